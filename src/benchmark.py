@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from synthetic_market import generate_market, get_market_dir, stamp_query_metadata, SCALES, BENCHMARK_DIR
+from run_metrics import get_peak_rss_mb
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RESULTS_DIR = f"{BENCHMARK_DIR}/results"
+BASELINE_FILE = f"{BENCHMARK_DIR}/baseline.json"
+
+# Benchmarked commands, run in this order against each market ({codes}: three stocks of the market).
+# "profile": the command accepts --profile; "stamp": the market's query metadata is stamped with today's
+# date before every run, so the incremental price query finds nothing to fetch whenever the market was generated
+BENCHMARK_CASES = {
+    "fetch_noop": {"command": ["query_data_new.py", "--data_type", "price", "--stock_type", "all"], "profile": True,
+                   "stamp": True},
+    "value": {"command": ["calculation_and_visualization_new.py", "--step", "value"], "profile": True},
+    "daily_value": {"command": ["daily_valuation.py", "--force"], "profile": False},
+    "screen": {"command": ["calculation_and_visualization_new.py", "--step", "screen", "--threshold", "0.26"],
+               "profile": True},
+    "visualize": {"command": ["calculation_and_visualization_new.py", "--step", "visualize", "--threshold", "0.05"],
+                  "profile": True},
+    "query_top_stocks": {"command": ["query_top_stocks.py", "--top_n", "20"], "profile": True},
+    "query_top_stocks_daily": {"command": ["query_top_stocks.py", "--top_n", "20", "--granularity", "daily"],
+                               "profile": True},
+    "query_stock_valuation": {"command": ["query_stock_valuation.py", "--stock_codes", "{codes}", "--no_plot"],
+                              "profile": True},
+}
+
+# Linux carries a process's peak memory over fork and exec, so the cases are started by this small
+# launcher rather than by the benchmark process (already large from pandas and the generated
+# markets); it reports the case's resource usage as JSON on the file descriptor in argv[1]
+LAUNCHER = """
+import os, sys, json, time
+fd = int(sys.argv[1])
+os.set_inheritable(fd, False)
+start = time.perf_counter()
+pid = os.posix_spawn(sys.argv[2], sys.argv[2:], os.environ)
+_, status, usage = os.wait4(pid, 0)
+os.write(fd, json.dumps({"wall": time.perf_counter() - start, "status": status, "cpu": usage.ru_utime + usage.ru_stime,
+                         "maxrss": usage.ru_maxrss}).encode())
+"""
+
+# A case is reported as slower or faster than the baseline beyond this ratio
+CHANGE_RATIO = 1.1
+
+
+def run_case(market_dir, name, case, codes, profile=False):
+    """
+    Run one benchmark command against a market and measure it
+
+    The command runs with the market's src folder as working directory, so
+    it reads and writes the market's data. Peak memory is the maximum
+    resident set size of the process. The valuation server is bypassed.
+    Returns: {"wall_seconds", "cpu_seconds", "peak_rss_mb", "returncode"}
+    """
+    if case.get("stamp"):
+        stamp_query_metadata(market_dir)
+    command = [part.replace("{codes}", codes) for part in case["command"]]
+    command = [sys.executable, os.path.join(SRC_DIR, command[0])] + command[1:]
+    if profile and case["profile"]:
+        command.append("--profile")
+
+    env = dict(os.environ, VALUATION_SERVER_URL="http://127.0.0.1:9", MPLBACKEND="Agg")
+    env.pop("PIPELINE_RUN_ID", None)
+
+    log_dir = f"{market_dir}/benchmark-logs"
+    os.makedirs(log_dir, exist_ok=True)
+    read_fd, write_fd = os.pipe()
+    with open(f"{log_dir}/{name}.log", 'w') as log:
+        subprocess.run([sys.executable, "-c", LAUNCHER, str(write_fd)] + command, cwd=f"{market_dir}/src", env=env,
+                       stdout=log, stderr=subprocess.STDOUT, pass_fds=[write_fd])
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        usage = json.load(f)
+
+    return {
+        "wall_seconds": round(usage["wall"], 3),
+        "cpu_seconds": round(usage["cpu"], 3),
+        "peak_rss_mb": round(get_peak_rss_mb(usage["maxrss"]), 1),
+        "returncode": os.waitstatus_to_exitcode(usage["status"]),
+    }
+
+
+def run_benchmarks(scales, case_names, repeat=1, seed=42, profile=False):
+    """
+    Run the benchmark cases against the synthetic market of each scale
+
+    Markets are generated (seeded) when they don't exist yet. Each case runs
+    repeat times; the median wall and CPU time and the highest peak memory
+    are kept.
+    Returns: the results, {scale: {case: measurements}}
+    """
+    results = {}
+    for stocks in scales:
+        market_dir = get_market_dir(stocks)
+        if not os.path.exists(f"{market_dir}/data/input/stock_names_full.csv"):
+            start = time.perf_counter()
+            generate_market(stocks, seed=seed)
+            print(f"Generated the market of {stocks} stocks in {time.perf_counter() - start:.0f}s")
+        codes = ",".join(pd.read_csv(f"{market_dir}/data/input/stock_names_full.csv", dtype={'code': str})['code'][:3])
+
+        results[str(stocks)] = {}
+        for name in case_names:
+            runs = [run_case(market_dir, name, BENCHMARK_CASES[name], codes, profile) for _ in range(repeat)]
+            result = {
+                "wall_seconds": float(np.median([run["wall_seconds"] for run in runs])),
+                "cpu_seconds": float(np.median([run["cpu_seconds"] for run in runs])),
+                "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+                "returncode": max((run["returncode"] for run in runs), key=abs),
+                "runs": [run["wall_seconds"] for run in runs],
+            }
+            results[str(stocks)][name] = result
+            status = "" if result["returncode"] == 0 else f"  FAILED (exit {result['returncode']}, see {market_dir}/benchmark-logs/{name}.log)"
+            print(f"  {stocks:>6} stocks  {name:<24} {result['wall_seconds']:>9.2f}s wall {result['cpu_seconds']:>9.2f}s cpu "
+                  f"{result['peak_rss_mb']:>9.1f} MB peak{status}")
+    return results
+
+
+def load_results(results_file):
+    """Load a results or baseline file, or None if it does not exist"""
+    if not os.path.exists(results_file):
+        return None
+    with open(results_file, 'r') as f:
+        return json.load(f)
+
+
+def save_results(results, results_file):
+    """Save benchmark results with the environment they were measured in"""
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def compare_with_baseline(report, baseline):
+    """Print every case measured in both runs with its change in wall time and peak memory"""
+    print(f"\nCompared with the baseline of {baseline['created_at']} ({baseline['machine']}):")
+    print(f"  {'Stocks':>6}  {'Case':<24} {'Baseline':>9} {'Now':>9} {'Change':>8} {'Peak MB':>17}")
+    for stocks, cases in report["results"].items():
+        for name, result in cases.items():
+            before = baseline["results"].get(stocks, {}).get(name)
+            if before is None or before["returncode"] != 0 or result["returncode"] != 0:
+                continue
+            ratio = result["wall_seconds"] / before["wall_seconds"] if before["wall_seconds"] else float('nan')
+            flag = "slower" if ratio > CHANGE_RATIO else "faster" if ratio < 1 / CHANGE_RATIO else ""
+            print(f"  {stocks:>6}  {name:<24} {before['wall_seconds']:>8.2f}s {result['wall_seconds']:>8.2f}s "
+                  f"{(ratio - 1) * 100:>+7.0f}% {before['peak_rss_mb']:>8.0f} -> {result['peak_rss_mb']:<6.0f} {flag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages and query CLIs on seeded synthetic markets")
+    parser.add_argument("--scales", type=str, default="300,1000",
+                        help=f"Market sizes to run, comma-separated (default: 300,1000; all: {','.join(map(str, SCALES))})")
+    parser.add_argument("--cases", type=str, default=",".join(BENCHMARK_CASES),
+                        help=f"Cases to run, comma-separated, in this order (default: all of {list(BENCHMARK_CASES)})")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Runs per case; the median time is kept (default: 1)")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="Seed of newly generated markets (default: 42)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Also profile the cases that support it (into each market's data/pipeline/profiles)")
+    parser.add_argument("--save_baseline", action="store_true",
+                        help="Make these results the baseline later runs are compared with")
+
+    args = parser.parse_args()
+
+    case_names = [name.strip() for name in args.cases.split(',')]
+    unknown = set(case_names) - set(BENCHMARK_CASES)
+    if unknown:
+        sys.exit(f"Unknown cases: {sorted(unknown)}. Choose from {list(BENCHMARK_CASES)}.")
+    scales = [int(stocks) for stocks in args.scales.split(',')]
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "machine": f"{platform.node()} {platform.machine()} {os.cpu_count()} cpus, Python {platform.python_version()}",
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": run_benchmarks(scales, case_names, args.repeat, args.seed, args.profile),
+    }
+    results_file = f"{RESULTS_DIR}/benchmark_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    save_results(report, results_file)
+    print(f"Results written to {results_file}")
+
+    baseline = load_results(BASELINE_FILE)
+    if baseline is not None:
+        compare_with_baseline(report, baseline)
+    if args.save_baseline or baseline is None:
+        save_results(report, BASELINE_FILE)
+        print(f"Baseline saved to {BASELINE_FILE}")
@@ -6,6 +6,21 @@ from datetime import datetime
 from tqdm import tqdm
 import argparse
 import sys
+import json
+
+from screen_delta import load_changed_stocks
+from fetch_priority import load_priority_codes
+from price_rollup import load_rollup
+from financial_store import load_financials, join_financials_asof
+from daily_valuation import build_daily_valuation, load_latest_daily_values
+from symbol_table import get_ids, get_names
+from market_panel import load_panel_latest_values, is_published, publish_panels
+from valuation_db import sync_valuation_db
+from valuation_asof import load_as_of_values
+from industry_rank import add_industry_ranks
+from valuation_stream import scan_latest_values, STREAM_COLUMNS, MEMORY_CAP_MB, PEAK_RSS_BUDGET_MB
+from run_metrics import start_run, timed, count, record_io, get_peak_rss_mb
+from stage_profiler import add_profile_arguments, start_profiling
 
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -13,6 +28,9 @@ import matplotlib.font_manager as fm
 [f.name for f in fm.fontManager.ttflist if "PingFang" in f.name or "Heiti" in f.name]
 plt.rcParams['font.sans-serif'] = ['Heiti TC']
 
+# Written after every valuation run; the valuation server reloads when it changes
+PUBLISH_MARKER_FILE = "../data/processed/stock-valuation/published.json"
+
 
 def get_stock_codes():
     """
@@ -29,177 +47,310 @@ def get_stock_codes():
     return stock_codes
 
 
-def format_symbol(code):
+def calculate_stock_value(stock_code, today=None, financial_date='report_date'):
     """
-    Format stock symbol with proper prefix based on code
+    Calculate the valuation history of one stock from its financial and price data and save it
+
+    Every monthly bar uses the latest quarter reported as of its month end:
+    by period end (financial_date='report_date') or by announcement date
+    ('announce_date', no look-ahead).
+    Returns: the valuation DataFrame, or None if the stock's data is missing
     """
-    if code.startswith('6'):
-        return f'sh{code}'
-    elif code.startswith('9') or code.startswith('4'):
-        return f'bj{code}'
-    else:
-        return f'sz{code}'
+    today = today if today else datetime.now().strftime("%Y%m%d")
+    financial_file = f"../data/input/financial-indicators/all/financial_indicators_{stock_code}.csv"
+    price_file = f"../data/input/price-data/all/price_data_{stock_code}.csv"
+
+    if not os.path.exists(financial_file) or not os.path.exists(price_file):
+        print(f"Missing data for {stock_code}")
+        return None
+
+    with timed("csv_read", kind="financial"):
+        financial_df = load_financials(stock_code)
+    record_io("read", financial_file, len(financial_df), "financial")
+    # monthly price bars, maintained by the price query (see price_rollup.py)
+    with timed("csv_read", kind="price_monthly"):
+        price_month = load_rollup(stock_code, "monthly")
+    count("rows_read_total", len(price_month), kind="price_monthly")
+
+    with timed("compute", kind="valuation"):
+        # --- merge the price data with financial data ---
+        price_month['report_date'] = pd.to_datetime(price_month[['year', 'month']].assign(day=1)) + pd.offsets.MonthEnd(0)
+        financial_price = join_financials_asof(price_month, financial_df, 'report_date', as_of=financial_date)
+
+        # --- calculate pe_ttm, pb_ttm, pr_ttm ---
+        financial_price['pe_ttm'] = financial_price['close'] / financial_price['eps_ttm']
+        financial_price['pb_ttm'] = financial_price['close'] / financial_price['bps_ttm']
+        financial_price['pr_ttm'] = financial_price['pe_ttm'] / financial_price['roe_ttm']
+        financial_price['code'] = stock_code.zfill(6)
+        financial_price['update_date'] = today
+
+    os.makedirs(f"../data/processed/stock-valuation/all", exist_ok=True)
+    valuation_file = f"../data/processed/stock-valuation/all/stock_valuation_{stock_code}.csv"
+    with timed("csv_write", kind="valuation"):
+        financial_price.to_csv(valuation_file, index=False)
+    record_io("written", valuation_file, len(financial_price), "valuation")
+    return financial_price
 
 
-def calculate_stock_values(stock_codes):
+def calculate_stock_values(stock_codes, financial_date='report_date'):
     """
     Calculate stock values based on financial data and price data
     """
-    financial_files = os.listdir('../data/input/financial-indicators/all/')
-    price_files = os.listdir('../data/input/price-data/all/')
-
     today = datetime.now().strftime("%Y%m%d")
 
     for stock_code in tqdm(stock_codes):
-        # Find matching files
-        financial_file = [file for file in financial_files if stock_code in file]
-        price_file = [file for file in price_files if stock_code in file]
+        calculate_stock_value(stock_code, today, financial_date)
 
-        if not financial_file or not price_file:
-            print(f"Missing data for {stock_code}")
-            continue
+    publish_valuations(stock_codes, financial_date)
 
-        financial_file = financial_file[0]
-        price_file = price_file[0]
 
-        financial_df = pd.read_csv(f"../data/input/financial-indicators/all/{financial_file}")
-        price_df = pd.read_csv(f"../data/input/price-data/all/{price_file}")
+def publish_valuations(stock_codes, financial_date='report_date'):
+    """
+    Mark the valuation files of stock_codes as complete, so readers such as the valuation server can reload them,
+    and bring the other copies of the valuations up to date
 
-        # --- merge the price data with financial data ---
-        financial_df['report_date'] = pd.to_datetime(financial_df['report_date'])
-        price_df['report_date'] = pd.to_datetime(price_df['report_date'])
-        financial_df['year'] = financial_df['report_date'].dt.year
-        financial_df['month'] = financial_df['report_date'].dt.month
-        price_df['year'] = price_df['report_date'].dt.year
-        price_df['month'] = price_df['report_date'].dt.month
-        # aggregate the daily price into monthly price
-        price_month = price_df.groupby(['year', 'month']).agg({'open': 'first', 'close': 'last',
-                                                        'high': 'max', 'low': 'min'}).reset_index()
-
-        financial_price = pd.merge(price_month, financial_df, on=['year', 'month'], how='left', validate="1:1")
-        financial_price = financial_price.ffill()
+    The marker records the financial_date the files were computed with (read by market_index.py).
+    """
+    with open(PUBLISH_MARKER_FILE, 'w') as f:
+        json.dump({"published_at": datetime.now().isoformat(timespec='seconds'), "stocks": len(stock_codes),
+                   "financial_date": financial_date}, f)
+    # copy the rewritten files into the SQL database (see query_sql.py)
+    sync_valuation_db(stock_codes)
+    # keep a published shared valuation panel current for the processes attached to it
+    if is_published("valuation"):
+        publish_panels(["valuation"])
 
-        # --- calculate pe_ttm, pb_ttm, pr_ttm ---
-        financial_price['pe_ttm'] = financial_price['close'] / financial_price['eps_ttm']
-        financial_price['pb_ttm'] = financial_price['close'] / financial_price['bps_ttm']
-        financial_price['pr_ttm'] = financial_price['pe_ttm'] / financial_price['roe_ttm']
-        financial_price['code'] = stock_code.zfill(6)
-        financial_price['update_date'] = today
 
-        os.makedirs(f"../data/processed/stock-valuation/all", exist_ok=True)
-        financial_price.to_csv(f"../data/processed/stock-valuation/all/stock_valuation_{stock_code}.csv", index=False)
+def get_latest_stock_value(stock_value):
+    """
+    Get the latest valuation row of one stock (the columns of the market
+    scan), together with the 25th and 75th percentiles of the stock's own
+    pr_ttm history
+    """
+    latest = stock_value.iloc[-1][list(STREAM_COLUMNS)].copy()
+    latest['code'] = str(int(latest['code'])).zfill(6)
+    latest['pr_ttm_q25'] = stock_value['pr_ttm'].quantile(0.25)
+    latest['pr_ttm_q75'] = stock_value['pr_ttm'].quantile(0.75)
+    return latest
 
 
-def find_and_visualize_best_stocks(threshold=0.35):
+def load_latest_stock_values(granularity="monthly", memory_cap_mb=MEMORY_CAP_MB):
     """
-    Find and visualize the best stocks based on stock valuation
+    Load the latest valuation row of every stock, together with the 25th and
+    75th percentiles of the stock's own pr_ttm history
+
+    The monthly histories come from the shared market panel when one is
+    published and current (see market_panel.py), otherwise they are streamed
+    in typed chunks of at most memory_cap_mb (see valuation_stream.py).
+    granularity='daily' reads the daily valuation archive instead: the row of
+    the last trading day and the percentiles of the daily history.
     """
-    today = datetime.now().strftime("%Y%m%d")
+    if granularity == "daily":
+        return load_latest_daily_values()
+    stock_values = load_panel_latest_values()
+    if stock_values is not None:
+        return stock_values
+
+    stock_values = scan_latest_values(memory_cap_mb=memory_cap_mb)
+    peak = get_peak_rss_mb()
+    print(f"Scanned {len(stock_values)} stocks, peak memory {peak:.0f} MB (budget {PEAK_RSS_BUDGET_MB} MB)")
+    if peak > PEAK_RSS_BUDGET_MB:
+        print(f"Warning: peak memory is over the budget of {PEAK_RSS_BUDGET_MB} MB; lower --memory_cap_mb")
+    return stock_values
+
+
+def filter_best_stocks(stock_values, threshold=0.35, reference=None):
+    """
+    Filter the stocks whose pe/pb/pr are below and roe above the threshold quantiles
+
+    The quantiles are taken over reference (default: stock_values itself).
+    """
+    reference = stock_values if reference is None else reference
 
     # pe_ttm, pb_ttm, pr_ttm < 25 quantile
     # roe_ttm > 25 quantile
-    stock_values = []
-    for stock_value_file in os.listdir("../data/processed/stock-valuation/all"):
-        if not stock_value_file.endswith('.csv'):
-            continue
-        stock_value = pd.read_csv(os.path.join("../data/processed/stock-valuation/all/", stock_value_file))
-        stock_value['code'] = stock_value['code'].astype(int).astype(str).str.zfill(6)
-        stock_values.append(stock_value.iloc[-1])
+    pe_th = reference.query("pe_ttm > 0").pe_ttm.quantile(threshold)
+    pb_th = reference.query("pe_ttm > 0").pb_ttm.quantile(threshold)
+    pr_th = reference.query("pe_ttm > 0").pr_ttm.quantile(threshold)
+    roe_th = reference.query("pe_ttm > 0").roe_ttm.quantile(1-threshold)
 
-    stock_values = pd.DataFrame(stock_values, columns=stock_value.columns)
-    pe_th = stock_values.query("pe_ttm > 0").pe_ttm.quantile(threshold)
-    pb_th = stock_values.query("pe_ttm > 0").pb_ttm.quantile(threshold)
-    pr_th = stock_values.query("pe_ttm > 0").pr_ttm.quantile(threshold)
-    roe_th = stock_values.query("pe_ttm > 0").roe_ttm.quantile(1-threshold)
+    return stock_values.query(f"(pe_ttm < {pe_th}) & (pb_ttm < {pb_th}) & (pr_ttm < {pr_th}) & (roe_ttm > {roe_th})")
 
-    stock_values_filtered = stock_values.query(f"(pe_ttm < {pe_th}) & (pb_ttm < {pb_th}) & (pr_ttm < {pr_th}) & (roe_ttm > {roe_th})")
-    stock_values_filtered.to_csv(f"../data/processed/stock-valuation/stocks_values_filtered_{today}.csv", index=False)
+
+def screen_best_stocks(threshold=0.35, stock_values=None, granularity="monthly", memory_cap_mb=MEMORY_CAP_MB,
+                       as_of=None):
+    """
+    Screen the best stocks based on stock valuation and save the filtered list
+
+    stock_values defaults to the latest valuations on disk, monthly or daily;
+    the streaming pipeline passes the snapshot it maintains in memory instead.
+    as_of ('YYYY-MM') screens the valuations as of the end of that month; its
+    list is saved as stocks_values_filtered_YYYYMM.csv, without a snapshot.
+    With an industry classification, the list and the snapshot carry each
+    stock's industry and its industry-relative ranks (industry_rank.py).
+    """
+    today = datetime.now().strftime("%Y%m%d")
+
+    if as_of:
+        stock_values = load_as_of_values(as_of, granularity)
+    elif stock_values is None:
+        stock_values = load_latest_stock_values(granularity, memory_cap_mb)
+    else:
+        stock_values = stock_values.copy()
+    stock_values = add_industry_ranks(stock_values)
+    with timed("compute", kind="screen"):
+        stock_values_filtered = filter_best_stocks(stock_values, threshold)
+    count("stocks_screened_total", len(stock_values))
+    date = as_of.replace('-', '') if as_of else today
+    stock_values_filtered.to_csv(f"../data/processed/stock-valuation/stocks_values_filtered_{date}.csv", index=False)
+
+    if not as_of:
+        # keep the metric snapshot of the whole market for change detection against the next run
+        stock_values['in_screen'] = stock_values['code'].isin(stock_values_filtered['code'])
+        stock_values.to_csv(f"../data/processed/stock-valuation/stocks_values_snapshot_{today}.csv", index=False)
 
     ob_stocks = stock_values_filtered.code.tolist()
+    print(f"The number of stocks that meet the criteria is {len(ob_stocks)} and are {ob_stocks}.")
+    return ob_stocks
+
+
+def load_screened_stocks(date=None):
+    """
+    Load the stock codes from the filtered stocks file of the given date (default: today)
+    """
+    date = date if date else datetime.now().strftime("%Y%m%d")
+    stocks = pd.read_csv(f"../data/processed/stock-valuation/stocks_values_filtered_{date}.csv", dtype={'code': str})
+    return stocks['code'].str.zfill(6).tolist()
+
+
+def get_image_file(stock_code, date=None):
+    """
+    Get the path of the distribution plot of a stock for the given date (default: today)
+    """
+    date = date if date else datetime.now().strftime("%Y%m%d")
+    return f"../img/{date}/pe_pb_pr_roe_distribution_monthly_close_{stock_code}_{date}.png"
+
+
+def plot_valuation_distribution(stock_code, stock_name, financial_price, image_file):
+    """
+    Plot the pe/pb/pr/roe distributions of one stock's valuation history and save the image
+    """
+    latest = financial_price.iloc[-1]
+
+    fig, axes = plt.subplots(2, 2, figsize=(12, 6))
+    axes = axes.flatten()
+
+    # pe ttm distribution
+    sns.histplot(financial_price, x='pe_ttm', color="#eeb908", ax=axes[0], kde=True)
+    axes[0].set_xlim(0, None)
+
+    # median pettm
+    axes[0].axvline(x=financial_price['pe_ttm'].median(), color='blue', linestyle='--', label='median')
+    # 25th percentile
+    axes[0].axvline(x=financial_price['pe_ttm'].quantile(0.25), color='blue', linestyle='--', label='25th percentile')
+    # 75th percentile
+    axes[0].axvline(x=financial_price['pe_ttm'].quantile(0.75), color='blue', linestyle='--', label='75th percentile')
+
+    # current pe ttm
+    axes[0].axvline(x=latest['pe_ttm'], color='red', linestyle='--', label='current')
+    axes[0].legend()
+
+    # pb ttm distribution
+    sns.histplot(financial_price, x='pb_ttm', color="#eeb908", ax=axes[1], kde=True)
+    axes[1].set_xlim(0, None)
+
+    # median pbttm
+    axes[1].axvline(x=financial_price['pb_ttm'].median(), color='blue', linestyle='--')
+    # 25th percentile
+    axes[1].axvline(x=financial_price['pb_ttm'].quantile(0.25), color='blue', linestyle='--')
+    # 75th percentile
+    axes[1].axvline(x=financial_price['pb_ttm'].quantile(0.75), color='blue', linestyle='--')
+    # current pb ttm
+    axes[1].axvline(x=latest['pb_ttm'], color='red', linestyle='--')
+
+    # pr ttm distribution
+    sns.histplot(financial_price, x='pr_ttm', color="#eeb908", ax=axes[2], kde=True)
+    axes[2].set_xlim(0, None)
+
+    # median prttm
+    axes[2].axvline(x=financial_price['pr_ttm'].median(), color='blue', linestyle='--')
+    # 25th percentile
+    axes[2].axvline(x=financial_price['pr_ttm'].quantile(0.25), color='blue', linestyle='--')
+    # 75th percentile
+    axes[2].axvline(x=financial_price['pr_ttm'].quantile(0.75), color='blue', linestyle='--')
+    # current pr ttm
+    axes[2].axvline(x=latest['pr_ttm'], color='red', linestyle='--')
+
+    # roe ttm distribution
+    sns.histplot(financial_price, x='roe_ttm', color="#eeb908", ax=axes[3], kde=True)
+    axes[3].set_xlim(0, None)
+
+    # median roettm
+    axes[3].axvline(x=financial_price['roe_ttm'].median(), color='blue', linestyle='--')
+    # 25th percentile
+    axes[3].axvline(x=financial_price['roe_ttm'].quantile(0.25), color='blue', linestyle='--')
+    # 75th percentile
+    axes[3].axvline(x=financial_price['roe_ttm'].quantile(0.75), color='blue', linestyle='--')
+    # current roe ttm
+    axes[3].axvline(x=latest['roe_ttm'], color='red', linestyle='--')
+
+    fig.suptitle(f"{stock_code} {stock_name} | pettm {latest['pe_ttm']:<10.2f} | \
+        pbttm {latest['pb_ttm']:<10.2f} | prttm {latest['pr_ttm']:<10.2f} | roettm {latest['roe_ttm']:<10.2f} | \
+        price {latest['close']:<10.2f} \
+        price_pr_25th {latest['close'] * financial_price['pr_ttm'].quantile(0.25) / latest['pr_ttm'] :<10.2f} \
+        price_pr_75th {latest['close'] * financial_price['pr_ttm'].quantile(0.75) / latest['pr_ttm'] :<10.2f}",
+        fontsize=10)
+    plt.tight_layout()
+
+    # save the image
+    plt.savefig(image_file, dpi=300)
+    plt.close()
+
+
+def visualize_stocks(ob_stocks, skip_existing=False):
+    """
+    Visualize the valuation distributions of the given stocks
+
+    With skip_existing, stocks already plotted today are not plotted again.
+    Returns: the image files of the given stocks
+    """
+    today = datetime.now().strftime("%Y%m%d")
+
     # create the img/{today} folder if it doesn't exist
     if not os.path.exists(f"../img/{today}"):
         os.makedirs(f"../img/{today}")
-    print(f"The number of stocks that meet the criteria is {len(ob_stocks)} and are {ob_stocks}.")
 
+    stock_names = dict(zip(ob_stocks, get_names(get_ids(ob_stocks))))
+    stock_files = os.listdir("../data/processed/stock-valuation/all")
+
+    image_files = []
     for stock_code in ob_stocks:
-        stock_files = os.listdir("../data/processed/stock-valuation/all")
+        image_file = get_image_file(stock_code, today)
+        if skip_existing and os.path.exists(image_file):
+            image_files.append(image_file)
+            continue
+
         ob_stock_file = [file for file in stock_files if stock_code in file]
         if not ob_stock_file:
             continue
         ob_stock_file = ob_stock_file[0]
         financial_price = pd.read_csv(os.path.join("../data/processed/stock-valuation/all/", ob_stock_file))
+        stock_name = stock_names[stock_code]
+
+        with timed("plot"):
+            plot_valuation_distribution(stock_code, stock_name, financial_price, image_file)
+        record_io("written", image_file, 1, "image")
+        image_files.append(image_file)
+
+    return image_files
+
 
-        fig, axes = plt.subplots(2, 2, figsize=(12, 6))
-        axes = axes.flatten()
-
-        # pe ttm distribution
-        sns.histplot(financial_price, x='pe_ttm', color="#eeb908", ax=axes[0], kde=True)
-        axes[0].set_xlim(0, None)
-
-        # median pettm
-        axes[0].axvline(x=financial_price['pe_ttm'].median(), color='blue', linestyle='--', label='median')
-        # 25th percentile
-        axes[0].axvline(x=financial_price['pe_ttm'].quantile(0.25), color='blue', linestyle='--', label='25th percentile')
-        # 75th percentile
-        axes[0].axvline(x=financial_price['pe_ttm'].quantile(0.75), color='blue', linestyle='--', label='75th percentile')
-
-        # current pe ttm
-        axes[0].axvline(x=financial_price.iloc[-1, -5], color='red', linestyle='--', label='current')
-        axes[0].legend()
-
-        # pb ttm distribution
-        sns.histplot(financial_price, x='pb_ttm', color="#eeb908", ax=axes[1], kde=True)
-        axes[1].set_xlim(0, None)
-
-        # median pbttm
-        axes[1].axvline(x=financial_price['pb_ttm'].median(), color='blue', linestyle='--')
-        # 25th percentile
-        axes[1].axvline(x=financial_price['pb_ttm'].quantile(0.25), color='blue', linestyle='--')
-        # 75th percentile
-        axes[1].axvline(x=financial_price['pb_ttm'].quantile(0.75), color='blue', linestyle='--')
-        # current pb ttm
-        axes[1].axvline(x=financial_price.iloc[-1, -4], color='red', linestyle='--')
-
-        # pr ttm distribution
-        sns.histplot(financial_price, x='pr_ttm', color="#eeb908", ax=axes[2], kde=True)
-        axes[2].set_xlim(0, None)
-
-        # median prttm
-        axes[2].axvline(x=financial_price['pr_ttm'].median(), color='blue', linestyle='--')
-        # 25th percentile
-        axes[2].axvline(x=financial_price['pr_ttm'].quantile(0.25), color='blue', linestyle='--')
-        # 75th percentile
-        axes[2].axvline(x=financial_price['pr_ttm'].quantile(0.75), color='blue', linestyle='--')
-        # current pr ttm
-        axes[2].axvline(x=financial_price.iloc[-1, -3], color='red', linestyle='--')
-
-        # roe ttm distribution
-        sns.histplot(financial_price, x='roe_ttm', color="#eeb908", ax=axes[3], kde=True)
-        axes[3].set_xlim(0, None)
-
-        # median roettm
-        axes[3].axvline(x=financial_price['roe_ttm'].median(), color='blue', linestyle='--')
-        # 25th percentile
-        axes[3].axvline(x=financial_price['roe_ttm'].quantile(0.25), color='blue', linestyle='--')
-        # 75th percentile
-        axes[3].axvline(x=financial_price['roe_ttm'].quantile(0.75), color='blue', linestyle='--')
-        # current roe ttm
-        axes[3].axvline(x=financial_price.iloc[-1, -6], color='red', linestyle='--')
-
-        stock_names = pd.read_csv("../data/input/stock_names_full.csv")
-        stock_name = stock_names[stock_names['code'] == int(stock_code)]['name'].values[0]
-
-        fig.suptitle(f"{stock_code} {stock_name} | pettm {financial_price.iloc[-1, -5]:<10.2f} | \
-            pbttm {financial_price.iloc[-1, -4]:<10.2f} | prttm {financial_price.iloc[-1, -3]:<10.2f} | roettm {financial_price.iloc[-1, -6]:<10.2f} | \
-            price {financial_price.iloc[-1, 3]:<10.2f} \
-            price_pr_25th {financial_price.iloc[-1, 3] * financial_price['pr_ttm'].quantile(0.25) / financial_price.iloc[-1, -3] :<10.2f} \
-            price_pr_75th {financial_price.iloc[-1, 3] * financial_price['pr_ttm'].quantile(0.75) / financial_price.iloc[-1, -3] :<10.2f}",
-            fontsize=10)
-        plt.tight_layout()
-
-        # save the image
-        plt.savefig(f"../img/{today}/pe_pb_pr_roe_distribution_monthly_close_{stock_code}_{today}.png", dpi=300)
-        plt.close()
+def find_and_visualize_best_stocks(threshold=0.35, granularity="monthly", memory_cap_mb=MEMORY_CAP_MB):
+    """
+    Find and visualize the best stocks based on stock valuation
+    """
+    ob_stocks = screen_best_stocks(threshold, granularity=granularity, memory_cap_mb=memory_cap_mb)
+    visualize_stocks(ob_stocks)
 
 
 if __name__ == "__main__":
@@ -207,17 +358,59 @@ if __name__ == "__main__":
     parser.add_argument("--threshold", type=float, default=0.26,
                         help="The threshold value for filtering stocks")
     parser.add_argument("--step", type=str,
-                        choices=['value', 'visualize', 'all'],
+                        choices=['value', 'screen', 'render', 'visualize', 'all'],
                         default='all',
-                        help="The step to run, either 'value', 'visualize', or 'all'")
+                        help="The step to run: 'value', 'screen', 'render', 'visualize' (screen + render), or 'all'")
+    parser.add_argument("--changed_only", action="store_true",
+                        help="Render only the stocks that changed since the previous screen (run screen_delta.py first)")
+    parser.add_argument("--financial_date", type=str, default="report_date",
+                        choices=['report_date', 'announce_date'],
+                        help="Match each month with the latest quarter by period end (default) or by announcement "
+                             "date (no look-ahead, for backtests)")
+    parser.add_argument("--priority_only", action="store_true",
+                        help="Value only today's priority set (run query_data_new.py --priority first)")
+    parser.add_argument("--granularity", type=str, default="monthly",
+                        choices=['monthly', 'daily'],
+                        help="Screen on the latest monthly close (default) or on the latest trading day; "
+                             "'daily' also updates the daily valuation archive in the value step")
+
+    parser.add_argument("--memory_cap_mb", type=int, default=MEMORY_CAP_MB,
+                        help=f"Valuation CSV text parsed at a time while scanning the market, in MB (default: {MEMORY_CAP_MB})")
+
+    parser.add_argument("--as_of", type=str, default=None,
+                        help="With --step screen, screen the valuations as of the end of a past month, YYYY-MM")
+
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
+    if args.as_of and args.step != 'screen':
+        parser.error("--as_of only applies to --step screen")
+
+    start_run(args.step)
+    if args.profile:
+        start_profiling(args.step, args.profile_memory, args.profile_top)
 
-    stock_codes = get_stock_codes()
     if args.step == 'value':
-        calculate_stock_values(stock_codes)
+        stock_codes = get_stock_codes()
+        if args.priority_only:
+            priority_codes = load_priority_codes()
+            if priority_codes is None:
+                sys.exit("Today's priority set is not complete yet.")
+            priority_codes = set(priority_codes)
+            stock_codes = [code for code in stock_codes if code in priority_codes]
+        calculate_stock_values(stock_codes, args.financial_date)
+        if args.granularity == 'daily':
+            build_daily_valuation(stock_codes, args.financial_date)
+    elif args.step == 'screen':
+        screen_best_stocks(args.threshold, granularity=args.granularity, memory_cap_mb=args.memory_cap_mb,
+                           as_of=args.as_of)
+    elif args.step == 'render':
+        visualize_stocks(load_changed_stocks() if args.changed_only else load_screened_stocks())
     elif args.step == 'visualize':
-        find_and_visualize_best_stocks(args.threshold)
+        find_and_visualize_best_stocks(args.threshold, args.granularity, args.memory_cap_mb)
     elif args.step == 'all':
-        calculate_stock_values(stock_codes)
-        find_and_visualize_best_stocks(args.threshold)
\ No newline at end of file
+        stock_codes = get_stock_codes()
+        calculate_stock_values(stock_codes, args.financial_date)
+        if args.granularity == 'daily':
+            build_daily_valuation(stock_codes, args.financial_date)
+        find_and_visualize_best_stocks(args.threshold, args.granularity, args.memory_cap_mb)
\ No newline at end of file
@@ -0,0 +1,272 @@
+import os
+import time
+import argparse
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from financial_store import load_financials, get_financial_file, FINANCIAL_DIR
+
+PRICE_DIR = "../data/input/price-data/all"
+
+# All stocks' daily valuations in one typed numpy archive: the rows of a stock are
+# contiguous (codes[i] owns rows offsets[i]:offsets[i + 1]) and sorted by date
+DAILY_VALUATION_FILE = "../data/processed/stock-valuation/daily/valuation_daily.npz"
+
+# Values kept per row, as float32 (dates are int32 days since 1970-01-01)
+VALUE_COLUMNS = ['close', 'bps_ttm', 'eps_ttm', 'roe_ttm', 'pe_ttm', 'pb_ttm', 'pr_ttm']
+
+# Composite (stock, day) key: day numbers stay far below this
+DAYS_PER_CODE = 100000
+
+
+def list_daily_codes():
+    """Get the codes that have both a daily price file and financial indicators"""
+    price_codes = {file[11:17] for file in os.listdir(PRICE_DIR) if file.endswith('.csv')}
+    financial_codes = {file[21:27] for file in os.listdir(FINANCIAL_DIR) if file.endswith('.csv')}
+    return sorted(price_codes & financial_codes)
+
+
+def to_days(dates):
+    """Convert dates to int32 days since 1970-01-01"""
+    return pd.to_datetime(dates).to_numpy(dtype='datetime64[D]').astype(np.int32)
+
+
+def read_daily_closes(stock_code):
+    """
+    Read the trading days and raw closes of one stock
+    Returns: (int32 days, float32 closes), sorted by day
+    """
+    price_df = pd.read_csv(f"{PRICE_DIR}/price_data_{stock_code}.csv", usecols=['report_date', 'close'],
+                           dtype={'close': np.float32})
+    days = to_days(price_df['report_date'])
+    order = np.argsort(days, kind='stable')
+    return days[order], price_df['close'].to_numpy()[order]
+
+
+def load_inputs(stock_codes, financial_date='report_date'):
+    """
+    Read the daily closes and reported quarters of the given stocks into flat typed arrays
+
+    Stock i of stock_codes gets code id i. financial_date selects the date a
+    quarter becomes usable from: its period end or its announcement date.
+    Returns: (price arrays, financial arrays) as dicts of numpy arrays
+    """
+    price_parts, financial_parts = [], []
+    for code_id, stock_code in enumerate(tqdm(stock_codes, desc="Reading daily prices and financials")):
+        days, closes = read_daily_closes(stock_code)
+        price_parts.append((np.full(len(days), code_id, dtype=np.int32), days, closes))
+
+        financial_df = load_financials(stock_code)
+        financial_parts.append((np.full(len(financial_df), code_id, dtype=np.int32),
+                                to_days(financial_df[financial_date]),
+                                to_days(financial_df['report_date']),
+                                financial_df[['bps_ttm', 'eps_ttm', 'roe_ttm']].to_numpy(dtype=np.float32)))
+
+    price = {
+        'code_id': np.concatenate([part[0] for part in price_parts] or [np.empty(0, np.int32)]),
+        'date': np.concatenate([part[1] for part in price_parts] or [np.empty(0, np.int32)]),
+        'close': np.concatenate([part[2] for part in price_parts] or [np.empty(0, np.float32)]),
+    }
+    fundamentals = np.concatenate([part[3] for part in financial_parts] or [np.empty((0, 3), np.float32)])
+    financial = {
+        'code_id': np.concatenate([part[0] for part in financial_parts] or [np.empty(0, np.int32)]),
+        'as_of': np.concatenate([part[1] for part in financial_parts] or [np.empty(0, np.int32)]),
+        'quarter': np.concatenate([part[2] for part in financial_parts] or [np.empty(0, np.int32)]),
+        'bps_ttm': fundamentals[:, 0],
+        'eps_ttm': fundamentals[:, 1],
+        'roe_ttm': fundamentals[:, 2],
+    }
+    return price, financial
+
+
+def join_daily_asof(price, financial):
+    """
+    Value every trading day of every stock against its latest usable quarter
+
+    The as-of join runs over all stocks at once: (stock, day) pairs are
+    encoded as one int64 key, so a single searchsorted over the sorted
+    quarter keys finds for each bar the last quarter of the same stock usable
+    on or before its day. When several quarters become usable on the same day
+    the most recent period wins. Bars before a stock's first quarter keep NaN
+    fundamentals, like the monthly valuation.
+    price must be sorted by (code_id, date).
+    Returns: dict of numpy arrays with code_id, date, quarter and VALUE_COLUMNS
+    """
+    financial_keys = financial['code_id'].astype(np.int64) * DAYS_PER_CODE + financial['as_of']
+    order = np.lexsort((financial['quarter'], financial_keys))
+    financial_keys = financial_keys[order]
+
+    price_keys = price['code_id'].astype(np.int64) * DAYS_PER_CODE + price['date']
+    match = np.searchsorted(financial_keys, price_keys, side='right') - 1
+    found = match >= 0
+    found[found] = financial['code_id'][order][match[found]] == price['code_id'][found]
+    rows = order[np.where(found, match, 0)]
+
+    daily = {'code_id': price['code_id'], 'date': price['date'], 'close': price['close']}
+    daily['quarter'] = np.where(found, financial['quarter'][rows], np.iinfo(np.int32).min).astype(np.int32)
+    for column in ['bps_ttm', 'eps_ttm', 'roe_ttm']:
+        daily[column] = np.where(found, financial[column][rows], np.nan).astype(np.float32)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        daily['pe_ttm'] = daily['close'] / daily['eps_ttm']
+        daily['pb_ttm'] = daily['close'] / daily['bps_ttm']
+        daily['pr_ttm'] = daily['pe_ttm'] / daily['roe_ttm']
+    return daily
+
+
+def load_daily_store(daily_file=DAILY_VALUATION_FILE):
+    """
+    Load the daily valuation archive
+    Returns: dict of numpy arrays, or None if it has not been built yet
+    """
+    if not os.path.exists(daily_file):
+        return None
+    with np.load(daily_file) as archive:
+        return {name: archive[name] for name in archive.files}
+
+
+def save_daily_store(store, daily_file=DAILY_VALUATION_FILE):
+    """Save the daily valuation archive atomically"""
+    os.makedirs(os.path.dirname(daily_file), exist_ok=True)
+    tmp_file = f"{daily_file}.tmp.npz"
+    np.savez(tmp_file, **store)
+    os.replace(tmp_file, daily_file)
+
+
+def get_changed_codes(stock_codes, store, financial_date, daily_file=DAILY_VALUATION_FILE):
+    """
+    Get the stocks whose daily valuations must be recomputed
+
+    Those are the stocks missing from the archive and those whose price or
+    financial file changed since it was written; all of them when it was
+    built with the other financial_date.
+    """
+    if store is None or str(store['financial_date']) != financial_date:
+        return list(stock_codes)
+    stored_at = os.path.getmtime(daily_file)
+    stored_codes = set(store['codes'].tolist())
+    return [stock_code for stock_code in stock_codes
+            if stock_code not in stored_codes
+            or os.path.getmtime(f"{PRICE_DIR}/price_data_{stock_code}.csv") > stored_at
+            or os.path.getmtime(get_financial_file(stock_code)) > stored_at]
+
+
+def build_daily_valuation(stock_codes=None, financial_date='report_date', force=False):
+    """
+    Compute the daily valuation series of all stocks and store them
+
+    Only stocks whose inputs changed since the last build are read and
+    valued; the rows of the others are carried over from the archive.
+    Stocks that no longer have data are dropped. With stock_codes, only those
+    stocks are considered for recomputation and all others are kept as stored;
+    without a stored archive of the same financial_date (or with force) there
+    is nothing to keep, so every stock is computed.
+    Returns: the number of recomputed stocks
+    """
+    start = time.perf_counter()
+    all_codes = np.array(list_daily_codes(), dtype='U6')
+    store = None if force else load_daily_store()
+    if store is None or str(store['financial_date']) != financial_date:
+        stock_codes = None
+    candidates = all_codes if stock_codes is None else sorted(set(stock_codes) & set(all_codes))
+    changed = get_changed_codes(candidates, store, financial_date)
+
+    price, financial = load_inputs(changed, financial_date)
+    daily = join_daily_asof(price, financial)
+    # code ids of load_inputs index the recomputed stocks: renumber them over all stocks
+    daily['code_id'] = np.searchsorted(all_codes, np.array(changed, dtype='U6')).astype(np.int32)[daily['code_id']]
+
+    if store is not None and str(store['financial_date']) == financial_date:
+        # carry over the stored rows of the stocks that are still listed and were not recomputed
+        stored_codes = store['codes']
+        keep_code = np.isin(stored_codes, all_codes) & ~np.isin(stored_codes, changed)
+        keep = np.repeat(keep_code, np.diff(store['offsets']))
+        kept_ids = np.searchsorted(all_codes, stored_codes).astype(np.int32)
+        kept = {'code_id': np.repeat(kept_ids, np.diff(store['offsets']))[keep],
+                'date': store['date'][keep], 'quarter': store['quarter'][keep]}
+        kept.update({column: store[column][keep] for column in VALUE_COLUMNS})
+        daily = {name: np.concatenate([kept[name], daily[name]]) for name in daily}
+
+    order = np.argsort(daily['code_id'], kind='stable')
+    counts = np.bincount(daily['code_id'][order], minlength=len(all_codes))
+    present = counts > 0
+    result = {
+        'codes': all_codes[present],
+        'offsets': np.r_[0, np.cumsum(counts[present])].astype(np.int64),
+        'date': daily['date'][order],
+        'quarter': daily['quarter'][order],
+        'financial_date': np.array(financial_date),
+        'update_date': np.array(datetime.now().strftime("%Y%m%d")),
+    }
+    result.update({column: daily[column][order] for column in VALUE_COLUMNS})
+    save_daily_store(result)
+
+    print(f"Daily valuation: recomputed {len(changed)} of {len(result['codes'])} stocks, "
+          f"{len(result['date'])} rows in {time.perf_counter() - start:.1f}s.")
+    return len(changed)
+
+
+def store_to_frame(store, rows, code_ids):
+    """Turn rows of the archive into a valuation DataFrame"""
+    frame = pd.DataFrame({'code': store['codes'][code_ids],
+                          'report_date': store['date'][rows].astype('datetime64[D]').astype('datetime64[ns]')})
+    frame['year'] = frame['report_date'].dt.year
+    frame['month'] = frame['report_date'].dt.month
+    for column in VALUE_COLUMNS:
+        frame[column] = store[column][rows]
+    quarter = store['quarter'][rows]
+    frame['financial_report_date'] = pd.to_datetime(np.where(quarter == np.iinfo(np.int32).min, np.datetime64('NaT'),
+                                                             quarter.astype('datetime64[D]')))
+    frame['update_date'] = str(store['update_date'])
+    return frame
+
+
+def load_daily_stock_valuation(stock_code, store=None):
+    """
+    Load the daily valuation history of one stock
+    Returns: DataFrame with report_date (the trading day), close, the fundamentals and pe/pb/pr
+    """
+    store = load_daily_store() if store is None else store
+    if store is None:
+        raise FileNotFoundError("Daily valuation not found. Run 'python daily_valuation.py' first.")
+    position = np.searchsorted(store['codes'], stock_code)
+    if position == len(store['codes']) or store['codes'][position] != stock_code:
+        raise FileNotFoundError(f"Daily valuation not found for stock {stock_code}")
+    rows = np.arange(store['offsets'][position], store['offsets'][position + 1])
+    return store_to_frame(store, rows, np.full(len(rows), position))
+
+
+def load_latest_daily_values(store=None):
+    """
+    Load the latest daily valuation of every stock, together with the 25th and
+    75th percentiles of the stock's own daily pr_ttm history
+    """
+    store = load_daily_store() if store is None else store
+    if store is None:
+        raise FileNotFoundError("Daily valuation not found. Run 'python daily_valuation.py' first.")
+    counts = np.diff(store['offsets'])
+    code_ids = np.flatnonzero(counts)
+    latest = store_to_frame(store, store['offsets'][1:][code_ids] - 1, code_ids)
+
+    pr_ttm = pd.Series(store['pr_ttm'].astype(np.float64))
+    quantiles = pr_ttm.groupby(np.repeat(np.arange(len(counts)), counts)).quantile([0.25, 0.75]).unstack()
+    latest['pr_ttm_q25'] = quantiles.loc[code_ids, 0.25].to_numpy()
+    latest['pr_ttm_q75'] = quantiles.loc[code_ids, 0.75].to_numpy()
+    return latest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute the daily valuation series of all stocks into a typed archive")
+    parser.add_argument("--financial_date", type=str, default="report_date",
+                        choices=['report_date', 'announce_date'],
+                        help="Match each day with the latest quarter by period end (default) or by announcement "
+                             "date (no look-ahead, for backtests)")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute every stock instead of only those whose data changed")
+
+    args = parser.parse_args()
+
+    build_daily_valuation(financial_date=args.financial_date, force=args.force)
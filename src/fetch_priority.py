@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import fcntl
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from screen_delta import find_previous_snapshot_date, load_snapshot
+
+# Written by the price query once the priority set is fetched, read by downstream steps
+PRIORITY_MARKER_FILE = "../data/input/price-data/priority_complete.json"
+
+# Fetch order: lower tiers are fetched first
+PRIORITY_TIERS = {
+    "portfolio": 0,
+    "last_screen": 1,
+    "near_threshold": 2,
+    "rest": 3,
+}
+
+
+def load_last_snapshot():
+    """Load the most recent metric snapshot written by the screen step, or None if there is none"""
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y%m%d")
+    date = find_previous_snapshot_date(tomorrow)
+    return load_snapshot(date) if date else None
+
+
+def screen_distance(snapshot, threshold=0.26):
+    """
+    How far each stock of a snapshot is from passing the screen
+
+    Each metric is turned into its quantile among the stocks with a positive
+    PE (the reference of filter_best_stocks), oriented so that lower is
+    better; the distance is the largest excess over the threshold. Screened
+    stocks have a distance <= 0.
+    Returns: Series of distances indexed like the snapshot
+    """
+    reference = snapshot[snapshot['pe_ttm'] > 0]
+    excess = []
+    for metric, ascending in [('pe_ttm', True), ('pb_ttm', True), ('pr_ttm', True), ('roe_ttm', False)]:
+        values = np.sort(reference[metric].dropna().to_numpy())
+        quantiles = np.searchsorted(values, snapshot[metric].to_numpy(), side='right') / max(len(values), 1)
+        excess.append((quantiles if ascending else 1 - quantiles) - threshold)
+    distance = np.nanmax(np.vstack(excess), axis=0)
+    return pd.Series(np.where(snapshot['pe_ttm'] > 0, distance, np.inf), index=snapshot.index)
+
+
+def get_priority_tiers(portfolio_codes, threshold=0.26, margin=0.1):
+    """
+    Get the priority tier of the stocks that matter most to today's report
+
+    - portfolio     : the portfolio holdings
+    - last_screen   : the members of the last screen
+    - near_threshold: stocks within margin of passing the last screen's thresholds
+    Stocks not listed belong to the 'rest' tier.
+    Returns: {code: (tier, distance)}
+    """
+    tiers = {code: (PRIORITY_TIERS["portfolio"], 0.0) for code in portfolio_codes}
+
+    snapshot = load_last_snapshot()
+    if snapshot is None:
+        return tiers
+
+    distance = screen_distance(snapshot, threshold)
+    in_screen = snapshot['in_screen'].eq(True) if 'in_screen' in snapshot else distance <= 0
+    for code, dist, screened in zip(snapshot['code'], distance, in_screen):
+        if code in tiers:
+            continue
+        if screened:
+            tiers[code] = (PRIORITY_TIERS["last_screen"], float(dist))
+        elif dist <= margin:
+            tiers[code] = (PRIORITY_TIERS["near_threshold"], float(dist))
+    return tiers
+
+
+def split_by_priority(stocks_to_update, tiers):
+    """
+    Split the stocks to update into the priority set and the rest
+
+    The priority set is ordered by tier, then by distance to the screen, so
+    the closest candidates are fetched first.
+    tiers: {code: (tier, distance)} of get_priority_tiers()
+    Returns: (priority stocks, remaining stocks), both lists of (code, last_date)
+    """
+    rest_tier = (PRIORITY_TIERS["rest"], 0.0)
+    ordered = sorted(stocks_to_update, key=lambda stock: tiers.get(stock[0], rest_tier))
+    priority = [stock for stock in ordered if stock[0] in tiers]
+    remaining = [stock for stock in ordered if stock[0] not in tiers]
+    return priority, remaining
+
+
+def load_marker():
+    """Load the published priority marker, or None if there is none"""
+    if not os.path.exists(PRIORITY_MARKER_FILE):
+        return None
+    with open(PRIORITY_MARKER_FILE, 'r') as f:
+        return json.load(f)
+
+
+def publish_priority_complete(codes, failed_codes, stock_type=None):
+    """
+    Record that the priority set of today is fetched, so valuation and email can start on it
+
+    codes is the whole priority tier of the run's universe, including the
+    stocks that were already up to date. The marker of today collects the
+    runs of every universe (and shard): the codes are merged, and a stock
+    counts as failed until a later run of the day fetched it.
+    """
+    os.makedirs(os.path.dirname(PRIORITY_MARKER_FILE), exist_ok=True)
+    today = datetime.now().strftime("%Y-%m-%d")
+    with open(f"{PRIORITY_MARKER_FILE}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        marker = load_marker()
+        if marker is None or marker['date'] != today:
+            marker = {"date": today, "codes": [], "failed": [], "universes": []}
+
+        marker["completed_at"] = datetime.now().isoformat(timespec='seconds')
+        marker["codes"] = sorted(set(marker["codes"]) | set(codes))
+        marker["failed"] = sorted((set(marker["failed"]) - set(codes)) | set(failed_codes))
+        if stock_type and stock_type not in marker.get("universes", []):
+            marker["universes"] = marker.get("universes", []) + [stock_type]
+
+        tmp_file = f"{PRIORITY_MARKER_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(marker, f, indent=2)
+        os.replace(tmp_file, PRIORITY_MARKER_FILE)
+    print(f"Priority set complete: {len(codes) - len(failed_codes)}/{len(codes)} stocks of {stock_type or 'the run'} "
+          f"up to date; {len(marker['codes']) - len(marker['failed'])}/{len(marker['codes'])} of today's priority set "
+          f"({', '.join(marker['universes']) or '-'}).")
+
+
+def load_priority_codes(date=None):
+    """
+    Load the codes of the priority set published on the given date (default: today)
+    Returns: list of codes, or None if the priority set of that date is not complete yet
+    """
+    date = date if date else datetime.now().strftime("%Y-%m-%d")
+    marker = load_marker()
+    if marker is None or marker['date'] != date:
+        return None
+    return [code for code in marker['codes'] if code not in marker['failed']]
+
+
+def wait_for_priority(timeout=3600, interval=10):
+    """
+    Block until today's priority set is complete
+    Returns: the priority codes, or None on timeout
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        codes = load_priority_codes()
+        if codes is not None or time.monotonic() >= deadline:
+            return codes
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the fetch priority order, or wait for today's priority set")
+    parser.add_argument("--threshold", type=float, default=0.26,
+                        help="The screen threshold the near-threshold tier is measured against")
+    parser.add_argument("--margin", type=float, default=0.1,
+                        help="Quantile distance to the thresholds within which a stock is near (default: 0.1)")
+    parser.add_argument("--wait", action="store_true",
+                        help="Wait until today's priority set is fetched (exit code 1 on timeout)")
+    parser.add_argument("--timeout", type=float, default=3600,
+                        help="Seconds to wait for the priority set (default: 3600)")
+
+    args = parser.parse_args()
+
+    from query_data_new import STOCK_TYPE_MAPPING
+
+    if args.wait:
+        codes = wait_for_priority(args.timeout)
+        if codes is None:
+            print("Timed out waiting for the priority set.")
+            raise SystemExit(1)
+        print(f"Priority set complete: {codes}")
+    else:
+        tiers = get_priority_tiers(STOCK_TYPE_MAPPING["portfolio"], args.threshold, args.margin)
+        names = {tier: name for name, tier in PRIORITY_TIERS.items()}
+        for code, (tier, distance) in sorted(tiers.items(), key=lambda item: item[1]):
+            print(f"{code}  {names[tier]:<15} {distance:+.3f}")
@@ -0,0 +1,96 @@
+import os
+import argparse
+
+import pandas as pd
+from tqdm import tqdm
+
+FINANCIAL_DIR = "../data/input/financial-indicators/all"
+
+FINANCIAL_COLUMNS = ['report_date', 'announce_date', 'bps', 'eps', 'roe', 'bps_ttm', 'eps_ttm', 'roe_ttm']
+
+# Statutory disclosure deadlines (CSRC), in months after the end of the report period:
+# Q1 by Apr 30, H1 by Aug 31, Q3 by Oct 31, annual report by Apr 30 of the next year
+ANNOUNCE_LAG_MONTHS = {
+    3: 1,
+    6: 2,
+    9: 1,
+    12: 4,
+}
+
+
+def estimate_announce_date(report_dates):
+    """
+    Latest date by which the reports of the given periods must be published
+
+    The quarterly source has no announcement dates, so the statutory deadline
+    is used: a conservative as-of date that never looks ahead.
+    """
+    report_dates = pd.to_datetime(pd.Series(report_dates))
+    lag = report_dates.dt.month.map(ANNOUNCE_LAG_MONTHS).fillna(1)
+    months = report_dates.dt.year * 12 + report_dates.dt.month - 1 + lag
+    first_day = pd.to_datetime(pd.DataFrame({'year': months // 12, 'month': months % 12 + 1, 'day': 1}))
+    return first_day + pd.offsets.MonthEnd(0)
+
+
+def compact_financials(financial_df):
+    """
+    Keep only the reported quarters of a financial table
+
+    Accepts the compact format as well as the former padded monthly grid,
+    whose empty months are dropped. Adds the announcement date when missing.
+    """
+    financial_df = financial_df.copy()
+    financial_df['report_date'] = pd.to_datetime(financial_df['report_date'])
+    financial_df = financial_df.dropna(subset=['eps_ttm']).reset_index(drop=True)
+    if 'announce_date' not in financial_df:
+        financial_df['announce_date'] = estimate_announce_date(financial_df['report_date'])
+    financial_df['announce_date'] = pd.to_datetime(financial_df['announce_date'])
+    return financial_df[FINANCIAL_COLUMNS]
+
+
+def get_financial_file(stock_code, financial_dir=FINANCIAL_DIR):
+    """Get the path of a stock's financial indicators"""
+    return f"{financial_dir}/financial_indicators_{stock_code}.csv"
+
+
+def save_financials(financial_df, financial_file):
+    """Save a compact financial table"""
+    financial_df.to_csv(financial_file, index=False, date_format='%Y-%m-%d')
+
+
+def load_financials(stock_code, financial_dir=FINANCIAL_DIR):
+    """Load a stock's reported quarters (files in the former monthly grid format are compacted on read)"""
+    return compact_financials(pd.read_csv(get_financial_file(stock_code, financial_dir)))
+
+
+def join_financials_asof(price_df, financial_df, date_column, as_of='report_date'):
+    """
+    Attach to every price bar the latest reported quarter available on its date
+
+    as_of='report_date' matches a bar with the quarter whose period ended on
+    or before it (the valuation's historical behaviour); as_of='announce_date'
+    only uses quarters already published by then, for look-ahead-free backtests;
+    when several quarters are published on the same day the most recent period wins.
+    """
+    price_df = price_df.sort_values(date_column)
+    financial_df = financial_df.sort_values([as_of, 'report_date'])
+    right = financial_df.drop(columns=[column for column in ['report_date', 'announce_date'] if column != as_of])
+    right = right.rename(columns={as_of: '_as_of'})
+    return pd.merge_asof(price_df, right, left_on=date_column, right_on='_as_of',
+                         direction='backward').drop(columns='_as_of')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the stored financial files from the padded monthly grid to reported quarters")
+
+    args = parser.parse_args()
+
+    financial_files = [file for file in os.listdir(FINANCIAL_DIR) if file.endswith('.csv')]
+    rows_before = rows_after = 0
+    for financial_file in tqdm(financial_files, desc="Compacting financial files"):
+        financial_df = pd.read_csv(f"{FINANCIAL_DIR}/{financial_file}")
+        compact_df = compact_financials(financial_df)
+        rows_before += len(financial_df)
+        rows_after += len(compact_df)
+        save_financials(compact_df, f"{FINANCIAL_DIR}/{financial_file}")
+    print(f"Compacted {len(financial_files)} files from {rows_before} to {rows_after} rows.")
@@ -0,0 +1,266 @@
+import akshare as ak
+import pandas as pd
+import numpy as np
+import os
+import json
+import argparse
+from datetime import datetime
+from tqdm import tqdm
+
+from query_data_new import (get_stock_list, format_symbol, load_metadata, query_financial_data_incremental,
+                            STOCK_TYPE_MAPPING)
+from financial_store import load_financials
+from run_metrics import start_run, track_request
+
+PRICE_DIR = "../data/input/price-data/all"
+FINANCIAL_DIR = "../data/input/financial-indicators/all"
+
+# Trading calendar cache (sina), refreshed when it does not reach today
+CALENDAR_FILE = "../data/input/trade_calendar.csv"
+# Confirmed suspensions and the history of repairs
+GAP_LOG_FILE = "../data/input/gap_repairs.json"
+
+
+def load_gap_log():
+    """Load the confirmed suspensions and repair history"""
+    if os.path.exists(GAP_LOG_FILE):
+        with open(GAP_LOG_FILE, 'r') as f:
+            return json.load(f)
+    return {"suspensions": {}, "repairs": []}
+
+
+def save_gap_log(gap_log):
+    """Save the confirmed suspensions and repair history"""
+    os.makedirs(os.path.dirname(GAP_LOG_FILE), exist_ok=True)
+    tmp_file = f"{GAP_LOG_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(gap_log, f, indent=2)
+    os.replace(tmp_file, GAP_LOG_FILE)
+
+
+def get_trading_calendar(price_dates=None):
+    """
+    Get the trading days as a sorted datetime64[D] array
+
+    Uses the cached sina calendar, refreshing it when it ends before today.
+    Without network access, falls back to the union of the dates stored for
+    all stocks (a day on which no stock traded is not a trading day).
+    """
+    today = np.datetime64(datetime.now().strftime("%Y-%m-%d"))
+    if os.path.exists(CALENDAR_FILE):
+        calendar = pd.read_csv(CALENDAR_FILE)['trade_date'].to_numpy(dtype='datetime64[D]')
+        if len(calendar) and calendar[-1] >= today:
+            return calendar
+
+    try:
+        calendar_df = ak.tool_trade_date_hist_sina()
+        calendar_df.to_csv(CALENDAR_FILE, index=False)
+        return calendar_df['trade_date'].to_numpy(dtype='datetime64[D]')
+    except Exception as e:
+        if price_dates is None:
+            raise
+        print(f"Trading calendar unavailable ({e}), using the dates stored across all stocks.")
+        return np.unique(np.concatenate(list(price_dates.values())))
+
+
+def load_price_dates(stock_codes):
+    """
+    Load only the stored dates of each stock's price file
+    Returns: {code: sorted datetime64[D] array}
+    """
+    price_dates = {}
+    for stock_code in stock_codes:
+        price_file = f"{PRICE_DIR}/price_data_{stock_code}.csv"
+        if os.path.exists(price_file):
+            dates = pd.read_csv(price_file, usecols=['report_date'])['report_date']
+            price_dates[stock_code] = np.unique(dates.to_numpy(dtype='datetime64[D]'))
+    return price_dates
+
+
+def to_runs(days):
+    """Group a sorted array of trading days given as calendar positions into (first, last) runs"""
+    if len(days) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(days) != 1)
+    starts = np.r_[days[0], days[breaks + 1]]
+    ends = np.r_[days[breaks], days[-1]]
+    return list(zip(starts, ends))
+
+
+def scan_price_gaps(price_dates, calendar, metadata, suspensions):
+    """
+    Find the trading days missing from each stock's price history
+
+    Each stock's dates are located in the calendar with one searchsorted, so
+    the expected days are a contiguous index range from its first stored day
+    to its last update; whatever is not stored is missing. Days inside
+    confirmed suspensions are not gaps.
+    Returns: {code: [(start_date, end_date), ...]} of missing runs (as 'YYYY-MM-DD')
+    """
+    gaps = {}
+    for stock_code, dates in price_dates.items():
+        if len(dates) == 0:
+            continue
+        last_update = metadata.get("price", {}).get(stock_code)
+        end = np.datetime64(last_update) if last_update else dates[-1]
+        # The last update may precede the day's close: only expect days strictly before it
+        first_pos = np.searchsorted(calendar, dates[0])
+        last_pos = max(np.searchsorted(calendar, end) - 1, np.searchsorted(calendar, dates[-1]))
+
+        expected = np.zeros(last_pos - first_pos + 1, dtype=bool)
+        stored_pos = np.searchsorted(calendar, dates) - first_pos
+        stored_pos = stored_pos[(stored_pos >= 0) & (stored_pos < len(expected))]
+        expected[stored_pos] = True
+
+        for start, stop in suspensions.get(stock_code, []):
+            lo = np.searchsorted(calendar, np.datetime64(start)) - first_pos
+            hi = np.searchsorted(calendar, np.datetime64(stop), side='right') - first_pos
+            expected[max(lo, 0):max(hi, 0)] = True
+
+        missing = np.flatnonzero(~expected) + first_pos
+        if len(missing):
+            gaps[stock_code] = [(str(calendar[start]), str(calendar[stop])) for start, stop in to_runs(missing)]
+    return gaps
+
+
+def scan_financial_gaps(stock_codes):
+    """
+    Find quarter ends without indicators between a stock's first and last reported quarter
+    Returns: {code: ['YYYY-MM-DD', ...]}
+    """
+    gaps = {}
+    for stock_code in stock_codes:
+        financial_file = f"{FINANCIAL_DIR}/financial_indicators_{stock_code}.csv"
+        if not os.path.exists(financial_file):
+            continue
+        reported = load_financials(stock_code, FINANCIAL_DIR)['report_date']
+        if reported.empty:
+            continue
+        quarters = pd.date_range(reported.min(), reported.max(), freq='QE')
+        missing = quarters[~quarters.isin(reported)]
+        if len(missing):
+            gaps[stock_code] = missing.strftime('%Y-%m-%d').tolist()
+    return gaps
+
+
+def backfill_price_gaps(gaps, calendar):
+    """
+    Fetch only the missing intervals and insert them into the stored histories
+
+    All missing runs of a stock are covered by one ranged request (from the
+    trading day before its first gap to the one after its last), so each
+    stock is requested once however many holes it has. A missing trading day
+    is returned as a suspension only when the source has no row for it but
+    returned rows on both sides of it; an empty response, or days beyond the
+    returned rows, count as a failure to retry on the next run.
+    Returns: (filled rows per code, confirmed suspension runs per code, failed codes)
+    """
+    filled, suspended, failed = {}, {}, []
+
+    for stock_code, runs in tqdm(gaps.items(), desc="Backfilling price gaps"):
+        first_pos = max(np.searchsorted(calendar, np.datetime64(runs[0][0])) - 1, 0)
+        last_pos = min(np.searchsorted(calendar, np.datetime64(runs[-1][1])) + 1, len(calendar) - 1)
+        start_date, end_date = str(calendar[first_pos]), str(calendar[last_pos])
+        missing_days = np.concatenate([calendar[(calendar >= np.datetime64(start)) & (calendar <= np.datetime64(stop))]
+                                       for start, stop in runs])
+        try:
+            with track_request("stock_zh_a_daily"):
+                new_price_df = ak.stock_zh_a_daily(symbol=format_symbol(stock_code), start_date=start_date.replace('-', ''),
+                                                   end_date=end_date.replace('-', ''), adjust="")
+        except Exception as e:
+            failed.append(stock_code)
+            continue
+        # Nothing at all for the range is no evidence of a suspension (throttling, a transient error)
+        if new_price_df.empty:
+            failed.append(stock_code)
+            continue
+
+        new_price_df = new_price_df[['date', 'open', 'high', 'low', 'close']]
+        new_price_df.columns = ['report_date', 'open', 'high', 'low', 'close']
+        new_price_df['report_date'] = pd.to_datetime(new_price_df['report_date'])
+        returned = new_price_df['report_date'].to_numpy(dtype='datetime64[D]')
+        # The ranged request also covers stored days around and between the gaps: keep only the missing ones
+        new_price_df = new_price_df[np.isin(returned, missing_days)]
+
+        if len(new_price_df):
+            price_file = f"{PRICE_DIR}/price_data_{stock_code}.csv"
+            price_df = pd.read_csv(price_file, parse_dates=['report_date'])
+            price_df = pd.concat([price_df, new_price_df], ignore_index=True)
+            price_df = price_df.drop_duplicates('report_date', keep='first').sort_values('report_date')
+            price_df.to_csv(price_file, index=False)
+            filled[stock_code] = len(new_price_df)
+
+        still_missing = missing_days[~np.isin(missing_days, returned)]
+        bracketed = (still_missing > returned.min()) & (still_missing < returned.max())
+        if bracketed.any():
+            suspended[stock_code] = [(str(calendar[start]), str(calendar[stop]))
+                                     for start, stop in to_runs(np.searchsorted(calendar, still_missing[bracketed]))]
+        if not bracketed.all():
+            failed.append(stock_code)
+
+    return filled, suspended, failed
+
+
+def detect_and_backfill(stock_type="all", data_type="both", scan_only=False):
+    """
+    Scan the stored histories of a stock list for gaps and repair them
+
+    Price gaps are fetched as ranged requests and the days the source skips
+    between rows it returned are recorded as suspensions, so they are not
+    requested again; the rest is retried on the next run.
+    Financial gaps are refetched once per affected stock. Every run is
+    appended to the repair log.
+    """
+    stock_codes = get_stock_list(stock_type)['code'].tolist()
+    gap_log = load_gap_log()
+    repair = {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "stock_type": stock_type}
+
+    if data_type in ("price", "both"):
+        price_dates = load_price_dates(stock_codes)
+        calendar = get_trading_calendar(price_dates)
+        gaps = scan_price_gaps(price_dates, calendar, load_metadata(), gap_log["suspensions"])
+        missing_days = sum(int(np.searchsorted(calendar, np.datetime64(stop), side='right') -
+                               np.searchsorted(calendar, np.datetime64(start)))
+                           for runs in gaps.values() for start, stop in runs)
+        print(f"Price: {len(gaps)} of {len(price_dates)} stocks have gaps, {missing_days} trading days missing.")
+        for stock_code, runs in list(gaps.items())[:20]:
+            print(f"  {stock_code}: {runs}")
+
+        if gaps and not scan_only:
+            filled, suspended, failed = backfill_price_gaps(gaps, calendar)
+            for stock_code, runs in suspended.items():
+                gap_log["suspensions"].setdefault(stock_code, []).extend(runs)
+            print(f"Filled {sum(filled.values())} rows for {len(filled)} stocks, "
+                  f"confirmed {sum(len(runs) for runs in suspended.values())} suspensions, {len(failed)} stocks failed.")
+            repair["price"] = {"gaps": gaps, "filled": filled, "suspended": suspended, "failed": failed}
+
+    if data_type in ("financial", "both"):
+        gaps = scan_financial_gaps(stock_codes)
+        print(f"Financial: {len(gaps)} stocks have missing quarters.")
+        if gaps and not scan_only:
+            stocks_df = pd.DataFrame({'code': list(gaps)})
+            query_financial_data_incremental(stocks_df, FINANCIAL_DIR, force=True)
+            remaining = scan_financial_gaps(list(gaps))
+            print(f"Repaired {len(gaps) - len(remaining)} stocks; {len(remaining)} still miss quarters the source does not report.")
+            repair["financial"] = {"gaps": gaps, "unresolved": remaining}
+
+    if not scan_only:
+        gap_log["repairs"].append(repair)
+        save_gap_log(gap_log)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect holes in stored price and financial histories and backfill them")
+    parser.add_argument("--stock_type", type=str, default="all",
+                        choices=list(STOCK_TYPE_MAPPING),
+                        help="Stock list to scan (default: all)")
+    parser.add_argument("--data_type", type=str, default="both",
+                        choices=['price', 'financial', 'both'],
+                        help="Histories to scan (default: both)")
+    parser.add_argument("--scan_only", action="store_true",
+                        help="Only report the gaps, don't fetch anything")
+
+    args = parser.parse_args()
+
+    start_run("backfill")
+    detect_and_backfill(args.stock_type, args.data_type, args.scan_only)
@@ -0,0 +1,117 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from valuation_stream import scan_latest_values
+from run_metrics import timed
+
+# Industry of every listed stock (columns: code, industry), written by
+# query_data_new.py --data_type industry
+INDUSTRY_FILE = "../data/input/industry_classification.csv"
+
+RANK_METRICS = ['pe_ttm', 'pb_ttm', 'pr_ttm', 'roe_ttm']
+
+# Industries with fewer ranked stocks get no ranks: a percentile among three peers says little
+MIN_INDUSTRY_STOCKS = 5
+
+
+def get_rank_column(metric):
+    """Get the name of the industry-relative rank column of a metric"""
+    return f"{metric}_industry_pct"
+
+
+def load_industries(industry_file=INDUSTRY_FILE):
+    """
+    Load the industry classification
+    Returns: Series of the industry indexed by the zero-padded code, or None if it has not been fetched yet
+    """
+    if not os.path.exists(industry_file):
+        return None
+    industries = pd.read_csv(industry_file, dtype={'code': str})
+    industries['code'] = industries['code'].str.zfill(6)
+    return industries.drop_duplicates('code').set_index('code')['industry']
+
+
+def grouped_percentiles(groups, values):
+    """
+    Rank values within their groups: the share of the group's values that
+    are lower or equal (ties share the highest rank)
+
+    One sort by (group, value) orders every group at once; the rank of a
+    value is then the end of its run of equal values minus the start of its
+    group. Values with a negative group or NaN are left out and get NaN.
+    groups: int array of group ids
+    values: float array
+    Returns: float64 array of percentiles in (0, 1]
+    """
+    valid = np.flatnonzero((groups >= 0) & ~np.isnan(values))
+    percentiles = np.full(len(values), np.nan)
+    if len(valid) == 0:
+        return percentiles
+
+    order = valid[np.lexsort((values[valid], groups[valid]))]
+    sorted_groups = groups[order]
+    sorted_values = values[order]
+
+    new_group = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+    new_run = new_group | np.r_[True, sorted_values[1:] != sorted_values[:-1]]
+    positions = np.arange(len(order))
+    # start of each row's group, and end (exclusive) of each row's run of equal values
+    group_start = np.maximum.accumulate(np.where(new_group, positions, 0))
+    run_ends = np.r_[np.flatnonzero(new_run)[1:], len(order)]
+    run_end = run_ends[np.cumsum(new_run) - 1]
+    group_size = np.bincount(sorted_groups)[sorted_groups]
+
+    percentiles[order] = (run_end - group_start) / group_size
+    percentiles[order[group_size < MIN_INDUSTRY_STOCKS]] = np.nan
+    return percentiles
+
+
+def add_industry_ranks(stock_values, industries=None):
+    """
+    Add each stock's industry and its industry-relative rank of every metric
+
+    {metric}_industry_pct is the share of the industry's stocks whose metric
+    is lower or equal: low is cheap for pe/pb/pr, high is profitable for
+    roe. Like the screen's thresholds, the ranks are taken over the stocks
+    with a positive pe_ttm; the others get no rank.
+    industries: Series code -> industry (default: the stored classification)
+    Returns: stock_values with the industry and rank columns, unchanged if
+    there is no classification yet
+    """
+    industries = load_industries() if industries is None else industries
+    if industries is None:
+        return stock_values
+
+    stock_values = stock_values.copy()
+    stock_values['industry'] = stock_values['code'].astype(str).str.zfill(6).map(industries)
+    with timed("compute", kind="industry_rank"):
+        groups, _ = pd.factorize(stock_values['industry'])
+        groups = np.where(stock_values['pe_ttm'].to_numpy() > 0, groups, -1)
+        for metric in RANK_METRICS:
+            stock_values[get_rank_column(metric)] = grouped_percentiles(
+                groups, stock_values[metric].to_numpy(dtype=np.float64))
+    return stock_values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Industry-relative percentile ranks of the latest valuations")
+    parser.add_argument("--industry", type=str, default=None,
+                        help="Only show the stocks of this industry")
+    parser.add_argument("--max_rows", type=int, default=50,
+                        help="Rows printed (default: 50)")
+
+    args = parser.parse_args()
+
+    if load_industries() is None:
+        raise SystemExit("No industry classification found. Run 'python query_data_new.py --data_type industry' first.")
+    ranked = add_industry_ranks(scan_latest_values())
+    if args.industry:
+        ranked = ranked[ranked['industry'] == args.industry]
+    ranked = ranked.sort_values(['industry', get_rank_column('pr_ttm')])
+    columns = ['code', 'industry', 'report_date'] + RANK_METRICS + [get_rank_column(metric) for metric in RANK_METRICS]
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(ranked[columns].head(args.max_rows).to_string(index=False))
+    print(f"{len(ranked)} stocks in {ranked['industry'].nunique()} industries")
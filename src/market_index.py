@@ -0,0 +1,215 @@
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from market_panel import attach_panel, detach_panel, read_valuation_panel, get_valuation_mode
+from symbol_table import load_symbol_table, get_ids, is_member, get_sources_key
+from daily_valuation import to_days
+from run_metrics import timed, count
+
+# Cross-sectional quantiles of the valuation metrics per universe and month
+MARKET_INDEX_FILE = "../data/processed/stock-valuation/market_index.csv"
+# What the stored index was computed from, and a fingerprint of the history up to its last month;
+# a change rebuilds it instead of extending it
+MARKET_INDEX_META_FILE = "../data/processed/stock-valuation/market_index.json"
+MARKET_INDEX_IMAGE_DIR = "../img/market-index"
+
+# Universes of the index; 'all' is every valued stock, the others are universe expressions of symbol_table.py
+INDEX_UNIVERSES = ["all", "hs300", "zz500", "hongli"]
+
+INDEX_METRICS = ['pe_ttm', 'pb_ttm', 'pr_ttm', 'roe_ttm']
+
+INDEX_QUANTILES = {"q25": 0.25, "median": 0.5, "q75": 0.75}
+
+
+def compute_market_index(history, universes=INDEX_UNIVERSES, start_day=None):
+    """
+    Compute the quantiles of every metric across the stocks of each universe, per month
+
+    Like the screen's thresholds, the quantiles are taken over the stocks
+    with a positive pe_ttm. The rows of all universes are stacked and
+    reduced in one groupby over (universe, month).
+    history: the valuation panel layout {codes, offsets, date, <metric>...}
+    start_day: only compute the months from this day (int days since 1970-01-01) on
+    Returns: DataFrame with universe, report_date, stocks and {metric}_{q25,median,q75}
+    """
+    table = load_symbol_table()
+    counts = np.diff(history["offsets"])
+    row_ids = np.repeat(get_ids(history["codes"], table), counts)
+    rows = history["pe_ttm"] > 0
+    if start_day is not None:
+        rows &= history["date"] >= start_day
+
+    selected, labels = [], []
+    for universe in universes:
+        members = rows if universe == "all" else rows & is_member(row_ids, universe, table)
+        selected.append(np.flatnonzero(members))
+        labels.append(np.full(len(selected[-1]), universe, dtype=object))
+    selected = np.concatenate(selected)
+
+    stacked = pd.DataFrame({metric: history[metric][selected].astype(np.float64) for metric in INDEX_METRICS})
+    stacked['universe'] = np.concatenate(labels)
+    stacked['report_date'] = history["date"][selected]
+
+    with timed("compute", kind="market_index"):
+        grouped = stacked.groupby(['universe', 'report_date'], sort=False)
+        quantiles = grouped[INDEX_METRICS].quantile(list(INDEX_QUANTILES.values())).unstack()
+        names = {q: name for name, q in INDEX_QUANTILES.items()}
+        quantiles.columns = [f"{metric}_{names[q]}" for metric, q in quantiles.columns]
+        index = grouped.size().rename('stocks').to_frame().join(quantiles).reset_index()
+    count("rows_read_total", len(stacked), kind="market_index")
+
+    index['report_date'] = np.datetime_as_string(index['report_date'].to_numpy().astype('datetime64[D]'))
+    columns = ['universe', 'report_date', 'stocks'] + [f"{metric}_{name}" for metric in INDEX_METRICS
+                                                       for name in INDEX_QUANTILES]
+    return index[columns].sort_values(['universe', 'report_date'], ignore_index=True)
+
+
+def load_market_index(universe=None, index_file=MARKET_INDEX_FILE):
+    """
+    Load the market index, of one universe or all of them
+    Returns: DataFrame, or None if the index has not been built yet
+    """
+    if not os.path.exists(index_file):
+        return None
+    index = pd.read_csv(index_file)
+    return index if universe is None else index[index['universe'] == universe].reset_index(drop=True)
+
+
+def get_history_fingerprint(history, before_day):
+    """
+    Hash the rows of the valuation history dated before a day (int days since 1970-01-01)
+
+    Covers the stock, date and metrics of every row, so a restated
+    valuation of any stored month changes it, while rows of later months don't.
+    """
+    rows = history["date"] < before_day
+    stocks = np.repeat(np.arange(len(history["codes"]), dtype=np.int32), np.diff(history["offsets"]))
+    digest = hashlib.sha1(stocks[rows].tobytes())
+    digest.update(np.ascontiguousarray(history["date"][rows]).tobytes())
+    for metric in INDEX_METRICS:
+        digest.update(np.ascontiguousarray(history[metric][rows]).tobytes())
+    return digest.hexdigest()
+
+
+def update_market_index(universes=INDEX_UNIVERSES, rebuild=False):
+    """
+    Bring the market index up to date with the valuation history
+
+    Only the months from the last stored one on are read and recomputed (the
+    last month may have been partial), as long as the history before it is
+    unchanged: the stored fingerprint of those rows is checked against the
+    current history. The index is rebuilt when that fingerprint, the
+    universes, the stock lists, the set of valued stocks or the
+    --financial_date of the valuation changed since.
+    The histories come from the shared valuation panel when it is current.
+    Returns: the index DataFrame
+    """
+    panel = attach_panel("valuation")
+    history = panel if panel is not None else read_valuation_panel()
+    meta = {"universes": list(universes), "sources": get_sources_key(),
+            "codes": hashlib.sha1(np.ascontiguousarray(history["codes"]).tobytes()).hexdigest(),
+            "financial_date": get_valuation_mode()}
+
+    stored = None
+    if not rebuild and os.path.exists(MARKET_INDEX_META_FILE):
+        with open(MARKET_INDEX_META_FILE, 'r') as f:
+            stored_meta = json.load(f)
+        if {key: stored_meta.get(key) for key in meta} == meta and "through" in stored_meta \
+                and get_history_fingerprint(history, to_days([stored_meta["through"]])[0]) == stored_meta.get("fingerprint"):
+            stored = load_market_index()
+
+    if stored is None or stored.empty:
+        index = compute_market_index(history, universes)
+        print(f"Market index built: {index['report_date'].nunique()} months of {len(universes)} universes")
+    else:
+        last_month = stored['report_date'].max()
+        recent = compute_market_index(history, universes, start_day=to_days([last_month])[0])
+        index = pd.concat([stored[stored['report_date'] < last_month], recent], ignore_index=True) \
+            .sort_values(['universe', 'report_date'], ignore_index=True)
+        print(f"Market index updated: {recent['report_date'].nunique()} months from {last_month} recomputed")
+    if not index.empty:
+        meta["through"] = index['report_date'].max()
+        meta["fingerprint"] = get_history_fingerprint(history, to_days([meta["through"]])[0])
+    if panel is not None:
+        detach_panel(panel)
+
+    os.makedirs(os.path.dirname(MARKET_INDEX_FILE), exist_ok=True)
+    # about the precision of the float32 metrics
+    index.to_csv(MARKET_INDEX_FILE, index=False, float_format='%.6g')
+    with open(MARKET_INDEX_META_FILE, 'w') as f:
+        json.dump(meta, f)
+    return index
+
+
+def get_market_summary(index, universes=None):
+    """
+    Describe each universe's latest medians, with the share of past months
+    whose median was lower (where the market stands against its own history)
+    Returns: list of text lines
+    """
+    universes = index['universe'].unique() if universes is None else universes
+    lines = []
+    for universe in universes:
+        series = index[index['universe'] == universe]
+        if series.empty:
+            continue
+        latest = series.iloc[-1]
+        parts = []
+        for metric in INDEX_METRICS:
+            history_rank = (series[f"{metric}_median"] < latest[f"{metric}_median"]).mean()
+            parts.append(f"{metric.split('_')[0].upper()} {latest[f'{metric}_median']:.2f} "
+                         f"({latest[f'{metric}_q25']:.2f}-{latest[f'{metric}_q75']:.2f}, {history_rank:.0%} of history lower)")
+        lines.append(f"{universe} ({latest['report_date']}, {latest['stocks']} stocks): median " + ", ".join(parts))
+    return lines
+
+
+def plot_market_index(index, universes=INDEX_UNIVERSES, image_file=None):
+    """
+    Plot the median of every metric over time, one line per universe, with
+    the interquartile band of the first universe; save and return the image file
+    """
+    image_file = image_file if image_file else f"{MARKET_INDEX_IMAGE_DIR}/market_index.png"
+    os.makedirs(os.path.dirname(image_file), exist_ok=True)
+
+    fig, axes = plt.subplots(2, 2, figsize=(12, 6), sharex=True)
+    for ax, metric in zip(axes.flatten(), INDEX_METRICS):
+        for position, universe in enumerate(universes):
+            series = index[index['universe'] == universe]
+            dates = pd.to_datetime(series['report_date'])
+            ax.plot(dates, series[f"{metric}_median"], label=universe, linewidth=1.5 if position == 0 else 1)
+            if position == 0:
+                ax.fill_between(dates, series[f"{metric}_q25"], series[f"{metric}_q75"], alpha=0.2,
+                                label=f"{universe} 25th-75th percentile")
+        ax.set_title(f"{metric} median")
+    axes[0][0].legend(fontsize=8)
+
+    fig.suptitle(f"Market valuation by month, up to {index['report_date'].max()}", fontsize=10)
+    plt.tight_layout()
+    plt.savefig(image_file, dpi=300)
+    plt.close()
+    return image_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Market-wide quantiles of the valuation metrics per universe and month")
+    parser.add_argument("--universes", type=str, default=",".join(INDEX_UNIVERSES),
+                        help=f"Universes, comma-separated ('all' or symbol_table.py expressions, default: {','.join(INDEX_UNIVERSES)})")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Recompute every month instead of only the latest ones")
+    parser.add_argument("--no_plot", action="store_true",
+                        help="Skip the chart")
+
+    args = parser.parse_args()
+
+    universes = [universe.strip() for universe in args.universes.split(',')]
+    index = update_market_index(universes, args.rebuild)
+    for line in get_market_summary(index, universes):
+        print(line)
+    if not args.no_plot:
+        print(f"Chart saved to {plot_market_index(index, universes)}")
@@ -0,0 +1,391 @@
+import os
+import json
+import fcntl
+import hashlib
+import argparse
+from datetime import datetime
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from valuation_stream import iter_valuation_chunks, STREAM_COLUMNS, VALUATION_DIR
+from daily_valuation import PRICE_DIR, to_days
+
+# Descriptor registry of the published panels: for each panel its version, source and the
+# name, dtype and shape of every shared memory segment
+PANEL_REGISTRY_FILE = "../data/processed/market_panel.json"
+
+# Shared memory segments are named {SEGMENT_PREFIX}{hash}_{version} (in /dev/shm on Linux), see get_segment_name()
+SEGMENT_PREFIX = "sp"
+# Longest POSIX shared memory name on macOS (PSHMNAMLEN), the leading slash included
+MAX_SEGMENT_NAME = 31
+
+# A panel is current while its source is unchanged since it was published: the valuation panel
+# follows the marker written after every valuation run, the price panel the query metadata
+PANEL_SOURCES = {
+    "valuation": "../data/processed/stock-valuation/published.json",
+    "price": "../data/input/query_metadata.json",
+}
+
+# Per-row value columns of each panel (float32, or int32 for dates)
+PANEL_COLUMNS = {
+    "valuation": [column for column in STREAM_COLUMNS if column not in ('code', 'report_date')],
+    "price": ['open', 'high', 'low', 'close'],
+}
+
+
+def get_source_mtime(panel_name):
+    """Get the modification time of a panel's source marker, or None if it does not exist"""
+    source = PANEL_SOURCES[panel_name]
+    return os.path.getmtime(source) if os.path.exists(source) else None
+
+
+def get_valuation_mode():
+    """Get the --financial_date the valuation files were last computed with (see publish_valuations())"""
+    marker_file = PANEL_SOURCES["valuation"]
+    if not os.path.exists(marker_file):
+        return None
+    with open(marker_file, 'r') as f:
+        return json.load(f).get("financial_date", "report_date")
+
+
+def read_valuation_panel():
+    """
+    Read every stock's monthly valuation history into flat typed arrays
+    Returns: {codes, offsets, date, <column>...}, the rows of codes[i] at offsets[i]:offsets[i + 1]
+    """
+    numbers, dates, values = [], [], {column: [] for column in PANEL_COLUMNS["valuation"]}
+    for chunk in iter_valuation_chunks():
+        numbers.append(chunk['code'].to_numpy())
+        categories = chunk['report_date'].cat
+        dates.append(to_days(categories.categories)[categories.codes])
+        for column in values:
+            values[column].append(chunk[column].to_numpy())
+    if not numbers:
+        raise FileNotFoundError("No valuation data found. Please run calculation first.")
+
+    numbers = np.concatenate(numbers)
+    starts = np.flatnonzero(np.r_[True, numbers[1:] != numbers[:-1]])
+    arrays = {
+        "codes": np.char.zfill(numbers[starts].astype('U6'), 6),
+        "offsets": np.r_[starts, len(numbers)].astype(np.int64),
+        "date": np.concatenate(dates),
+    }
+    for column, parts in values.items():
+        arrays[column] = np.concatenate(parts)
+    return arrays
+
+
+def read_price_panel():
+    """
+    Read every stock's raw daily prices into flat typed arrays
+    Returns: {codes, offsets, date, open, high, low, close}
+    """
+    files = sorted(file for file in os.listdir(PRICE_DIR) if file.endswith('.csv'))
+    codes, counts, dates, values = [], [], [], {column: [] for column in PANEL_COLUMNS["price"]}
+    for file in tqdm(files, desc="Reading prices"):
+        price_df = pd.read_csv(os.path.join(PRICE_DIR, file), usecols=['report_date'] + PANEL_COLUMNS["price"],
+                               dtype={column: np.float32 for column in PANEL_COLUMNS["price"]})
+        if price_df.empty:
+            continue
+        days = to_days(price_df['report_date'])
+        order = np.argsort(days, kind='stable')
+        codes.append(file[11:17])
+        counts.append(len(days))
+        dates.append(days[order])
+        for column in values:
+            values[column].append(price_df[column].to_numpy()[order])
+    if not codes:
+        raise FileNotFoundError("No price data found. Please query prices first.")
+
+    arrays = {
+        "codes": np.array(codes, dtype='U6'),
+        "offsets": np.r_[0, np.cumsum(counts)].astype(np.int64),
+        "date": np.concatenate(dates),
+    }
+    for column, parts in values.items():
+        arrays[column] = np.concatenate(parts)
+    return arrays
+
+
+PANEL_READERS = {
+    "valuation": read_valuation_panel,
+    "price": read_price_panel,
+}
+
+
+def untrack(segment):
+    """
+    Keep the resource tracker from unlinking a segment when this process exits
+
+    Segments outlive the processes that publish or attach them; only
+    unpublish_panels() and later publishes unlink them.
+    """
+    resource_tracker.unregister(segment._name, "shared_memory")
+
+
+def load_registry():
+    """Load the panel registry, or an empty one"""
+    if os.path.exists(PANEL_REGISTRY_FILE):
+        with open(PANEL_REGISTRY_FILE, 'r') as f:
+            return json.load(f)
+    return {"version": 0, "panels": {}, "previous": {}}
+
+
+def save_registry(registry):
+    """Replace the panel registry atomically, so readers always see a complete one"""
+    tmp_file = f"{PANEL_REGISTRY_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(registry, f, indent=2)
+    os.replace(tmp_file, PANEL_REGISTRY_FILE)
+
+
+def unlink_segments(descriptor):
+    """Unlink the segments of a panel version; processes still attached keep their mapping"""
+    for segment in descriptor["segments"].values():
+        try:
+            shm = shared_memory.SharedMemory(name=segment["name"])
+        except FileNotFoundError:
+            continue
+        # unlink() also drops the segment from the resource tracker
+        shm.close()
+        shm.unlink()
+
+
+def get_segment_name(version, panel_name, key):
+    """
+    Get the shared memory segment name of one array of a panel version
+
+    The hash of the registry's absolute path, the panel and the array keeps
+    the segments of different data folders apart (each has its own versions)
+    and the name short enough for macOS.
+    """
+    digest = hashlib.sha1(f"{os.path.abspath(PANEL_REGISTRY_FILE)}:{panel_name}:{key}".encode()).hexdigest()[:10]
+    name = f"{SEGMENT_PREFIX}{digest}_{version}"
+    if len(name) + 1 > MAX_SEGMENT_NAME:
+        raise ValueError(f"Shared memory segment name too long: /{name}")
+    return name
+
+
+def publish_panels(panel_names=("valuation", "price")):
+    """
+    Publish panels into shared memory under a new version
+
+    Each array of a panel is copied into its own segment and described in the
+    registry. The previous version of each panel stays linked, so readers that
+    looked it up just before the publish can still attach it; the version
+    before that is unlinked. Readers attached to any older version keep
+    working on their mapping until they detach.
+    Returns: the new registry
+    """
+    os.makedirs(os.path.dirname(PANEL_REGISTRY_FILE), exist_ok=True)
+    with open(f"{PANEL_REGISTRY_FILE}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        registry = load_registry()
+        version = registry["version"] + 1
+
+        for panel_name in panel_names:
+            source_mtime = get_source_mtime(panel_name)
+            arrays = PANEL_READERS[panel_name]()
+            segments = {}
+            for key, array in arrays.items():
+                shm = shared_memory.SharedMemory(name=get_segment_name(version, panel_name, key), create=True,
+                                                 size=max(array.nbytes, 1))
+                untrack(shm)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+                segments[key] = {"name": shm.name, "dtype": array.dtype.str, "shape": list(array.shape)}
+                shm.close()
+
+            if panel_name in registry["previous"]:
+                unlink_segments(registry["previous"][panel_name])
+            if panel_name in registry["panels"]:
+                registry["previous"][panel_name] = registry["panels"][panel_name]
+            registry["panels"][panel_name] = {
+                "version": version,
+                "published_at": datetime.now().isoformat(timespec='seconds'),
+                "source_mtime": source_mtime,
+                "stocks": len(arrays["codes"]),
+                "rows": int(arrays["offsets"][-1]),
+                "segments": segments,
+            }
+            print(f"Published the {panel_name} panel v{version}: {len(arrays['codes'])} stocks, "
+                  f"{int(arrays['offsets'][-1])} rows, {sum(a.nbytes for a in arrays.values()) / 2**20:.0f} MB")
+
+        registry["version"] = version
+        save_registry(registry)
+    return registry
+
+
+def is_published(panel_name):
+    """Test whether a panel has been published (current or not)"""
+    return panel_name in load_registry()["panels"]
+
+
+def unpublish_panels():
+    """Unlink every published segment and remove the registry"""
+    registry = load_registry()
+    for descriptors in (registry["panels"], registry["previous"]):
+        for descriptor in descriptors.values():
+            unlink_segments(descriptor)
+    if os.path.exists(PANEL_REGISTRY_FILE):
+        os.remove(PANEL_REGISTRY_FILE)
+
+
+def attach_panel(panel_name, require_current=True, attempts=3):
+    """
+    Attach a published panel as read-only NumPy arrays over the shared memory (no copy)
+
+    With require_current, a panel whose source changed since it was published
+    is not returned, so callers fall back to reading the files. Keep the
+    returned panel as long as its arrays or frames are used, then detach it.
+    Returns: {name, version, codes, offsets, date, <column>..., segments}, or None if not published
+    """
+    for _ in range(attempts):
+        descriptor = load_registry()["panels"].get(panel_name)
+        if descriptor is None:
+            return None
+        if require_current and descriptor["source_mtime"] != get_source_mtime(panel_name):
+            return None
+
+        panel = {"name": panel_name, "version": descriptor["version"], "segments": []}
+        try:
+            for key, segment in descriptor["segments"].items():
+                shm = shared_memory.SharedMemory(name=segment["name"])
+                untrack(shm)
+                panel["segments"].append(shm)
+                array = np.ndarray(segment["shape"], dtype=np.dtype(segment["dtype"]), buffer=shm.buf)
+                array.flags.writeable = False
+                panel[key] = array
+        except FileNotFoundError:
+            # retired by a publish between reading the registry and attaching: look again
+            detach_panel(panel)
+            continue
+        return panel
+    return None
+
+
+def detach_panel(panel):
+    """
+    Release a panel's mappings
+
+    Arrays or frames of the panel still referenced elsewhere keep their
+    mapping alive until they are dropped.
+    """
+    keys = [key for key in panel if isinstance(panel[key], np.ndarray)]
+    for key in keys:
+        del panel[key]
+    for shm in panel["segments"]:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+    panel["segments"] = []
+
+
+def is_panel_current(panel):
+    """Test whether a panel is still the latest published version"""
+    descriptor = load_registry()["panels"].get(panel["name"])
+    return descriptor is not None and descriptor["version"] == panel["version"]
+
+
+def panel_to_frame(panel, start=0, end=None, code=None):
+    """
+    Build a DataFrame over rows start:end of a panel
+
+    The value columns are views of the shared memory; the code (categorical)
+    and report_date (datetime) columns are built for the rows.
+    """
+    end = panel["offsets"][-1] if end is None else end
+    if code is None:
+        positions = np.repeat(np.arange(len(panel["codes"])), np.diff(panel["offsets"]))[start:end]
+        codes = pd.Categorical.from_codes(positions, categories=panel["codes"])
+    else:
+        codes = pd.Categorical([code] * (end - start))
+    columns = {
+        'code': codes,
+        'report_date': panel["date"][start:end].astype('datetime64[D]').astype('datetime64[ns]'),
+    }
+    for column in PANEL_COLUMNS[panel["name"]]:
+        columns[column] = panel[column][start:end]
+    return pd.DataFrame(columns, copy=False)
+
+
+def get_stock_frame(panel, stock_code):
+    """Get one stock's rows of a panel as a DataFrame, or None if the stock is not in it"""
+    position = np.searchsorted(panel["codes"], stock_code)
+    if position == len(panel["codes"]) or panel["codes"][position] != stock_code:
+        return None
+    return panel_to_frame(panel, panel["offsets"][position], panel["offsets"][position + 1], stock_code)
+
+
+def load_panel_stock_valuation(stock_code):
+    """Load one stock's monthly valuation history from the shared panel, or None if there is no current panel"""
+    panel = attach_panel("valuation")
+    if panel is None:
+        return None
+    frame = get_stock_frame(panel, stock_code)
+    frame = None if frame is None else frame.copy()
+    detach_panel(panel)
+    return frame
+
+
+def load_panel_latest_values():
+    """
+    Load the latest monthly valuation of every stock from the shared panel,
+    together with the 25th and 75th percentiles of the stock's own pr_ttm history
+    Returns: DataFrame like valuation_stream.scan_latest_values(), or None if there is no current panel
+    """
+    panel = attach_panel("valuation")
+    if panel is None:
+        return None
+    counts = np.diff(panel["offsets"])
+    latest_rows = panel["offsets"][1:][counts > 0] - 1
+
+    latest = pd.DataFrame({'code': panel["codes"][counts > 0].astype(object),
+                           'report_date': np.datetime_as_string(panel["date"][latest_rows].astype('datetime64[D]'))})
+    for column in PANEL_COLUMNS["valuation"]:
+        latest[column] = panel[column][latest_rows]
+    pr_ttm = pd.Series(panel["pr_ttm"].astype(np.float64))
+    quantiles = pr_ttm.groupby(np.repeat(np.arange(len(counts)), counts)).quantile([0.25, 0.75]).unstack()
+    latest['pr_ttm_q25'] = quantiles[0.25].to_numpy()
+    latest['pr_ttm_q75'] = quantiles[0.75].to_numpy()
+    detach_panel(panel)
+    return latest
+
+
+def print_status():
+    """Print the published panels and whether they are current"""
+    registry = load_registry()
+    if not registry["panels"]:
+        print("No panels published.")
+    for panel_name, descriptor in registry["panels"].items():
+        current = descriptor["source_mtime"] == get_source_mtime(panel_name)
+        size = sum(np.dtype(s["dtype"]).itemsize * int(np.prod(s["shape"])) for s in descriptor["segments"].values())
+        print(f"{panel_name}: v{descriptor['version']} published {descriptor['published_at']}, "
+              f"{descriptor['stocks']} stocks, {descriptor['rows']} rows, {size / 2**20:.0f} MB, "
+              f"{'current' if current else 'stale (source changed since, republish)'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish the valuation and price panels into shared memory for other processes")
+    parser.add_argument("--publish", action="store_true",
+                        help="Publish the panels as a new version")
+    parser.add_argument("--panels", type=str, default="valuation,price",
+                        help="Panels to publish, comma-separated (default: valuation,price)")
+    parser.add_argument("--unpublish", action="store_true",
+                        help="Unlink all published segments and remove the registry")
+
+    args = parser.parse_args()
+
+    if args.unpublish:
+        unpublish_panels()
+        print("Unpublished all panels.")
+    elif args.publish:
+        panel_names = [name.strip() for name in args.panels.split(',')]
+        unknown = set(panel_names) - set(PANEL_READERS)
+        if unknown:
+            parser.error(f"Unknown panels: {sorted(unknown)}. Choose from {list(PANEL_READERS)}.")
+        publish_panels(panel_names)
+    print_status()
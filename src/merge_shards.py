@@ -0,0 +1,202 @@
+import os
+import re
+import shutil
+import argparse
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from query_data_new import (STAGING_DIR, STOCK_TYPE_MAPPING, get_stock_list, get_shard, load_metadata,
+                            save_metadata)
+from price_adjustment import ADJUST_FACTOR_DIR
+
+# Main store folders and the file prefix of each kind of staged data
+DATA_KINDS = {
+    "financial": ("financial-indicators/all", "../data/input/financial-indicators/all", "financial_indicators_"),
+    "price": ("price-data/all", "../data/input/price-data/all", "price_data_"),
+    "factor": ("price-data/adjust-factor", ADJUST_FACTOR_DIR, "adjust_factor_"),
+}
+
+
+def find_shard_dirs(staging_dir=STAGING_DIR):
+    """
+    Find the staging areas of all shards
+    Returns: list of (shard_index, shard_count, path), sorted
+    """
+    shards = []
+    if not os.path.isdir(staging_dir):
+        return shards
+    for name in os.listdir(staging_dir):
+        match = re.fullmatch(r"shard_(\d+)_of_(\d+)", name)
+        if match:
+            shards.append((int(match.group(1)), int(match.group(2)), os.path.join(staging_dir, name)))
+    return sorted(shards)
+
+
+def list_staged_files(shards, kind):
+    """
+    List the staged files of one kind by stock code
+    Returns: {code: [path, ...]} (more than one path means several shards staged the same stock)
+    """
+    folder, _, prefix = DATA_KINDS[kind]
+    staged = {}
+    for _, _, shard_dir in shards:
+        data_dir = os.path.join(shard_dir, folder)
+        if not os.path.isdir(data_dir):
+            continue
+        for file in sorted(os.listdir(data_dir)):
+            if file.startswith(prefix) and file.endswith('.csv'):
+                staged.setdefault(file[len(prefix):-len('.csv')], []).append(os.path.join(data_dir, file))
+    return staged
+
+
+def fold_series(main_file, staged_file, date_column):
+    """
+    Fold a staged time series into the main file
+
+    Staged rows replace the main rows from the first staged date on (the same
+    rule as the incremental price query). Overlapping dates whose values
+    differ are counted as revisions.
+    Returns: number of revised rows
+    """
+    staged_df = pd.read_csv(staged_file)
+    staged_df[date_column] = pd.to_datetime(staged_df[date_column])
+    if not os.path.exists(main_file) or staged_df.empty:
+        if not staged_df.empty:
+            staged_df.to_csv(main_file, index=False, date_format='%Y-%m-%d')
+        return 0
+
+    main_df = pd.read_csv(main_file)
+    main_df[date_column] = pd.to_datetime(main_df[date_column])
+
+    overlap = pd.merge(main_df, staged_df, on=date_column, suffixes=('_main', ''))
+    value_columns = [column for column in staged_df.columns if column != date_column and f"{column}_main" in overlap]
+    revised = 0
+    if value_columns and not overlap.empty:
+        main_values = overlap[[f"{column}_main" for column in value_columns]].to_numpy(dtype=float)
+        staged_values = overlap[value_columns].to_numpy(dtype=float)
+        revised = int((~np.isclose(main_values, staged_values, equal_nan=True)).any(axis=1).sum())
+
+    main_df = main_df[main_df[date_column] < staged_df[date_column].min()]
+    combined_df = pd.concat([main_df, staged_df], ignore_index=True).sort_values(date_column)
+    tmp_file = f"{main_file}.tmp"
+    combined_df.to_csv(tmp_file, index=False, date_format='%Y-%m-%d')
+    os.replace(tmp_file, main_file)
+    return revised
+
+
+def files_identical(paths):
+    """Check whether staged copies of the same stock from different shards have the same content"""
+    frames = [pd.read_csv(path) for path in paths]
+    return all(frame.equals(frames[0]) for frame in frames[1:])
+
+
+def merge_shards(shards, keep=False):
+    """
+    Fold the staged data files and metadata of the given shards into the main store
+
+    A stock staged by more than one shard (e.g. shards of different runs with
+    a different n) is a conflict unless all copies are identical; conflicting
+    stocks are left in staging and their metadata is not merged.
+    Returns: {'merged': {kind: count}, 'revised': {kind: count}, 'conflicts': [(kind, code, paths)]}
+    """
+    result = {"merged": {}, "revised": {}, "conflicts": []}
+    conflicted_codes = set()
+
+    for kind, (_, main_dir, prefix) in DATA_KINDS.items():
+        os.makedirs(main_dir, exist_ok=True)
+        merged = revised = 0
+        for code, paths in list_staged_files(shards, kind).items():
+            if len(paths) > 1 and not files_identical(paths):
+                result["conflicts"].append((kind, code, paths))
+                conflicted_codes.add(code)
+                continue
+
+            main_file = f"{main_dir}/{prefix}{code}.csv"
+            if kind == "financial":
+                # Financial files are rewritten in full by every query
+                shutil.copyfile(paths[0], f"{main_file}.tmp")
+                os.replace(f"{main_file}.tmp", main_file)
+            else:
+                revised += fold_series(main_file, paths[0], 'report_date' if kind == "price" else 'date')
+            merged += 1
+        result["merged"][kind] = merged
+        result["revised"][kind] = revised
+
+    # Metadata: the latest update time of each stock wins
+    main_metadata = load_metadata()
+    for data_type in ["financial", "price"]:
+        section = main_metadata.setdefault(data_type, {})
+        for _, _, shard_dir in shards:
+            shard_metadata = load_metadata(f"{shard_dir}/query_metadata.json")
+            for code, date in shard_metadata.get(data_type, {}).items():
+                if code not in conflicted_codes and date > section.get(code, ""):
+                    section[code] = date
+        save_metadata(main_metadata, data_type)
+
+    if not keep:
+        conflicted_paths = [path for _, _, paths in result["conflicts"] for path in paths]
+        for _, _, shard_dir in shards:
+            if not any(path.startswith(shard_dir) for path in conflicted_paths):
+                shutil.rmtree(shard_dir)
+
+    return result
+
+
+def report_coverage(stock_type, shards):
+    """
+    Report which stocks of a universe are up to date in the main store after the merge
+
+    Prices count as covered when updated today, financial data when updated
+    within 30 days (the refresh intervals of query_data_new.py). Missing
+    stocks are attributed to the shard they hash to, so a failed worker
+    shows up as one incomplete shard.
+    Returns: {data_type: list of missing codes}
+    """
+    codes = get_stock_list(stock_type)['code'].tolist()
+    metadata = load_metadata()
+    today = datetime.now()
+    shard_count = shards[0][1] if shards else None
+
+    missing = {}
+    for data_type, max_age in [("price", 0), ("financial", 29)]:
+        section = metadata.get(data_type, {})
+        missing[data_type] = [code for code in codes if code not in section or
+                              (today - datetime.strptime(section[code], "%Y-%m-%d")).days > max_age]
+        covered = len(codes) - len(missing[data_type])
+        print(f"{data_type}: {covered}/{len(codes)} stocks of {stock_type} up to date ({covered / max(len(codes), 1):.1%})")
+        if missing[data_type] and shard_count:
+            by_shard = pd.Series([get_shard(code, shard_count) for code in missing[data_type]]).value_counts().sort_index()
+            for shard_index, count in by_shard.items():
+                print(f"  shard {shard_index}/{shard_count}: {count} stocks missing")
+        if missing[data_type]:
+            print(f"  missing: {missing[data_type][:20]}{' ...' if len(missing[data_type]) > 20 else ''}")
+    return missing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the staging areas of sharded queries into the main data store")
+    parser.add_argument("--stock_type", type=str, default="all",
+                        choices=list(STOCK_TYPE_MAPPING),
+                        help="Stock list to report coverage for (default: all)")
+    parser.add_argument("--shard_count", type=int, default=None,
+                        help="Only merge the shards of a run with this many shards (default: every staged shard)")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the staging areas after merging")
+
+    args = parser.parse_args()
+
+    shards = find_shard_dirs()
+    if args.shard_count:
+        shards = [shard for shard in shards if shard[1] == args.shard_count]
+    print(f"Merging {len(shards)} shards: {[f'{index}/{count}' for index, count, _ in shards]}")
+
+    if shards:
+        result = merge_shards(shards, keep=args.keep)
+        for kind in DATA_KINDS:
+            print(f"{kind}: merged {result['merged'][kind]} stocks, {result['revised'][kind]} revised rows")
+        for kind, code, paths in result['conflicts']:
+            print(f"Conflict: {kind} data of {code} differs between {paths}, left in staging")
+
+    report_coverage(args.stock_type, shards)
@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from run_metrics import start_run, timed, count
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Pipeline state (input fingerprints of the last successful run of each stage)
+STATE_FILE = "../data/pipeline/state.json"
+LOG_DIR = "../data/pipeline/logs"
+
+STOCK_LIST_FILES = [
+    "../data/input/hongli_list_20251213.csv",
+    "../data/input/honglidibo_list_20251213.csv",
+    "../data/input/hs300_list_20251213.csv",
+    "../data/input/zz500_list_20251216.csv",
+]
+
+FINANCIAL_STOCK_TYPES = ["honglidibo", "hongli", "hs300", "zz500"]
+PRICE_STOCK_TYPES = ["honglidibo", "hongli", "hs300", "zz500", "portfolio"]
+
+
+def script(name):
+    """Command prefix to run one of the pipeline scripts with the current interpreter"""
+    return [sys.executable, os.path.join(SRC_DIR, name)]
+
+
+def build_stages(today, threshold=0.26, delta=False, granularity="monthly"):
+    """
+    Declare the pipeline stages
+
+    Each stage lists the stages it depends on, the files or folders it reads
+    (inputs) and writes (outputs), the parameters that change its result, and
+    the commands that produce it. A stage is skipped when the fingerprint of
+    its inputs and parameters is unchanged since its last successful run and
+    all of its outputs exist.
+
+    With delta=True, render and email only cover the stocks that changed
+    since the previous screen. With granularity='daily', the value stage also
+    updates the daily valuation archive and the screen runs on the latest
+    trading day.
+    """
+    filtered_file = f"../data/processed/stock-valuation/stocks_values_filtered_{today}.csv"
+    snapshot_file = f"../data/processed/stock-valuation/stocks_values_snapshot_{today}.csv"
+    delta_file = f"../data/processed/stock-valuation/stocks_values_delta_{today}.csv"
+    report_file = delta_file if delta else filtered_file
+    return {
+        "fetch_financial": {
+            "deps": [],
+            "inputs": STOCK_LIST_FILES,
+            "params": {"date": today},
+            "outputs": ["../data/input/financial-indicators/all"],
+            "commands": [script("query_data_new.py") + ["--data_type", "financial", "--stock_type", stock_type]
+                         for stock_type in FINANCIAL_STOCK_TYPES],
+        },
+        "fetch_price": {
+            "deps": [],
+            "inputs": STOCK_LIST_FILES,
+            "params": {"date": today},
+            "outputs": ["../data/input/price-data/all"],
+            "commands": [script("query_data_new.py") + ["--data_type", "price", "--stock_type", stock_type]
+                         for stock_type in PRICE_STOCK_TYPES],
+        },
+        "fetch_industry": {
+            "deps": [],
+            "inputs": [],
+            "params": {"date": today},
+            "outputs": ["../data/input/industry_classification.csv"],
+            "commands": [script("query_data_new.py") + ["--data_type", "industry", "--stock_type", "all"]],
+        },
+        "value": {
+            "deps": ["fetch_financial", "fetch_price"],
+            "inputs": ["../data/input/financial-indicators/all", "../data/input/price-data/all"],
+            "params": {"granularity": granularity},
+            "outputs": ["../data/processed/stock-valuation/all"]
+                       + (["../data/processed/stock-valuation/daily"] if granularity == "daily" else []),
+            "commands": [script("calculation_and_visualization_new.py") + ["--step", "value",
+                                                                            "--granularity", granularity]],
+        },
+        "index": {
+            "deps": ["value"],
+            "inputs": ["../data/processed/stock-valuation/all"],
+            "params": {},
+            "outputs": ["../data/processed/stock-valuation/market_index.csv", "../img/market-index"],
+            "commands": [script("market_index.py")],
+        },
+        "screen": {
+            "deps": ["value", "fetch_industry"],
+            "inputs": ["../data/processed/stock-valuation/all",
+                       "../data/input/industry_classification.csv"]
+                      + (["../data/processed/stock-valuation/daily"] if granularity == "daily" else []),
+            "params": {"date": today, "threshold": threshold, "granularity": granularity},
+            "outputs": [filtered_file, snapshot_file],
+            "commands": [script("calculation_and_visualization_new.py") + ["--step", "screen",
+                                                                            "--threshold", str(threshold),
+                                                                            "--granularity", granularity]],
+        },
+        "delta": {
+            "deps": ["screen"],
+            "inputs": [snapshot_file],
+            "params": {"date": today},
+            "outputs": [delta_file],
+            "commands": [script("screen_delta.py") + ["--date", today]],
+        },
+        "render": {
+            "deps": ["delta"],
+            "inputs": [report_file],
+            "params": {"date": today, "delta": delta},
+            "outputs": [f"../img/{today}"],
+            "commands": [script("calculation_and_visualization_new.py") + ["--step", "render"]
+                         + (["--changed_only"] if delta else [])],
+        },
+        "email": {
+            "deps": ["render", "index"],
+            "inputs": [report_file, f"../img/{today}", "../data/processed/stock-valuation/market_index.csv"],
+            "params": {"date": today, "delta": delta},
+            "outputs": [],
+            "commands": [script("send_emails_new.py") + ["--date", today] + (["--delta"] if delta else [])],
+        },
+    }
+
+
+def fingerprint(paths, params):
+    """
+    Fingerprint the inputs of a stage from file names, sizes and modification times
+
+    Folders are fingerprinted by their direct entries. Missing inputs are part
+    of the fingerprint too, so a stage reruns once they appear.
+    """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    for path in paths:
+        digest.update(path.encode())
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                stats = sorted((e.name, e.stat().st_size, e.stat().st_mtime_ns) for e in entries if e.is_file())
+            for name, size, mtime in stats:
+                digest.update(f"{name}:{size}:{mtime};".encode())
+        elif os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns};".encode())
+        else:
+            digest.update(b"<missing>;")
+    return digest.hexdigest()
+
+
+def load_state():
+    """Load the fingerprints recorded for each stage"""
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state):
+    """Save the fingerprints recorded for each stage"""
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    with open(STATE_FILE, 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def select_stages(stages, from_stage=None, only=None):
+    """
+    Return the stages to consider and the stages to force-run
+
+    - only: run exactly these stages, ignoring fingerprints
+    - from_stage: run this stage and everything downstream of it, ignoring fingerprints
+    - neither: consider every stage and skip the up-to-date ones
+    """
+    if only:
+        unknown = set(only) - set(stages)
+        if unknown:
+            raise ValueError(f"Unknown stages: {sorted(unknown)}. Choose from {list(stages)}.")
+        return list(only), set(only)
+
+    if from_stage:
+        if from_stage not in stages:
+            raise ValueError(f"Unknown stage: {from_stage}. Choose from {list(stages)}.")
+        selected = [from_stage]
+        for name, stage in stages.items():
+            if any(dep in selected for dep in stage['deps']) and name not in selected:
+                selected.append(name)
+        return selected, set(selected)
+
+    return list(stages), set()
+
+
+def run_stage(name, stage, today):
+    """
+    Run the commands of a stage one after another, logging their output
+    Returns: True if all commands succeeded
+    """
+    log_dir = f"{LOG_DIR}/{today}"
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = f"{log_dir}/{name}.log"
+
+    with open(log_file, 'w') as log:
+        for command in stage['commands']:
+            log.write(f"$ {' '.join(command)}\n")
+            log.flush()
+            with timed("run_stage", step=name):
+                result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+            if result.returncode != 0:
+                print(f"[{name}] failed (exit code {result.returncode}), see {log_file}")
+                return False
+    return True
+
+
+def run_pipeline(stages, today, from_stage=None, only=None, force=False, max_workers=2, dry_run=False):
+    """
+    Run the selected stages in dependency order
+
+    Stages whose dependencies are all satisfied run concurrently. Dependencies
+    that are not selected (e.g. upstream of --from) are treated as satisfied.
+    Returns: True if no stage failed
+    """
+    selected, forced = select_stages(stages, from_stage, only)
+    if force:
+        forced = set(selected)
+
+    state = load_state()
+    done = set(stages) - set(selected)
+    failed = set()
+    pending = list(selected)
+    running = {}
+
+    def is_up_to_date(name, current):
+        stage = stages[name]
+        return (name not in forced
+                and state.get(name, {}).get('fingerprint') == current
+                and all(os.path.exists(output) for output in stage['outputs']))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name in list(pending):
+                deps = stages[name]['deps']
+                if any(dep in failed for dep in deps):
+                    print(f"[{name}] blocked by failed dependency")
+                    pending.remove(name)
+                    failed.add(name)
+                    continue
+                if not all(dep in done for dep in deps):
+                    continue
+
+                pending.remove(name)
+                current = fingerprint(stages[name]['inputs'], stages[name]['params'])
+                if is_up_to_date(name, current):
+                    print(f"[{name}] up to date, skipped")
+                    count("stages_total", step=name, status="skipped")
+                    done.add(name)
+                    continue
+                if dry_run:
+                    print(f"[{name}] would run: " + "; ".join(" ".join(c[1:]) for c in stages[name]['commands']))
+                    done.add(name)
+                    continue
+
+                print(f"[{name}] running")
+                running[executor.submit(run_stage, name, stages[name], today)] = (name, current)
+
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, current = running.pop(future)
+                if future.result():
+                    print(f"[{name}] completed")
+                    count("stages_total", step=name, status="completed")
+                    state[name] = {"fingerprint": current, "completed_at": datetime.now().isoformat(timespec='seconds')}
+                    save_state(state)
+                    done.add(name)
+                else:
+                    count("stages_total", step=name, status="failed")
+                    failed.add(name)
+
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the incremental pipeline, skipping stages whose inputs haven't changed")
+    parser.add_argument("--from", dest="from_stage", type=str, default=None,
+                        help="Rerun this stage and every stage downstream of it")
+    parser.add_argument("--only", type=str, default=None,
+                        help="Rerun only these stages, comma-separated (e.g. 'screen,render')")
+    parser.add_argument("--force", action="store_true",
+                        help="Run every selected stage, ignoring fingerprints")
+    parser.add_argument("--threshold", type=float, default=0.26,
+                        help="The threshold value for filtering stocks")
+    parser.add_argument("--season_end", type=str, default=None,
+                        help="Deprecated and ignored: financial data is stored at its report dates")
+    parser.add_argument("--max_workers", type=int, default=2,
+                        help="Number of stages that may run at the same time")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Only print which stages would run")
+    parser.add_argument("--delta", action="store_true",
+                        help="Only render and email the stocks that changed since the previous screen")
+    parser.add_argument("--granularity", type=str, default="monthly",
+                        choices=['monthly', 'daily'],
+                        help="Screen on the latest monthly close (default) or on the latest trading day")
+
+    args = parser.parse_args()
+
+    today = datetime.now().strftime("%Y%m%d")
+    if not args.dry_run:
+        # the stage processes report into this run; the run report is written when the pipeline exits
+        start_run("pipeline")
+    stages = build_stages(today, threshold=args.threshold, delta=args.delta, granularity=args.granularity)
+    only = [name.strip() for name in args.only.split(',')] if args.only else None
+
+    ok = run_pipeline(stages, today, from_stage=args.from_stage, only=only, force=args.force,
+                      max_workers=args.max_workers, dry_run=args.dry_run)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,136 @@
+import akshare as ak
+import pandas as pd
+import os
+import argparse
+
+from run_metrics import track_request
+
+# Raw (unadjusted) daily prices written by query_data_new.py
+PRICE_DIR = "../data/input/price-data/all"
+# Backward adjustment (hfq) factor events per stock: the factor applies from its date on
+ADJUST_FACTOR_DIR = "../data/input/price-data/adjust-factor"
+# Cache of derived adjusted prices: price-data/qfq/, price-data/hfq/
+ADJUSTED_PRICE_DIR = "../data/input/price-data/{adjust}"
+
+
+def get_adjust_factor_file(stock_code, factor_dir=ADJUST_FACTOR_DIR):
+    """Get the path of the stored adjustment factors of a stock"""
+    return f"{factor_dir}/adjust_factor_{stock_code}.csv"
+
+
+def load_adjust_factor(stock_code, factor_dir=ADJUST_FACTOR_DIR):
+    """
+    Load the stored hfq factor events of a stock (columns: date, hfq_factor)
+    """
+    factor_df = pd.read_csv(get_adjust_factor_file(stock_code, factor_dir))
+    factor_df['date'] = pd.to_datetime(factor_df['date'])
+    return factor_df
+
+
+def query_adjust_factor_incremental(stock_code, symbol, factor_dir=ADJUST_FACTOR_DIR):
+    """
+    Fetch the hfq factor events of a stock and append the ones newer than the stored series
+
+    Backward (hfq) factors never change once published, a dividend or split
+    only adds a new event, so the stored series only grows. Forward (qfq)
+    prices are derived from it locally instead of being refetched.
+    Returns: number of new factor events
+    """
+    os.makedirs(factor_dir, exist_ok=True)
+
+    try:
+        with track_request("stock_zh_a_daily_hfq_factor", expected=ValueError):
+            new_factor_df = ak.stock_zh_a_daily(symbol=symbol, adjust="hfq-factor")
+    except ValueError:
+        # No dividend or split yet: adjusted prices equal the raw prices
+        new_factor_df = pd.DataFrame({'date': ['1990-01-01'], 'hfq_factor': [1.0]})
+    new_factor_df = new_factor_df[['date', 'hfq_factor']].copy()
+    new_factor_df['date'] = pd.to_datetime(new_factor_df['date'])
+    new_factor_df['hfq_factor'] = new_factor_df['hfq_factor'].astype(float)
+
+    factor_file = get_adjust_factor_file(stock_code, factor_dir)
+    if os.path.exists(factor_file):
+        factor_df = load_adjust_factor(stock_code, factor_dir)
+        new_factor_df = new_factor_df[new_factor_df['date'] > factor_df['date'].max()]
+        if new_factor_df.empty:
+            return 0
+        factor_df = pd.concat([factor_df, new_factor_df], ignore_index=True)
+    else:
+        factor_df = new_factor_df
+
+    factor_df = factor_df.sort_values('date').reset_index(drop=True)
+    factor_df.to_csv(factor_file, index=False, date_format='%Y-%m-%d')
+    return len(new_factor_df)
+
+
+def adjust_prices(price_df, factor_df, adjust):
+    """
+    Derive qfq or hfq prices from raw prices and hfq factor events
+
+    Every trading day takes the latest factor event on or before it (one
+    as-of join over the whole history). Days before the first event use the
+    first factor.
+        hfq = raw * factor
+        qfq = raw * factor / latest factor
+    """
+    if adjust not in ('qfq', 'hfq'):
+        raise ValueError(f"Unknown adjustment method: {adjust}. Use 'qfq' or 'hfq'.")
+
+    price_df = price_df.copy()
+    price_df['report_date'] = pd.to_datetime(price_df['report_date'])
+    factor_df = factor_df.sort_values('date')
+
+    factors = pd.merge_asof(price_df[['report_date']].sort_values('report_date'), factor_df,
+                            left_on='report_date', right_on='date', direction='backward')
+    factor = factors['hfq_factor'].fillna(factor_df['hfq_factor'].iloc[0]).to_numpy()
+    if adjust == 'qfq':
+        factor = factor / factor_df['hfq_factor'].iloc[-1]
+
+    price_df = price_df.sort_values('report_date').reset_index(drop=True)
+    for column in ['open', 'high', 'low', 'close']:
+        price_df[column] = (price_df[column] * factor).round(2)
+    return price_df
+
+
+def load_adjusted_price(stock_code, adjust=""):
+    """
+    Load the daily prices of a stock with the given adjustment ('', 'qfq' or 'hfq')
+
+    Adjusted prices are derived on demand and cached in price-data/{adjust}/;
+    the cache is rebuilt when the raw prices or the factors are newer.
+    """
+    price_file = f"{PRICE_DIR}/price_data_{stock_code}.csv"
+    if not adjust:
+        price_df = pd.read_csv(price_file)
+        price_df['report_date'] = pd.to_datetime(price_df['report_date'])
+        return price_df
+
+    factor_file = get_adjust_factor_file(stock_code)
+    cache_dir = ADJUSTED_PRICE_DIR.format(adjust=adjust)
+    cache_file = f"{cache_dir}/price_data_{stock_code}.csv"
+
+    if os.path.exists(cache_file) and \
+            os.path.getmtime(cache_file) >= max(os.path.getmtime(price_file), os.path.getmtime(factor_file)):
+        price_df = pd.read_csv(cache_file)
+        price_df['report_date'] = pd.to_datetime(price_df['report_date'])
+        return price_df
+
+    price_df = adjust_prices(pd.read_csv(price_file), load_adjust_factor(stock_code), adjust)
+    os.makedirs(cache_dir, exist_ok=True)
+    price_df.to_csv(cache_file, index=False, date_format='%Y-%m-%d')
+    return price_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Derive adjusted daily prices from raw prices and stored adjustment factors")
+    parser.add_argument("--stock_codes", type=str, required=True,
+                        help="Stock codes, comma-separated (e.g., '600519,000858')")
+    parser.add_argument("--adjust", type=str, required=True,
+                        choices=['qfq', 'hfq'],
+                        help="Price adjustment method: 'qfq' (forward) or 'hfq' (backward)")
+
+    args = parser.parse_args()
+
+    for stock_code in [code.strip().zfill(6) for code in args.stock_codes.split(',')]:
+        price_df = load_adjusted_price(stock_code, args.adjust)
+        print(f"{stock_code}: {len(price_df)} rows written to {ADJUSTED_PRICE_DIR.format(adjust=args.adjust)}")
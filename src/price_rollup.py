@@ -0,0 +1,135 @@
+import os
+import argparse
+
+import pandas as pd
+from tqdm import tqdm
+
+# Daily prices are in price-data/all; rollups in price-data/monthly and price-data/weekly
+PRICE_DATA_DIR = "../data/input/price-data"
+
+# Period key columns of each rollup
+ROLLUP_KEYS = {
+    "monthly": ['year', 'month'],
+    "weekly": ['week_end'],
+}
+
+
+def get_rollup_file(stock_code, freq="monthly", price_data_dir=PRICE_DATA_DIR):
+    """Get the path of a stock's monthly or weekly OHLC rollup"""
+    return f"{price_data_dir}/{freq}/price_{freq}_{stock_code}.csv"
+
+
+def get_maintained_freqs(price_data_dir=PRICE_DATA_DIR):
+    """
+    Get the rollups kept up to date at ingest time
+
+    The monthly rollup is always maintained; the weekly one once it has been
+    built (python price_rollup.py --freq weekly).
+    """
+    freqs = ["monthly"]
+    if os.path.isdir(f"{price_data_dir}/weekly"):
+        freqs.append("weekly")
+    return freqs
+
+
+def add_period_keys(price_df, freq):
+    """Add the period key columns of a rollup to daily prices"""
+    price_df = price_df.copy()
+    price_df['report_date'] = pd.to_datetime(price_df['report_date'])
+    if freq == "monthly":
+        price_df['year'] = price_df['report_date'].dt.year
+        price_df['month'] = price_df['report_date'].dt.month
+    else:
+        price_df['week_end'] = price_df['report_date'].dt.to_period('W-FRI').dt.end_time.dt.normalize()
+    return price_df
+
+
+def rollup_prices(price_df, freq="monthly"):
+    """
+    Aggregate daily prices into monthly or weekly OHLC bars
+    Returns: DataFrame with the period keys, open, close, high, low
+    """
+    keys = ROLLUP_KEYS[freq]
+    price_df = add_period_keys(price_df, freq)
+    return price_df.groupby(keys).agg({'open': 'first', 'close': 'last',
+                                       'high': 'max', 'low': 'min'}).reset_index()
+
+
+def save_rollup(rollup_df, rollup_file):
+    """Save a rollup atomically"""
+    os.makedirs(os.path.dirname(rollup_file), exist_ok=True)
+    tmp_file = f"{rollup_file}.tmp"
+    rollup_df.to_csv(tmp_file, index=False, date_format='%Y-%m-%d')
+    os.replace(tmp_file, rollup_file)
+
+
+def update_rollups(stock_code, price_df, first_new_date, price_data_dir=PRICE_DATA_DIR):
+    """
+    Update a stock's rollups after new daily bars were stored
+
+    Only the periods from the one containing first_new_date on are
+    recomputed (usually just the current month or week); older bars are
+    kept as they are. price_df holds the stock's daily prices after the update.
+    """
+    first_new_date = pd.Timestamp(first_new_date)
+    for freq in get_maintained_freqs(price_data_dir):
+        rollup_file = get_rollup_file(stock_code, freq, price_data_dir)
+        if not os.path.exists(rollup_file):
+            save_rollup(rollup_prices(price_df, freq), rollup_file)
+            continue
+
+        if freq == "monthly":
+            period_start = first_new_date.replace(day=1)
+        else:
+            period_start = first_new_date - pd.Timedelta(days=first_new_date.dayofweek)
+        recent = rollup_prices(price_df[pd.to_datetime(price_df['report_date']) >= period_start], freq)
+
+        rollup_df = load_rollup_file(rollup_file, freq)
+        if freq == "monthly":
+            keep = rollup_df['year'] * 12 + rollup_df['month'] < period_start.year * 12 + period_start.month
+        else:
+            keep = rollup_df['week_end'] < period_start
+        save_rollup(pd.concat([rollup_df[keep], recent], ignore_index=True), rollup_file)
+
+
+def load_rollup_file(rollup_file, freq):
+    """Read a rollup file"""
+    if freq == "weekly":
+        return pd.read_csv(rollup_file, parse_dates=['week_end'])
+    return pd.read_csv(rollup_file)
+
+
+def load_rollup(stock_code, freq="monthly", price_data_dir=PRICE_DATA_DIR):
+    """
+    Load a stock's monthly or weekly OHLC bars
+
+    Reads the rollup directly. When the daily file was changed by something
+    other than the incremental query (a gap backfill, a shard merge) or the
+    rollup does not exist yet, it is rebuilt from the daily prices first.
+    """
+    rollup_file = get_rollup_file(stock_code, freq, price_data_dir)
+    price_file = f"{price_data_dir}/all/price_data_{stock_code}.csv"
+
+    if os.path.exists(rollup_file) and \
+            (not os.path.exists(price_file) or os.path.getmtime(rollup_file) >= os.path.getmtime(price_file)):
+        return load_rollup_file(rollup_file, freq)
+
+    rollup_df = rollup_prices(pd.read_csv(price_file), freq)
+    save_rollup(rollup_df, rollup_file)
+    return rollup_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the monthly or weekly OHLC rollups of every stored daily price file")
+    parser.add_argument("--freq", type=str, default="monthly",
+                        choices=list(ROLLUP_KEYS),
+                        help="Rollup to build (default: monthly); once built, a weekly rollup is maintained at ingest")
+
+    args = parser.parse_args()
+
+    price_files = [file for file in os.listdir(f"{PRICE_DATA_DIR}/all") if file.endswith('.csv')]
+    for price_file in tqdm(price_files, desc=f"Building {args.freq} rollups"):
+        stock_code = price_file[11:17]
+        price_df = pd.read_csv(f"{PRICE_DATA_DIR}/all/{price_file}")
+        save_rollup(rollup_prices(price_df, args.freq), get_rollup_file(stock_code, args.freq))
+    print(f"Built {args.freq} rollups for {len(price_files)} stocks.")
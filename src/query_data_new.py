@@ -2,64 +2,120 @@ import akshare as ak
 import pandas as pd
 import numpy as np
 import os
+import time
 from datetime import datetime, timedelta
 from tqdm import tqdm
 import argparse
 import json
-
-STOCK_TYPE_MAPPING = {
-    "hongli": "../data/input/hongli_list_20251213.csv",
-    "honglidibo": "../data/input/honglidibo_list_20251213.csv",
-    "hs300": "../data/input/hs300_list_20251213.csv",
-    "zz500": "../data/input/zz500_list_20251216.csv",
-    "portfolio": ["600519", "000858", "600938", "000333", "600926", "300866", "600900", "601128"],
-    "all": "../data/input/stock_names_full.csv",
-}
+import fcntl
+import zlib
+
+from price_adjustment import query_adjust_factor_incremental, load_adjusted_price, get_adjust_factor_file, ADJUST_FACTOR_DIR
+from fetch_priority import get_priority_tiers, split_by_priority, publish_priority_complete
+from price_rollup import update_rollups
+from run_metrics import start_run, timed, track_request, count, observe, record_io
+from stage_profiler import add_profile_arguments, start_profiling
+from financial_store import compact_financials, save_financials
+from symbol_table import STOCK_TYPE_MAPPING, format_symbol, get_universe_codes
+from industry_rank import INDUSTRY_FILE
 
 # Metadata file to track last update times
 METADATA_FILE = "../data/input/query_metadata.json"
 
+# Staging areas of sharded queries, one folder per shard (see --shard and merge_shards.py)
+STAGING_DIR = "../data/staging"
+
 
-def load_metadata():
+def load_metadata(metadata_file=METADATA_FILE):
     """Load metadata containing last update times for each stock"""
-    if os.path.exists(METADATA_FILE):
-        with open(METADATA_FILE, 'r') as f:
+    if os.path.exists(metadata_file):
+        with open(metadata_file, 'r') as f:
             return json.load(f)
     return {"financial": {}, "price": {}}
 
 
-def save_metadata(metadata):
-    """Save metadata to file"""
-    os.makedirs(os.path.dirname(METADATA_FILE), exist_ok=True)
-    with open(METADATA_FILE, 'w') as f:
-        json.dump(metadata, f, indent=2)
+def save_metadata(metadata, data_type=None, metadata_file=METADATA_FILE):
+    """
+    Save metadata to file
+
+    When data_type is given, only that section is written back and the other
+    sections are re-read from disk, so price and financial queries running in
+    parallel do not overwrite each other's updates.
+    """
+    os.makedirs(os.path.dirname(metadata_file), exist_ok=True)
+    with open(f"{metadata_file}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if data_type:
+            merged = load_metadata(metadata_file)
+            merged[data_type] = metadata.get(data_type, {})
+            metadata = merged
+        tmp_file = f"{metadata_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(tmp_file, metadata_file)
 
 
 def get_stock_list(stock_type):
     """
     Get stock list based on the specified type
+
+    stock_type is a universe of STOCK_TYPE_MAPPING or an expression of them,
+    such as 'hs300&hongli' (see symbol_table.py).
     """
-    if stock_type == "zz500":
-        df = pd.read_csv(STOCK_TYPE_MAPPING[stock_type], sep='\t')
-    elif stock_type == "portfolio":
-        df = pd.DataFrame(STOCK_TYPE_MAPPING[stock_type], columns=['code'])
-    else:
-        df = pd.read_csv(STOCK_TYPE_MAPPING[stock_type])
+    return pd.DataFrame({'code': get_universe_codes(stock_type)})
 
-    df['code'] = df['code'].astype(str).str.zfill(6)
-    return df
+
+def parse_shard(shard):
+    """
+    Parse a shard specification 'i/n' (0 <= i < n)
+    Returns: (shard_index, shard_count)
+    """
+    try:
+        shard_index, shard_count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard: {shard}. Use 'i/n', e.g. '0/4'.")
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"Invalid shard: {shard}. The index must be between 0 and {shard_count - 1}.")
+    return shard_index, shard_count
 
 
-def format_symbol(code):
+def get_shard(stock_code, shard_count):
     """
-    Format stock symbol with proper prefix based on code
+    Get the shard a stock belongs to
+
+    Uses a stable hash (CRC32) of the code, so every worker and host assigns
+    the same stocks to the same shard regardless of list order or Python's
+    per-process hash seed.
     """
-    if code.startswith('6'):
-        return f'sh{code}'
-    elif code.startswith('9') or code.startswith('4'):
-        return f'bj{code}'
-    else:
-        return f'sz{code}'
+    return zlib.crc32(stock_code.encode()) % shard_count
+
+
+def filter_shard(stocks_df, shard_index, shard_count):
+    """Keep only the stocks of one shard"""
+    in_shard = stocks_df['code'].map(lambda code: get_shard(code, shard_count)) == shard_index
+    return stocks_df[in_shard].reset_index(drop=True)
+
+
+def get_shard_dir(shard_index, shard_count):
+    """Get the staging area of a shard"""
+    return f"{STAGING_DIR}/shard_{shard_index}_of_{shard_count}"
+
+
+def seed_shard_metadata(metadata_file, stock_codes):
+    """
+    Copy the last update times of the shard's stocks from the main metadata into the shard's metadata
+
+    This keeps sharded queries incremental: a shard only fetches what the main
+    store is missing, and its staging area only holds the new rows.
+    """
+    main_metadata = load_metadata()
+    shard_metadata = load_metadata(metadata_file)
+    for data_type in ["financial", "price"]:
+        section = shard_metadata.setdefault(data_type, {})
+        for stock_code in stock_codes:
+            if stock_code not in section and stock_code in main_metadata.get(data_type, {}):
+                section[stock_code] = main_metadata[data_type][stock_code]
+    save_metadata(shard_metadata, metadata_file=metadata_file)
 
 
 def get_last_update_date(metadata, data_type, stock_code):
@@ -107,13 +163,23 @@ def should_query_price(metadata, stock_code, force=False):
     return days_since_update >= 1, last_date_str
 
 
-def query_financial_data_incremental(stocks_df, output_dir, force=False, season_end='2025-12-31'):
+def observe_iteration(iteration_start, data_type):
+    """Record the duration of one pass of a retry loop"""
+    count("iterations_total", data=data_type)
+    observe("iteration_seconds", time.perf_counter() - iteration_start, data=data_type)
+
+
+def query_financial_data_incremental(stocks_df, output_dir, force=False, metadata_file=METADATA_FILE):
     """
     Query financial data incrementally - only update stocks that haven't been updated in 30+ days
+
+    Only the reported quarters are stored, with their announcement dates
+    (see financial_store.py); valuation joins them to the price bars as of
+    each bar's date, so no date range has to be configured.
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    metadata = load_metadata()
+    metadata = load_metadata(metadata_file)
     stock_codes = stocks_df['code'].tolist()
 
     # Determine which stocks need updating
@@ -137,11 +203,14 @@ def query_financial_data_incremental(stocks_df, output_dir, force=False, season_
         iteration += 1
         if iteration > 1:
             print(f"Retry iteration {iteration}/{max_iterations} for {len(stocks_to_update)} stocks...")
+            count("retries_total", len(stocks_to_update), data="financial")
+        iteration_start = time.perf_counter()
 
         for stock_code, last_date in tqdm(stocks_to_update.copy(), desc=f"Querying financial data (iter {iteration})"):
             try:
                 # Get the financial data
-                financial_df = ak.stock_financial_abstract_ths(symbol=f"{stock_code}", indicator="按单季度")
+                with track_request("stock_financial_abstract_ths"):
+                    financial_df = ak.stock_financial_abstract_ths(symbol=f"{stock_code}", indicator="按单季度")
 
                 # Select and process key indicators
                 financial_df = financial_df[['报告期', '每股净资产', '基本每股收益', '净资产收益率']]
@@ -159,13 +228,12 @@ def query_financial_data_incremental(stocks_df, output_dir, force=False, season_
                 financial_df['roe_ttm'] = financial_df['roe'].rolling(window=4).sum()
                 financial_df.dropna(inplace=True)
 
-                # Standardize report dates
-                date_df = pd.DataFrame(pd.date_range(start='2010-12-31', end=season_end, freq='ME'), columns=['report_date'])
-                financial_date = pd.merge(date_df, financial_df, on='report_date', how='left', validate="1:1")
-
-                # Save to file
+                # Save the reported quarters to file
                 output_file = f"{output_dir}/financial_indicators_{stock_code}.csv"
-                financial_date.to_csv(output_file, index=False)
+                with timed("csv_write", kind="financial"):
+                    financial_df = compact_financials(financial_df)
+                    save_financials(financial_df, output_file)
+                record_io("written", output_file, len(financial_df), "financial")
 
                 # Update metadata
                 metadata["financial"][stock_code] = datetime.now().strftime("%Y-%m-%d")
@@ -176,152 +244,344 @@ def query_financial_data_incremental(stocks_df, output_dir, force=False, season_
             except Exception as e:
                 continue  # Keep in list for retry
 
+        observe_iteration(iteration_start, "financial")
+
     # Save updated metadata
-    save_metadata(metadata)
+    save_metadata(metadata, "financial", metadata_file)
 
     if stocks_to_update:
         failed_codes = [stock[0] for stock in stocks_to_update]
+        count("failed_stocks_total", len(failed_codes), data="financial")
         print(f"Failed to query financial data for {len(failed_codes)} stocks after {iteration} iterations: {failed_codes}")
     else:
         print("Successfully queried financial data for all stocks needing update.")
 
 
-def query_price_data_incremental(stocks_df, output_dir, force=False, adjust=""):
+def query_industry_classification(force=False, source_file=None, industry_file=INDUSTRY_FILE,
+                                  metadata_file=METADATA_FILE):
+    """
+    Query the industry of every listed stock - the constituents of each industry board,
+    refreshing only the boards not updated in 30+ days
+
+    source_file: read the classification from a local CSV (columns: code, industry)
+    instead of akshare, a stand-in for offline runs and tests; the metadata is left untouched.
+    """
+    os.makedirs(os.path.dirname(industry_file), exist_ok=True)
+
+    if source_file:
+        industry_df = pd.read_csv(source_file, dtype={'code': str})[['code', 'industry']]
+        industry_df['code'] = industry_df['code'].str.zfill(6)
+        industry_df.sort_values('code').to_csv(industry_file, index=False)
+        print(f"Industry classification of {len(industry_df)} stocks read from {source_file}")
+        return
+
+    metadata = load_metadata(metadata_file)
+    metadata.setdefault("industry", {})
+    with track_request("stock_board_industry_name_em"):
+        boards = ak.stock_board_industry_name_em()['板块名称'].tolist()
+
+    # Boards are refreshed like financial data: once more than 30 days have passed
+    boards_to_update = []
+    for board in boards:
+        last_date_str = metadata["industry"].get(board)
+        if force or not last_date_str or (datetime.now() - datetime.strptime(last_date_str, "%Y-%m-%d")).days >= 30:
+            boards_to_update.append(board)
+
+    print(f"Total industry boards: {len(boards)}, Need to update: {len(boards_to_update)}")
+    if not boards_to_update:
+        print("Industry classification is up to date (within 30 days).")
+        return
+
+    if os.path.exists(industry_file):
+        industry_df = pd.read_csv(industry_file, dtype={'code': str})
+        # boards that no longer exist are dropped
+        industry_df = industry_df[industry_df['industry'].isin(boards)]
+    else:
+        industry_df = pd.DataFrame(columns=['code', 'industry'])
+
+    # Retry loop - up to 20 iterations for failed boards
+    max_iterations = 20
+    iteration = 0
+    fetched = []
+
+    while boards_to_update and iteration < max_iterations:
+        iteration += 1
+        if iteration > 1:
+            print(f"Retry iteration {iteration}/{max_iterations} for {len(boards_to_update)} boards...")
+            count("retries_total", len(boards_to_update), data="industry")
+        iteration_start = time.perf_counter()
+
+        for board in tqdm(boards_to_update.copy(), desc=f"Querying industry boards (iter {iteration})"):
+            try:
+                with track_request("stock_board_industry_cons_em"):
+                    members_df = ak.stock_board_industry_cons_em(symbol=board)
+                fetched.append(pd.DataFrame({'code': members_df['代码'].astype(str).str.zfill(6), 'industry': board}))
+                metadata["industry"][board] = datetime.now().strftime("%Y-%m-%d")
+                boards_to_update.remove(board)
+            except Exception as e:
+                continue  # Keep in list for retry
+
+        observe_iteration(iteration_start, "industry")
+
+    if fetched:
+        fetched = pd.concat(fetched, ignore_index=True)
+        industry_df = industry_df[~industry_df['industry'].isin(fetched['industry'])]
+        # a stock keeps the industry of its latest fetched board
+        industry_df = pd.concat([industry_df, fetched], ignore_index=True) \
+            .drop_duplicates('code', keep='last').sort_values('code')
+        industry_df.to_csv(industry_file, index=False)
+        record_io("written", industry_file, len(industry_df), "industry")
+
+    save_metadata(metadata, "industry", metadata_file)
+
+    if boards_to_update:
+        count("failed_boards_total", len(boards_to_update), data="industry")
+        print(f"Failed to query {len(boards_to_update)} industry boards after {iteration} iterations: {boards_to_update}")
+    else:
+        print(f"Successfully queried the industry classification: {industry_df['code'].nunique()} stocks "
+              f"in {industry_df['industry'].nunique()} industries.")
+
+
+def query_price_for_stock(stock_code, last_date, output_dir, today):
+    """
+    Fetch the raw (unadjusted) daily prices of one stock since last_date and append them to its file
+
+    The stock's monthly (and weekly, if built) rollups next to output_dir are
+    updated from the same data, recomputing only the periods with new bars.
+    """
+    symbol = format_symbol(stock_code)
+
+    # Determine start date for incremental query
+    if last_date:
+        # Incremental: start from day after last date
+        start_date = (datetime.strptime(last_date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y%m%d")
+    else:
+        # Full query: start from 2010
+        start_date = "20101231"
+
+    # Query new data
+    with track_request("stock_zh_a_daily"):
+        new_price_df = ak.stock_zh_a_daily(symbol=symbol, start_date=start_date, end_date=today, adjust="")
+    count("rows_fetched_total", len(new_price_df), data="price")
+
+    if new_price_df.empty:
+        # No new data
+        return
+
+    new_price_df = new_price_df[['date', 'open', 'high', 'low', 'close']]
+    new_price_df.columns = ['report_date', 'open', 'high', 'low', 'close']
+
+    # Check if existing data file exists
+    existing_file = f"{output_dir}/price_data_{stock_code}.csv"
+
+    if os.path.exists(existing_file) and last_date:
+        # Load existing data and append new data
+        with timed("csv_read", kind="price"):
+            existing_df = pd.read_csv(existing_file)
+        record_io("read", existing_file, len(existing_df), "price")
+        existing_df['report_date'] = pd.to_datetime(existing_df['report_date'])
+        new_price_df['report_date'] = pd.to_datetime(new_price_df['report_date'])
+
+        # Remove any overlapping dates from existing data (in case of corrections)
+        existing_df = existing_df[existing_df['report_date'] < new_price_df['report_date'].min()]
+
+        # Combine and save
+        combined_df = pd.concat([existing_df, new_price_df], ignore_index=True)
+        combined_df = combined_df.sort_values('report_date').reset_index(drop=True)
+        with timed("csv_write", kind="price"):
+            combined_df.to_csv(existing_file, index=False)
+    else:
+        # No existing data, save new data directly
+        with timed("csv_write", kind="price"):
+            new_price_df.to_csv(existing_file, index=False)
+        combined_df = new_price_df
+    record_io("written", existing_file, len(combined_df), "price")
+
+    with timed("rollup"):
+        update_rollups(stock_code, combined_df, pd.to_datetime(new_price_df['report_date']).min(),
+                       os.path.dirname(output_dir))
+
+
+def query_price_data_incremental(stocks_df, output_dir, force=False, adjust="", metadata_file=METADATA_FILE,
+                                 factor_dir=ADJUST_FACTOR_DIR, priority=False, threshold=0.26, stock_type=None):
     """
     Query price data incrementally - only fetch new data since last update
+
+    Raw prices are always stored. With adjust='qfq' or 'hfq', the stock's
+    adjustment factors are updated as well and the adjusted prices are
+    derived locally (see price_adjustment.py) instead of refetching the whole
+    adjusted history, which changes after every dividend. When the factors go
+    to a staging area, the adjusted prices are derived after the merge.
+
+    With priority=True, the portfolio, the last screen's members and the
+    stocks near its thresholds are fetched (and retried) first, and a
+    "priority set complete" marker is published before the rest is fetched
+    (see fetch_priority.py). The marker lists every priority stock of the
+    list, also those already up to date; stock_type names the list in it.
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    metadata = load_metadata()
+    metadata = load_metadata(metadata_file)
     stock_codes = stocks_df['code'].tolist()
 
     # Determine which stocks need updating
     stocks_to_update = []
     for stock_code in stock_codes:
         should_query, last_date = should_query_price(metadata, stock_code, force)
-        if should_query:
+        if should_query or (adjust and not os.path.exists(get_adjust_factor_file(stock_code))):
             stocks_to_update.append((stock_code, last_date))
 
     print(f"Total stocks: {len(stock_codes)}, Need to update: {len(stocks_to_update)}")
 
+    if priority:
+        tiers = get_priority_tiers(STOCK_TYPE_MAPPING["portfolio"], threshold)
+        priority_codes = [code for code in stock_codes if code in tiers]
+
     if not stocks_to_update:
         print("All price data is up to date (queried today).")
+        if priority:
+            publish_priority_complete(priority_codes, [], stock_type)
         return
 
     today = datetime.now().strftime("%Y%m%d")
 
-    # Retry loop - up to 20 iterations for failed stocks
-    max_iterations = 20
-    iteration = 0
-
-    while stocks_to_update and iteration < max_iterations:
-        iteration += 1
-        if iteration > 1:
-            print(f"Retry iteration {iteration}/{max_iterations} for {len(stocks_to_update)} stocks...")
-
-        for stock_code, last_date in tqdm(stocks_to_update.copy(), desc=f"Querying price data (iter {iteration})"):
-            symbol = format_symbol(stock_code)
-
-            try:
-                # Determine start date for incremental query
-                if last_date:
-                    # Incremental: start from day after last date
-                    start_date = (datetime.strptime(last_date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y%m%d")
-                else:
-                    # Full query: start from 2010
-                    start_date = "20101231"
-
-                # Query new data
-                new_price_df = ak.stock_zh_a_daily(symbol=symbol, start_date=start_date, end_date=today, adjust=adjust)
-
-                if new_price_df.empty:
-                    # No new data, just update metadata
+    groups = [("price data", stocks_to_update)]
+    if priority:
+        priority_stocks, remaining_stocks = split_by_priority(stocks_to_update, tiers)
+        print(f"Priority set: {len(priority_codes)} stocks, {len(priority_stocks)} to update, "
+              f"then {len(remaining_stocks)} more.")
+        groups = [("priority prices", priority_stocks), ("price data", remaining_stocks)]
+
+    failed_codes = []
+    for group_name, stocks_to_update in groups:
+        # Retry loop - up to 20 iterations for failed stocks
+        max_iterations = 20
+        iteration = 0
+
+        while stocks_to_update and iteration < max_iterations:
+            iteration += 1
+            if iteration > 1:
+                print(f"Retry iteration {iteration}/{max_iterations} for {len(stocks_to_update)} stocks...")
+                count("retries_total", len(stocks_to_update), data="price")
+            iteration_start = time.perf_counter()
+
+            for stock_code, last_date in tqdm(stocks_to_update.copy(), desc=f"Querying {group_name} (iter {iteration})"):
+                try:
+                    query_price_for_stock(stock_code, last_date, output_dir, today)
+
+                    if adjust:
+                        # Only new dividend/split events are appended; the adjusted cache is refreshed from them
+                        query_adjust_factor_incremental(stock_code, format_symbol(stock_code), factor_dir)
+                        if factor_dir == ADJUST_FACTOR_DIR:
+                            load_adjusted_price(stock_code, adjust)
+
+                    # Update metadata
                     metadata["price"][stock_code] = datetime.now().strftime("%Y-%m-%d")
-                    stocks_to_update.remove((stock_code, last_date))
-                    continue
-
-                new_price_df = new_price_df[['date', 'open', 'high', 'low', 'close']]
-                new_price_df.columns = ['report_date', 'open', 'high', 'low', 'close']
-
-                # Check if existing data file exists
-                existing_file = f"{output_dir}/price_data_{stock_code}.csv"
 
-                if os.path.exists(existing_file) and last_date:
-                    # Load existing data and append new data
-                    existing_df = pd.read_csv(existing_file)
-                    existing_df['report_date'] = pd.to_datetime(existing_df['report_date'])
-                    new_price_df['report_date'] = pd.to_datetime(new_price_df['report_date'])
-
-                    # Remove any overlapping dates from existing data (in case of corrections)
-                    existing_df = existing_df[existing_df['report_date'] < new_price_df['report_date'].min()]
+                    # Remove from retry list on success
+                    stocks_to_update.remove((stock_code, last_date))
 
-                    # Combine and save
-                    combined_df = pd.concat([existing_df, new_price_df], ignore_index=True)
-                    combined_df = combined_df.sort_values('report_date').reset_index(drop=True)
-                    combined_df.to_csv(existing_file, index=False)
-                else:
-                    # No existing data, save new data directly
-                    new_price_df.to_csv(existing_file, index=False)
+                except Exception as e:
+                    continue  # Keep in list for retry
 
-                # Update metadata
-                metadata["price"][stock_code] = datetime.now().strftime("%Y-%m-%d")
+            observe_iteration(iteration_start, "price")
 
-                # Remove from retry list on success
-                stocks_to_update.remove((stock_code, last_date))
+        failed_codes += [stock[0] for stock in stocks_to_update]
+        count("failed_stocks_total", len(stocks_to_update), data="price")
 
-            except Exception as e:
-                continue  # Keep in list for retry
+        if group_name == "priority prices":
+            save_metadata(metadata, "price", metadata_file)
+            publish_priority_complete(priority_codes, failed_codes, stock_type)
 
     # Save updated metadata
-    save_metadata(metadata)
+    save_metadata(metadata, "price", metadata_file)
 
-    if stocks_to_update:
-        failed_codes = [stock[0] for stock in stocks_to_update]
-        print(f"Failed to query price data for {len(failed_codes)} stocks after {iteration} iterations: {failed_codes}")
+    if failed_codes:
+        print(f"Failed to query price data for {len(failed_codes)} stocks: {failed_codes}")
     else:
         print("Successfully queried price data for all stocks needing update.")
 
 
-def query_data(data_type, stock_type, force=False, season_end="2025-12-31", adjust=""):
+def query_data(data_type, stock_type, force=False, adjust="", shard=None, priority=False, threshold=0.26,
+               industry_source=None):
     """
-    Main function to query either financial or price data incrementally
+    Main function to query financial, price or industry data incrementally
 
     Args:
-        data_type: 'financial' or 'price'
-        stock_type: Type of stocks to query
+        data_type: 'financial', 'price' or 'industry'
+        stock_type: Type of stocks to query (the industry classification always covers all listed stocks)
         force: If True, force query all stocks regardless of last update time
-        season_end: End date for financial data standardization
-        adjust: Price adjustment method ('qfq', 'hfq', or '')
+        adjust: Adjusted prices to derive locally besides the raw prices ('qfq', 'hfq', or '')
+        shard: Only query the stocks of shard 'i/n' and write them to the shard's staging area
+        priority: Fetch the portfolio and the stocks closest to the screen first (price data only)
+        threshold: The screen threshold used to find the stocks near the screen
+        industry_source: Local CSV (code, industry) to read the industry classification from instead of akshare
     """
+    if data_type.lower() == "industry":
+        query_industry_classification(force=force, source_file=industry_source)
+        return
+
     # Get the stock list
     stocks_df = get_stock_list(stock_type)
     print(f"Loaded {len(stocks_df)} stocks for {stock_type}")
 
+    data_dir = "../data/input"
+    metadata_file = METADATA_FILE
+    if shard:
+        shard_index, shard_count = parse_shard(shard)
+        stocks_df = filter_shard(stocks_df, shard_index, shard_count)
+        data_dir = get_shard_dir(shard_index, shard_count)
+        metadata_file = f"{data_dir}/query_metadata.json"
+        seed_shard_metadata(metadata_file, stocks_df['code'].tolist())
+        print(f"Shard {shard_index}/{shard_count}: {len(stocks_df)} stocks, staged in {data_dir}")
+
     if data_type.lower() == "financial":
-        output_dir = "../data/input/financial-indicators/all"
-        query_financial_data_incremental(stocks_df, output_dir, force=force, season_end=season_end)
+        output_dir = f"{data_dir}/financial-indicators/all"
+        query_financial_data_incremental(stocks_df, output_dir, force=force, metadata_file=metadata_file)
     elif data_type.lower() == "price":
-        output_dir = "../data/input/price-data/all"
-        query_price_data_incremental(stocks_df, output_dir, force=force, adjust=adjust)
+        output_dir = f"{data_dir}/price-data/all"
+        factor_dir = f"{data_dir}/price-data/adjust-factor" if shard else ADJUST_FACTOR_DIR
+        query_price_data_incremental(stocks_df, output_dir, force=force, adjust=adjust,
+                                     metadata_file=metadata_file, factor_dir=factor_dir,
+                                     priority=priority, threshold=threshold, stock_type=stock_type)
     else:
-        raise ValueError(f"Unknown data type: {data_type}. Use 'financial' or 'price'.")
+        raise ValueError(f"Unknown data type: {data_type}. Use 'financial', 'price' or 'industry'.")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Query financial or price data incrementally for specified stock lists")
     parser.add_argument("--data_type", type=str, required=True,
-                        choices=['financial', 'price'],
-                        help="Type of data to query: 'financial' or 'price'")
+                        choices=['financial', 'price', 'industry'],
+                        help="Type of data to query: 'financial', 'price' or 'industry' (the industry classification)")
     parser.add_argument("--stock_type", type=str, required=True,
                         choices=['hs300', 'zz500', 'hongli', 'honglidibo', 'portfolio', 'all'],
                         help="Type of stocks to query")
     parser.add_argument("--force", action="store_true",
                         help="Force query all stocks, ignoring last update time")
-    parser.add_argument("--season_end", type=str, default='2025-12-31',
-                        help="The end date of the season for financial data")
+    parser.add_argument("--season_end", type=str, default=None,
+                        help="Deprecated and ignored: financial data is stored at its report dates")
     parser.add_argument("--adjust", type=str, default="",
-                        help="Price adjustment method: 'qfq', 'hfq', or '' for none")
+                        choices=['', 'qfq', 'hfq'],
+                        help="Also derive adjusted prices from stored adjustment factors: 'qfq', 'hfq', or '' for none "
+                             "(raw prices are always stored)")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="Only query shard 'i/n' of the stock list (0 <= i < n) into its own staging area; "
+                             "fold the shards into the main store with merge_shards.py")
+
+    parser.add_argument("--priority", action="store_true",
+                        help="Fetch the portfolio, the last screen's members and the stocks near its thresholds first, "
+                             "and publish a marker once they are done (price data only)")
+    parser.add_argument("--threshold", type=float, default=0.26,
+                        help="The screen threshold used to find the stocks near the screen (with --priority)")
+    parser.add_argument("--industry_source", type=str, default=None,
+                        help="Read the industry classification from a local CSV (columns: code, industry) instead of "
+                             "akshare (industry data only)")
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
 
-    query_data(args.data_type, args.stock_type, args.force, args.season_end, args.adjust)
\ No newline at end of file
+    start_run(f"fetch_{args.data_type}")
+    if args.profile:
+        start_profiling(f"fetch_{args.data_type}", args.profile_memory, args.profile_top)
+    query_data(args.data_type, args.stock_type, args.force, args.adjust, args.shard, args.priority, args.threshold,
+               args.industry_source)
\ No newline at end of file
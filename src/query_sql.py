@@ -0,0 +1,93 @@
+import sys
+import time
+import argparse
+
+import pandas as pd
+
+from valuation_db import query_sql, sync_valuation_db, VALUATION_DB_FILE
+
+# Named queries for questions that used to need a notebook looping over the valuation files
+EXAMPLE_QUERIES = {
+    # stocks whose pr_ttm stayed below the median of its trailing 60 months in each of the last 6 months
+    "pr_below_5y_median": """
+        WITH recent AS (
+            SELECT code, report_date, pr_ttm,
+                   median(pr_ttm) OVER (PARTITION BY code ORDER BY report_date
+                                        ROWS BETWEEN 59 PRECEDING AND CURRENT ROW) AS pr_median_5y,
+                   ROW_NUMBER() OVER (PARTITION BY code ORDER BY report_date DESC) AS months_ago
+            FROM valuation
+            WHERE report_date >= (SELECT date(MAX(report_date), '-72 months') FROM valuation)
+        )
+        SELECT code, stocks.name, MAX(CASE WHEN months_ago = 1 THEN pr_ttm END) AS pr_ttm,
+               MAX(CASE WHEN months_ago = 1 THEN pr_median_5y END) AS pr_median_5y
+        FROM recent JOIN stocks USING (code)
+        WHERE months_ago <= 6
+        GROUP BY code
+        HAVING SUM(pr_ttm < pr_median_5y) = 6
+        ORDER BY pr_ttm / pr_median_5y
+    """,
+    # the latest month's cheapest profitable stocks by pr_ttm
+    "latest_lowest_pr": """
+        SELECT code, name, report_date, close, pe_ttm, pb_ttm, roe_ttm, pr_ttm
+        FROM latest_valuation JOIN stocks USING (code)
+        WHERE pr_ttm > 0
+        ORDER BY pr_ttm
+        LIMIT 20
+    """,
+    # months in which each stock's pe_ttm reached its lowest value
+    "pe_lows": """
+        SELECT code, name, report_date, MIN(pe_ttm) AS pe_ttm
+        FROM valuation JOIN stocks USING (code)
+        WHERE pe_ttm > 0
+        GROUP BY code
+        ORDER BY report_date DESC
+    """,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the valuation history with SQL")
+    parser.add_argument("sql", type=str, nargs='?', default=None,
+                        help="SQL query; tables: valuation, stocks, latest_valuation (view); median() is available")
+    parser.add_argument("--file", type=str, default=None,
+                        help="Read the query from a .sql file")
+    parser.add_argument("--example", type=str, default=None, choices=list(EXAMPLE_QUERIES),
+                        help="Run one of the named example queries")
+    parser.add_argument("--sync", action="store_true",
+                        help="Copy the valuation files changed since the last sync into the database first")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Rebuild the database from all valuation files first")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Also save the result as a CSV file")
+    parser.add_argument("--max_rows", type=int, default=50,
+                        help="Rows printed (default: 50)")
+
+    args = parser.parse_args()
+
+    if args.sync or args.rebuild:
+        sync_valuation_db(rebuild=args.rebuild)
+
+    if args.file:
+        with open(args.file, 'r') as f:
+            sql = f.read()
+    elif args.example:
+        sql = EXAMPLE_QUERIES[args.example]
+    else:
+        sql = args.sql
+    if sql is None:
+        if args.sync or args.rebuild:
+            sys.exit(0)
+        parser.error("give a query, --file or --example")
+
+    start = time.perf_counter()
+    result = query_sql(sql)
+    elapsed = time.perf_counter() - start
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(result.head(args.max_rows).to_string(index=False))
+    if len(result) > args.max_rows:
+        print(f"... {len(result) - args.max_rows} more rows")
+    print(f"{len(result)} rows in {elapsed * 1000:.0f} ms ({VALUATION_DB_FILE})")
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"Result saved to {args.output}")
@@ -4,17 +4,45 @@ import os
 import argparse
 from datetime import datetime
 
+from valuation_client import load_snapshot_from_server, load_history_from_server
+from valuation_stream import scan_latest_values, VALUATION_DIR
+from market_panel import load_panel_latest_values
+from symbol_table import get_name, get_universe_codes
+from valuation_compare import compare_stocks, export_comparison
+from daily_valuation import load_daily_stock_valuation, load_latest_daily_values
+from valuation_asof import load_as_of_values, load_as_of_history
+from stage_profiler import add_profile_arguments, start_profiling
+
 import matplotlib.pyplot as plt
 import seaborn as sns
 import matplotlib.font_manager as fm
 [f.name for f in fm.fontManager.ttflist if "PingFang" in f.name or "Heiti" in f.name]
 plt.rcParams['font.sans-serif'] = ['Heiti TC']
 
+# Above this many stocks, the comparison is plotted as distributions instead of one bar per stock
+MAX_BAR_STOCKS = 12
+
 
-def load_stock_valuation(stock_code):
+def load_stock_valuation(stock_code, granularity="monthly", as_of=None):
     """
-    Load stock valuation data for a specific stock
+    Load stock valuation data for a specific stock (from the valuation server when it is running)
+
+    granularity='daily' loads the stock's daily series from the daily valuation archive.
+    as_of ('YYYY-MM') gives the history up to the end of that month, valued
+    with the quarters announced by each bar (see valuation_asof.load_as_of_history()).
     """
+    if as_of:
+        df = load_as_of_history(stock_code, as_of, granularity)
+        if df.empty:
+            raise FileNotFoundError(f"Valuation data not found for stock {stock_code} as of {as_of}")
+        return df
+    if granularity == "daily":
+        return load_daily_stock_valuation(stock_code)
+
+    df = load_history_from_server(stock_code)
+    if df is not None:
+        return df
+
     valuation_file = f"../data/processed/stock-valuation/all/stock_valuation_{stock_code}.csv"
     
     if not os.path.exists(valuation_file):
@@ -25,22 +53,31 @@ def load_stock_valuation(stock_code):
     return df
 
 
-def load_all_stocks_valuation():
+def load_all_stocks_valuation(granularity="monthly", as_of=None):
     """
-    Load valuation data for all stocks to calculate quantiles
+    Load valuation data for all stocks (from the valuation server when it is running) to calculate quantiles
+
+    as_of ('YYYY-MM') loads every stock's valuation as of the end of that month instead of the latest.
     """
-    valuation_dir = "../data/processed/stock-valuation/all/"
-    
-    if not os.path.exists(valuation_dir):
+    if as_of:
+        return load_as_of_values(as_of, granularity)
+    if granularity == "daily":
+        return load_latest_daily_values()
+
+    all_stocks = load_snapshot_from_server()
+    if all_stocks is not None:
+        return all_stocks
+
+    # attach the shared market panel when one is published and current
+    all_stocks = load_panel_latest_values()
+    if all_stocks is not None:
+        return all_stocks
+
+    if not os.path.exists(VALUATION_DIR):
         raise FileNotFoundError("Valuation directory not found. Please run calculation first.")
-    
-    all_stocks = []
-    for file in os.listdir(valuation_dir):
-        if file.endswith('.csv'):
-            df = pd.read_csv(os.path.join(valuation_dir, file))
-            all_stocks.append(df.iloc[-1])  # Get the latest row for each stock
-    
-    return pd.DataFrame(all_stocks)
+
+    # latest row of every stock, streamed in typed chunks
+    return scan_latest_values()
 
 
 def calculate_quantiles(all_stocks_df, metric, value):
@@ -56,71 +93,23 @@ def calculate_quantiles(all_stocks_df, metric, value):
     return (valid_values <= value).mean()
 
 
-def get_stock_name(stock_code):
-    """
-    Get stock name from stock code
-    """
-    stock_code = str(stock_code).zfill(6)
-    stock_names_file = "../data/input/stock_names_full.csv"
-    if os.path.exists(stock_names_file):
-        stock_names = pd.read_csv(stock_names_file)
-        stock_name = stock_names[stock_names['code'].astype(str).str.zfill(6) == stock_code]['name'].values
-        return stock_name[0] if len(stock_name) > 0 else "Unknown"
-    return "Unknown"
-
-
-def print_comparison_table(stock_codes, all_stocks_df):
+def print_comparison_table(stock_codes, all_stocks_df, max_rows=50):
     """
-    Print a comparison table for multiple stocks
+    Print a comparison table for multiple stocks (any number, looked up in one pass)
+    Returns: the comparison DataFrame of valuation_compare.compare_stocks(), or None if no stock was found
     """
-    # Collect data for all stocks
-    stocks_data = []
-    
-    for stock_code in stock_codes:
-        try:
-            stock_df = load_stock_valuation(stock_code)
-            latest = stock_df.iloc[-1]
-            
-            # Calculate quantiles
-            pe_quantile = calculate_quantiles(all_stocks_df, 'pe_ttm', latest['pe_ttm'])
-            pb_quantile = calculate_quantiles(all_stocks_df, 'pb_ttm', latest['pb_ttm'])
-            pr_quantile = calculate_quantiles(all_stocks_df, 'pr_ttm', latest['pr_ttm'])
-            roe_quantile = calculate_quantiles(all_stocks_df, 'roe_ttm', latest['roe_ttm'])
-            
-            # Calculate target prices
-            pr_25 = stock_df['pr_ttm'].quantile(0.25)
-            pr_75 = stock_df['pr_ttm'].quantile(0.75)
-            current_pr = latest['pr_ttm']
-            
-            price_25th = latest['close'] * pr_25 / current_pr if current_pr > 0 else None
-            price_75th = latest['close'] * pr_75 / current_pr if current_pr > 0 else None
-            
-            stocks_data.append({
-                'code': stock_code,
-                'name': get_stock_name(stock_code),
-                'close': latest['close'],
-                'pe_ttm': latest['pe_ttm'],
-                'pe_quantile': pe_quantile,
-                'pb_ttm': latest['pb_ttm'],
-                'pb_quantile': pb_quantile,
-                'pr_ttm': latest['pr_ttm'],
-                'pr_quantile': pr_quantile,
-                'roe_ttm': latest['roe_ttm'],
-                'roe_quantile': roe_quantile,
-                'price_25th': price_25th,
-                'price_75th': price_75th
-            })
-        except FileNotFoundError as e:
-            print(f"Warning: {e}")
-            continue
+    stocks_data, missing = compare_stocks(stock_codes, all_stocks_df)
+    if missing:
+        print(f"Warning: Valuation data not found for {len(missing)} stocks: {missing[:20]}")
     
-    if not stocks_data:
+    if stocks_data.empty:
         print("No valid stock data found.")
-        return
+        return None
+    shown = stocks_data.head(max_rows)
     
     # Print comparison table
     print("\n" + "=" * 120)
-    print("  Stock Valuation Comparison")
+    print(f"  Stock Valuation Comparison ({len(stocks_data)} stocks)")
     print("=" * 120)
     
     # Header
@@ -128,7 +117,7 @@ def print_comparison_table(stock_codes, all_stocks_df):
     print("-" * 120)
     
     # Data rows
-    for stock in stocks_data:
+    for _, stock in shown.iterrows():
         print(f"  {stock['code']:<8} {stock['name']:<10} {stock['close']:>10.2f} "
               f"{stock['pe_ttm']:>10.2f} {stock['pe_quantile']*100:>7.1f}% "
               f"{stock['pb_ttm']:>10.2f} {stock['pb_quantile']*100:>7.1f}% "
@@ -143,8 +132,8 @@ def print_comparison_table(stock_codes, all_stocks_df):
     print(f"  {'Code':<8} {'Name':<10} {'Current':>12} {'Target (25th)':>15} {'Upside':>10} {'Target (75th)':>15} {'Upside':>10}")
     print("-" * 120)
     
-    for stock in stocks_data:
-        if stock['price_25th'] and stock['price_75th']:
+    for _, stock in shown.iterrows():
+        if pd.notna(stock['price_25th']) and pd.notna(stock['price_75th']):
             upside_25 = (stock['price_25th'] / stock['close'] - 1) * 100
             upside_75 = (stock['price_75th'] / stock['close'] - 1) * 100
             print(f"  {stock['code']:<8} {stock['name']:<10} {stock['close']:>12.2f} "
@@ -153,6 +142,8 @@ def print_comparison_table(stock_codes, all_stocks_df):
         else:
             print(f"  {stock['code']:<8} {stock['name']:<10} {stock['close']:>12.2f} {'N/A':>15} {'N/A':>10} {'N/A':>15} {'N/A':>10}")
     
+    if len(stocks_data) > max_rows:
+        print(f"  ... {len(stocks_data) - max_rows} more stocks (export them with --output)")
     print("=" * 120 + "\n")
     
     return stocks_data
@@ -163,7 +154,7 @@ def print_stock_info(stock_code, stock_df, all_stocks_df):
     Print stock information in a nice layout
     """
     # Get stock name
-    stock_name = get_stock_name(stock_code)
+    stock_name = get_name(stock_code)
     
     # Get latest data
     latest = stock_df.iloc[-1]
@@ -192,17 +183,18 @@ def print_stock_info(stock_code, stock_df, all_stocks_df):
     print(f"  {'ROE-TTM':<15} {latest['roe_ttm']:>12.2f} {roe_quantile*100:>11.1f}%  {'Higher is better' if roe_quantile > 0.5 else 'Lower than median':>25}")
     print("-" * 80)
     
-    # Print last 24 report dates
-    print(f"\n  Last 24 Report Dates:")
+    # Print last 24 report dates (trading days of a daily series, with its TTM fundamentals)
+    fields = ['eps', 'bps', 'roe'] if 'eps' in stock_df.columns else ['eps_ttm', 'bps_ttm', 'roe_ttm']
+    print(f"\n  Last 24 {'Report Dates' if fields[0] == 'eps' else 'Trading Days'}:")
     print("-" * 80)
     
-    last_24 = stock_df.tail(24)[['report_date', 'eps', 'bps', 'roe']].copy()
+    last_24 = stock_df.tail(24)[['report_date'] + fields].copy()
     last_24['report_date'] = last_24['report_date'].dt.strftime('%Y-%m-%d')
     
-    print(f"  {'Report Date':<15} {'EPS':>12} {'BPS':>12} {'ROE':>12}")
+    print(f"  {'Report Date':<15} {fields[0].upper():>12} {fields[1].upper():>12} {fields[2].upper():>12}")
     print("-" * 80)
     for _, row in last_24.iterrows():
-        print(f"  {row['report_date']:<15} {row['eps']:>12.2f} {row['bps']:>12.2f} {row['roe']:>12.2f}")
+        print(f"  {row['report_date']:<15} {row[fields[0]]:>12.2f} {row[fields[1]]:>12.2f} {row[fields[2]]:>12.2f}")
     print("-" * 80)
     
     # Print price info
@@ -267,21 +259,25 @@ def plot_distributions(stock_code, stock_df):
         
         axes[i].legend(fontsize=8)
     
-    stock_name = get_stock_name(stock_code)
+    stock_name = get_name(stock_code)
     
     fig.suptitle(f"{stock_code} - {stock_name} | Historical Valuation Distribution", fontsize=14, fontweight='bold')
     plt.tight_layout()
     plt.show()
 
 
-def plot_comparison(stock_codes, stocks_data):
+def plot_comparison(stocks_data, all_stocks_df):
     """
     Plot comparison charts for multiple stocks
+
+    Up to MAX_BAR_STOCKS stocks get one bar each, sorted per metric, with one
+    colour per stock across the charts. Larger lists are plotted as the
+    distribution of the selected stocks against the whole market.
     """
-    if not stocks_data or len(stocks_data) < 2:
+    if stocks_data is None or len(stocks_data) < 2:
         return
     
-    # Create comparison bar chart
+    # Create comparison chart
     fig, axes = plt.subplots(2, 2, figsize=(14, 10))
     axes = axes.flatten()
     
@@ -292,65 +288,103 @@ def plot_comparison(stock_codes, stocks_data):
         ('roe_ttm', 'ROE-TTM', 'higher')
     ]
     
-    codes = [s['code'] for s in stocks_data]
-    names = [s['name'][:6] for s in stocks_data]  # Truncate long names
-    labels = [f"{c}\n{n}" for c, n in zip(codes, names)]
-    
-    colors = ['#eeb908', '#4CAF50', '#2196F3', '#FF5722', '#9C27B0', '#00BCD4']
-    
-    for i, (metric, title, better) in enumerate(metrics):
-        values = [s[metric] for s in stocks_data]
-        
-        # Sort by value
-        sorted_indices = np.argsort(values)
-        if better == 'higher':
-            sorted_indices = sorted_indices[::-1]
-        
-        sorted_labels = [labels[j] for j in sorted_indices]
-        sorted_values = [values[j] for j in sorted_indices]
-        sorted_colors = [colors[j % len(colors)] for j in range(len(sorted_indices))]
+    if len(stocks_data) <= MAX_BAR_STOCKS:
+        labels = [f"{code}\n{str(name)[:6]}" for code, name in zip(stocks_data['code'], stocks_data['name'])]  # Truncate long names
+        colors = plt.get_cmap('tab20')(np.linspace(0, 1, 20))[:len(stocks_data)]
         
-        bars = axes[i].bar(sorted_labels, sorted_values, color=sorted_colors)
-        axes[i].set_title(f'{title} Comparison ({better} is better)', fontsize=12)
-        axes[i].set_ylabel(title, fontsize=10)
-        
-        # Add value labels on bars
-        for bar, val in zip(bars, sorted_values):
-            axes[i].text(bar.get_x() + bar.get_width()/2, bar.get_height() + 0.5,
-                        f'{val:.2f}', ha='center', va='bottom', fontsize=9)
+        for i, (metric, title, better) in enumerate(metrics):
+            values = stocks_data[metric].to_numpy(dtype=np.float64)
+            
+            # Sort by value, best first; stocks without a value last
+            sorted_indices = np.argsort(-values if better == 'higher' else values, kind='stable')
+            
+            bars = axes[i].bar([labels[j] for j in sorted_indices], values[sorted_indices], color=colors[sorted_indices])
+            axes[i].set_title(f'{title} Comparison ({better} is better)', fontsize=12)
+            axes[i].set_ylabel(title, fontsize=10)
+            axes[i].tick_params(axis='x', labelsize=8)
+            
+            # Add value labels on bars
+            axes[i].bar_label(bars, fmt='%.2f', fontsize=9)
+        fig.suptitle("Stock Valuation Comparison", fontsize=14, fontweight='bold')
+    else:
+        for i, (metric, title, better) in enumerate(metrics):
+            market = all_stocks_df[metric].dropna()
+            market = market[market > 0]
+            selected = stocks_data[metric].dropna()
+            selected = selected[selected > 0]
+            if len(market) == 0 or len(selected) == 0:
+                axes[i].text(0.5, 0.5, 'No valid data', ha='center', va='center', transform=axes[i].transAxes)
+                continue
+            
+            # Leave out the far tail of the market so the bulk stays readable
+            upper = market.quantile(0.98)
+            bins = np.linspace(0, upper, 50)
+            axes[i].hist(market.clip(upper=upper), bins=bins, density=True, color='grey', alpha=0.4,
+                         label=f'All stocks ({len(market)})')
+            axes[i].hist(selected.clip(upper=upper), bins=bins, density=True, color="#eeb908", alpha=0.7,
+                         label=f'Selected ({len(selected)})')
+            axes[i].axvline(x=market.median(), color='grey', linestyle='--', label=f'Market median: {market.median():.2f}')
+            axes[i].axvline(x=selected.median(), color='red', linestyle='--', label=f'Selected median: {selected.median():.2f}')
+            axes[i].set_title(f'{title} Distribution ({better} is better)', fontsize=12)
+            axes[i].set_xlabel(title, fontsize=10)
+            axes[i].set_ylabel('Density', fontsize=10)
+            axes[i].legend(fontsize=8)
+        fig.suptitle(f"Stock Valuation Comparison: {len(stocks_data)} stocks against the market",
+                     fontsize=14, fontweight='bold')
     
-    fig.suptitle("Stock Valuation Comparison", fontsize=14, fontweight='bold')
     plt.tight_layout()
     plt.show()
 
 
 def main():
     parser = argparse.ArgumentParser(description="Query and visualize stock valuation data")
-    parser.add_argument("--stock_codes", type=str, required=True,
+    parser.add_argument("--stock_codes", type=str, default=None,
                         help="Stock codes to query, comma-separated (e.g., '600519,000858,600036')")
+    parser.add_argument("--universe", type=str, default=None,
+                        help="Compare all members of a universe instead, e.g. 'hs300' or 'hs300&hongli' (see symbol_table.py)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Also export the comparison to a .csv, .parquet or .json file")
+    parser.add_argument("--max_rows", type=int, default=50,
+                        help="Stocks printed in the comparison table (default: 50)")
     parser.add_argument("--no_plot", action="store_true",
                         help="Skip plotting distribution charts")
+    parser.add_argument("--granularity", type=str, default="monthly",
+                        choices=['monthly', 'daily'],
+                        help="Use the monthly valuation (default) or the daily series (run daily_valuation.py first)")
+    parser.add_argument("--as_of", type=str, default=None,
+                        help="Show the valuations and percentiles as of the end of a past month, YYYY-MM (default: latest)")
+    add_profile_arguments(parser)
     
     args = parser.parse_args()
-    
-    # Parse stock codes
-    stock_codes = [code.strip().zfill(6) for code in args.stock_codes.split(',')]
+    if not args.stock_codes and not args.universe:
+        parser.error("give --stock_codes or --universe")
+    if args.profile:
+        start_profiling("query_stock_valuation", args.profile_memory, args.profile_top)
     
     try:
+        # Parse stock codes
+        if args.universe:
+            stock_codes = get_universe_codes(args.universe)
+        else:
+            stock_codes = [code.strip().zfill(6) for code in args.stock_codes.split(',')]
+        
         # Load all stocks data for quantile calculation
-        all_stocks_df = load_all_stocks_valuation()
+        all_stocks_df = load_all_stocks_valuation(args.granularity, args.as_of)
         
-        # Print comparison table if multiple stocks
-        if len(stock_codes) > 1:
-            stocks_data = print_comparison_table(stock_codes, all_stocks_df)
+        # Print comparison table if multiple stocks (or exporting)
+        if len(stock_codes) > 1 or args.output:
+            stocks_data = print_comparison_table(stock_codes, all_stocks_df, args.max_rows)
+            
+            if args.output and stocks_data is not None:
+                print(f"Comparison of {len(stocks_data)} stocks exported to {export_comparison(stocks_data, args.output)}")
             
             # Plot comparison charts
-            if not args.no_plot and stocks_data:
-                plot_comparison(stock_codes, stocks_data)
+            if not args.no_plot:
+                plot_comparison(stocks_data, all_stocks_df)
         else:
             # Single stock - print detailed info
             stock_code = stock_codes[0]
-            stock_df = load_stock_valuation(stock_code)
+            stock_df = load_stock_valuation(stock_code, args.granularity, args.as_of)
             print_stock_info(stock_code, stock_df, all_stocks_df)
             
             # Plot distributions
@@ -3,44 +3,53 @@ import numpy as np
 import os
 import argparse
 
+from valuation_client import load_snapshot_from_server
+from valuation_stream import scan_latest_values, VALUATION_DIR
+from market_panel import load_panel_latest_values
+from symbol_table import get_ids, get_names
+from daily_valuation import load_latest_daily_values
+from valuation_asof import load_as_of_values
+from industry_rank import add_industry_ranks, get_rank_column, load_industries
+from stage_profiler import add_profile_arguments, start_profiling
 
-def load_all_stocks_valuation():
+
+def load_all_stocks_valuation(granularity="monthly", as_of=None):
     """
-    Load valuation data for all stocks
+    Load valuation data for all stocks (from the valuation server when it is running)
+
+    granularity='daily' loads the latest trading day of every stock from the daily valuation archive.
+    as_of ('YYYY-MM') loads every stock's valuation as of the end of that month instead of the latest.
     """
-    valuation_dir = "../data/processed/stock-valuation/all/"
-    
-    if not os.path.exists(valuation_dir):
-        raise FileNotFoundError("Valuation directory not found. Please run calculation first.")
-    
-    all_stocks = []
-    for file in os.listdir(valuation_dir):
-        if file.endswith('.csv'):
-            df = pd.read_csv(os.path.join(valuation_dir, file))
-            all_stocks.append(df.iloc[-1])  # Get the latest row for each stock
-    
-    return pd.DataFrame(all_stocks)
+    if as_of:
+        return load_as_of_values(as_of, granularity)
+    if granularity == "daily":
+        return load_latest_daily_values()
 
+    all_stocks = load_snapshot_from_server()
+    if all_stocks is not None:
+        return all_stocks
 
-def get_stock_name(stock_code):
-    """
-    Get stock name from stock code
-    """
-    stock_code = str(stock_code).zfill(6)
-    stock_names_file = "../data/input/stock_names_full.csv"
-    if os.path.exists(stock_names_file):
-        stock_names = pd.read_csv(stock_names_file)
-        stock_name = stock_names[stock_names['code'].astype(str).str.zfill(6) == stock_code]['name'].values
-        return stock_name[0] if len(stock_name) > 0 else "Unknown"
-    return "Unknown"
+    # attach the shared market panel when one is published and current
+    all_stocks = load_panel_latest_values()
+    if all_stocks is not None:
+        return all_stocks
+
+    if not os.path.exists(VALUATION_DIR):
+        raise FileNotFoundError("Valuation directory not found. Please run calculation first.")
 
+    # latest row of every stock, streamed in typed chunks
+    return scan_latest_values()
 
-def find_top_stocks(all_stocks_df, indicator, top_n):
+
+def find_top_stocks(all_stocks_df, indicator, top_n, industry_relative=False):
     """
     Find top N stocks based on the indicator
     - For pe_ttm, pb_ttm, pr_ttm: find smallest values (lower is better)
     - For roe_ttm: find highest values (higher is better)
+    With industry_relative, sort by the indicator's rank within the stock's
+    industry instead (needs the industry rank columns, see industry_rank.py).
     """
+    sort_columns = [get_rank_column(indicator), indicator] if industry_relative else [indicator]
     # Filter valid values (positive only for the selected indicator)
     valid_df = all_stocks_df[all_stocks_df[indicator] > 0].copy()
     
@@ -52,16 +61,20 @@ def find_top_stocks(all_stocks_df, indicator, top_n):
     if 'roe_ttm' in valid_df.columns:
         valid_df = valid_df[valid_df['roe_ttm'] > 0]
     
+    if industry_relative:
+        # stocks of small or unclassified industries have no rank
+        valid_df = valid_df[valid_df[get_rank_column(indicator)].notna()]
+    
     if len(valid_df) == 0:
         return pd.DataFrame()
     
     # Sort based on indicator type
     if indicator == 'roe_ttm':
         # Higher is better for ROE
-        valid_df = valid_df.sort_values(indicator, ascending=False)
+        valid_df = valid_df.sort_values(sort_columns, ascending=False)
     else:
         # Lower is better for PE, PB, PR
-        valid_df = valid_df.sort_values(indicator, ascending=True)
+        valid_df = valid_df.sort_values(sort_columns, ascending=True)
     
     # Get top N
     top_stocks = valid_df.head(top_n).copy()
@@ -70,7 +83,7 @@ def find_top_stocks(all_stocks_df, indicator, top_n):
     top_stocks['code'] = top_stocks['code'].astype(str).str.zfill(6)
     
     # Add stock name
-    top_stocks['name'] = top_stocks['code'].apply(lambda x: get_stock_name(x))
+    top_stocks['name'] = get_names(get_ids(top_stocks['code']))
     
     return top_stocks
 
@@ -109,6 +122,10 @@ def print_top_stocks(top_stocks_df, indicator, top_n):
                 header += f" {'Price':>10}"
             else:
                 header += f" {col.upper():>10}"
+    # industry and the indicator's rank within it, when there is an industry classification
+    rank_column = get_rank_column(indicator)
+    if rank_column in top_stocks_df.columns:
+        header += f"  {'Industry':<12} {'Ind. rank':>9}"
     print(header)
     print("-" * 100)
     
@@ -118,6 +135,9 @@ def print_top_stocks(top_stocks_df, indicator, top_n):
         for col in ['pe_ttm', 'pb_ttm', 'pr_ttm', 'roe_ttm', 'close']:
             if col in row:
                 line += f" {row[col]:>10.2f}"
+        if rank_column in row:
+            rank = f"{row[rank_column]:.0%}" if pd.notna(row[rank_column]) else "-"
+            line += f"  {str(row['industry']) if pd.notna(row['industry']) else '-':<12} {rank:>9}"
         print(line)
     
     print("-" * 100)
@@ -132,17 +152,33 @@ def main():
     parser.add_argument("--indicator", type=str, default="pe_ttm",
                         choices=['pe_ttm', 'pb_ttm', 'pr_ttm', 'roe_ttm'],
                         help="Indicator to sort by: pe_ttm, pb_ttm, pr_ttm (lower is better), roe_ttm (higher is better)")
+    parser.add_argument("--granularity", type=str, default="monthly",
+                        choices=['monthly', 'daily'],
+                        help="Rank on the latest monthly close (default) or the latest trading day (run daily_valuation.py first)")
+    parser.add_argument("--as_of", type=str, default=None,
+                        help="Rank on the valuations as of the end of a past month, YYYY-MM (default: latest)")
+    parser.add_argument("--industry_relative", action="store_true",
+                        help="Rank on the indicator's percentile within each stock's industry instead of its value "
+                             "(run 'python query_data_new.py --data_type industry --stock_type all' first)")
+    add_profile_arguments(parser)
     
     args = parser.parse_args()
+    if args.industry_relative and load_industries() is None:
+        parser.error("no industry classification found, run 'python query_data_new.py --data_type industry --stock_type all' first")
+    if args.profile:
+        start_profiling("query_top_stocks", args.profile_memory, args.profile_top)
     
     try:
         # Load all stocks data
-        all_stocks_df = load_all_stocks_valuation()
+        all_stocks_df = load_all_stocks_valuation(args.granularity, args.as_of)
+        
+        print(f"\nLoaded {len(all_stocks_df)} stocks for analysis" + (f" as of {args.as_of}." if args.as_of else "."))
         
-        print(f"\nLoaded {len(all_stocks_df)} stocks for analysis.")
+        # Rank every stock within its industry
+        all_stocks_df = add_industry_ranks(all_stocks_df)
         
         # Find top stocks
-        top_stocks_df = find_top_stocks(all_stocks_df, args.indicator, args.top_n)
+        top_stocks_df = find_top_stocks(all_stocks_df, args.indicator, args.top_n, args.industry_relative)
         
         # Print results
         print_top_stocks(top_stocks_df, args.indicator, args.top_n)
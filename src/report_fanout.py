@@ -0,0 +1,135 @@
+import json
+import argparse
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from symbol_table import load_symbol_table, get_ids, get_universe_bits, is_member
+from calculation_and_visualization_new import load_latest_stock_values, filter_best_stocks, visualize_stocks, get_image_file
+from send_emails_new import get_smtp_settings, open_smtp_session, send_mail
+
+# Subscriptions: one report per entry, e.g.
+# [
+#   {"receiver": "a@example.com", "stock_type": "portfolio", "threshold": 0.35},
+#   {"receiver": "b@example.com", "stock_type": "hs300", "threshold": 0.26, "scope": "universe"}
+# ]
+SUBSCRIPTIONS_FILE = "../data/input/subscriptions.json"
+
+
+def load_subscriptions(subscriptions_file=SUBSCRIPTIONS_FILE):
+    """
+    Load the report subscriptions and fill in the default screen parameters
+
+    - receiver  : address (or comma-separated addresses) to send the report to
+    - stock_type: universe from STOCK_TYPE_MAPPING, or an expression of them such as 'hs300&hongli'
+    - threshold : quantile threshold of the screen (default: 0.26)
+    - scope     : 'market' to take the quantiles over all valued stocks (default),
+                  'universe' to take them over the subscription's universe only
+    """
+    with open(subscriptions_file, 'r') as f:
+        subscriptions = json.load(f)
+
+    for subscription in subscriptions:
+        try:
+            get_universe_bits(subscription.get('stock_type') or "")
+        except ValueError as e:
+            raise ValueError(f"Unknown stock_type in subscription {subscription}. {e}")
+        if subscription.get('scope', 'market') not in ('market', 'universe'):
+            raise ValueError(f"Unknown scope in subscription {subscription}. Use 'market' or 'universe'.")
+        subscription.setdefault('threshold', 0.26)
+        subscription.setdefault('scope', 'market')
+    return subscriptions
+
+
+def evaluate_subscriptions(subscriptions, stock_values):
+    """
+    Screen every subscription against one in-memory snapshot of the latest valuations
+
+    Stocks are matched to universes by symbol table id with the universe
+    bitsets; identical (universe, threshold, scope) screens are evaluated
+    once and shared between subscriptions.
+    Returns: list of screened stock codes, one per subscription
+    """
+    table = load_symbol_table()
+    ids = get_ids(stock_values['code'], table)
+    screens = {}
+    results = []
+
+    for subscription in subscriptions:
+        stock_type = subscription['stock_type']
+        key = (stock_type, subscription['threshold'], subscription['scope'])
+
+        if key not in screens:
+            in_universe = stock_values[is_member(ids, stock_type, table)]
+            reference = in_universe if subscription['scope'] == 'universe' else stock_values
+            screened = filter_best_stocks(in_universe, subscription['threshold'], reference=reference)
+            screens[key] = screened['code'].tolist()
+
+        results.append(screens[key])
+
+    return results
+
+
+def fan_out_reports(subscriptions, dry_run=False, max_message_mb=10, max_width=1200, budget_kb=300):
+    """
+    Screen, render and send all subscribed reports in one run
+
+    Each distinct stock is plotted once (charts already rendered today are
+    reused) and its chart is shared by every report that contains it.
+    """
+    today = datetime.now().strftime('%Y%m%d')
+
+    stock_values = load_latest_stock_values()
+    print(f"Loaded {len(stock_values)} stocks for {len(subscriptions)} subscriptions.")
+
+    screened_codes = evaluate_subscriptions(subscriptions, stock_values)
+
+    unique_codes = sorted(set(code for codes in screened_codes for code in codes))
+    print(f"Rendering {len(unique_codes)} distinct stocks.")
+    image_files = set(visualize_stocks(unique_codes, skip_existing=True))
+
+    if dry_run:
+        for subscription, codes in zip(subscriptions, screened_codes):
+            print(f"{subscription['receiver']} ({subscription['stock_type']}): {len(codes)} stocks {codes}")
+        return
+
+    settings = get_smtp_settings()
+    smtp = open_smtp_session(**settings)
+    try:
+        for subscription, codes in zip(subscriptions, screened_codes):
+            report_images = [get_image_file(code, today) for code in codes]
+            report_images = [image_file for image_file in report_images if image_file in image_files]
+
+            mail_title = f"Stock Analytics Results ({subscription['stock_type']}) by {today}"
+            mail_content = f'The analysis results of {subscription["stock_type"]} by {today} are: \n' + \
+                f'There are {len(codes)} stocks in total and \n' + \
+                f'The stock codes are: {codes}.'
+
+            send_mail(receivers=subscription['receiver'], mail_title=mail_title, mail_content=mail_content,
+                      img_dir=report_images, smtp=smtp, sender=settings["sender_mail"],
+                      max_message_mb=max_message_mb, max_width=max_width, budget_kb=budget_kb)
+            print(f"Sent {subscription['stock_type']} report with {len(codes)} stocks to {subscription['receiver']}.")
+    finally:
+        smtp.quit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send personalized screen reports to a list of subscriptions")
+    parser.add_argument("--subscriptions", type=str, default=SUBSCRIPTIONS_FILE,
+                        help=f"Subscriptions JSON file (default: {SUBSCRIPTIONS_FILE})")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Screen and render, but only print the reports instead of sending them")
+    parser.add_argument('--max_image_width', type=int, default=1200,
+                        help='Downscale inline images to at most this width in pixels (default: 1200)')
+    parser.add_argument('--image_budget_kb', type=int, default=300,
+                        help='Target size per inline image in KB (default: 300)')
+    parser.add_argument('--max_message_mb', type=float, default=10,
+                        help='Split a report into several messages above this size in MB (default: 10)')
+
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    subscriptions = load_subscriptions(args.subscriptions)
+    fan_out_reports(subscriptions, dry_run=args.dry_run, max_message_mb=args.max_message_mb,
+                    max_width=args.max_image_width, budget_kb=args.image_budget_kb)
@@ -29,4 +29,8 @@ python querying_data.py --data_type price --stock_type portfolio --season_end 20
 python calculation_and_visualization.py --price_date $PRICE_DATE --step all --threshold 0.26
 
 # send the email with the results
-python send_emails.py --price_date $PRICE_DATE
\ No newline at end of file
+python send_emails.py --price_date $PRICE_DATE
+
+# record today's dated folders in the deduplicating snapshot store (add --delete to keep only the store;
+# python snapshot_store.py --dataset price --date YYYYMMDD materializes a folder again)
+python snapshot_store.py --migrate
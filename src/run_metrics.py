@@ -0,0 +1,375 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import argparse
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+# One folder per run with the metrics of every stage process and the run report
+METRICS_DIR = "../data/pipeline/metrics"
+# Prometheus textfile (node_exporter textfile collector) with the metrics of the latest run
+PROM_FILE = f"{METRICS_DIR}/stock_pipeline.prom"
+# Set by pipeline.py so the stage processes it starts report into the same run
+RUN_ID_ENV = "PIPELINE_RUN_ID"
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+# A stage or operation is reported as a regression when it got this much slower than in the previous run
+REGRESSION_RATIO = 1.25
+# ... and at least this many seconds slower (stage duration) / with at least this many observations (latency)
+REGRESSION_MIN_SECONDS = 1.0
+REGRESSION_MIN_COUNT = 5
+
+# Metrics of the current process: {(name, labels): value} and {(name, labels): histogram}
+COUNTERS = {}
+HISTOGRAMS = {}
+STAGE = {}
+LOCK = threading.Lock()
+
+
+def get_key(name, labels):
+    """Key of a metric with its labels"""
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_metric(name, labels):
+    """Format a metric as name{label="value",...}"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def count(name, value=1, **labels):
+    """Add value to a counter"""
+    key = get_key(name, labels)
+    with LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """Record a latency in a histogram"""
+    key = get_key(name, labels)
+    with LOCK:
+        histogram = HISTOGRAMS.setdefault(key, {"counts": [0] * (len(LATENCY_BUCKETS) + 1),
+                                                "sum": 0.0, "count": 0, "max": 0.0})
+        position = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        histogram["counts"][position] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+        histogram["max"] = max(histogram["max"], seconds)
+
+
+@contextmanager
+def timed(operation, **labels):
+    """
+    Time a local operation (CSV parsing, plotting, ...) into operation_seconds
+
+    Exceptions are counted in operation_errors_total and re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count("operation_errors_total", operation=operation, **labels)
+        raise
+    finally:
+        observe("operation_seconds", time.perf_counter() - start, operation=operation, **labels)
+
+
+@contextmanager
+def track_request(endpoint, expected=()):
+    """
+    Count and time a call to an upstream endpoint (an akshare function, the SMTP server)
+
+    Records requests_total, request_seconds and, when the call raises,
+    request_failures_total; the exception is re-raised. Exceptions of the
+    expected types are answers rather than failures (e.g. no data for the stock).
+    """
+    count("requests_total", endpoint=endpoint)
+    start = time.perf_counter()
+    try:
+        yield
+    except expected:
+        raise
+    except Exception:
+        count("request_failures_total", endpoint=endpoint)
+        raise
+    finally:
+        observe("request_seconds", time.perf_counter() - start, endpoint=endpoint)
+
+
+def record_io(direction, file, rows, kind):
+    """Count the rows and bytes of a file read or written ('read' or 'written')"""
+    count(f"rows_{direction}_total", rows, kind=kind)
+    if os.path.exists(file):
+        count(f"bytes_{direction}_total", os.path.getsize(file), kind=kind)
+
+
+def get_peak_rss_mb(maxrss=None):
+    """
+    Get a peak resident memory in MB: of this process so far, or of a ru_maxrss
+    value (e.g. of a child from os.wait4)
+
+    ru_maxrss is in bytes on macOS and in KiB on Linux.
+    """
+    if maxrss is None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 1024
+
+
+def get_run_id(stage):
+    """Get the run id of the pipeline run, or a new one for a stage run on its own"""
+    return os.environ.get(RUN_ID_ENV) or f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{stage}"
+
+
+def get_run_dir(run_id):
+    """Get the folder of a run's metrics"""
+    return f"{METRICS_DIR}/runs/{run_id}"
+
+
+def start_run(stage):
+    """
+    Start recording the metrics of a stage process
+
+    The metrics are saved when the process exits. The first process of a run
+    (pipeline.py, or a stage run on its own) owns it: the processes it starts
+    report into the same run, and it writes the run report when it exits.
+    """
+    owner = not os.environ.get(RUN_ID_ENV)
+    STAGE.update({"stage": stage, "run_id": get_run_id(stage), "owner": owner,
+                  "started_at": datetime.now().isoformat(timespec='seconds'), "start": time.perf_counter()})
+    os.environ[RUN_ID_ENV] = STAGE["run_id"]
+    atexit.register(finish_run)
+
+
+def finish_run():
+    """Save the metrics of the stage process, and write the run report if the process owns the run"""
+    save_stage_metrics()
+    if STAGE["owner"]:
+        write_run_report(STAGE["run_id"])
+
+
+def save_stage_metrics():
+    """Save the metrics recorded by this process to its run folder"""
+    run_dir = get_run_dir(STAGE["run_id"])
+    os.makedirs(run_dir, exist_ok=True)
+    with LOCK:
+        stage_metrics = {
+            "stage": STAGE["stage"],
+            "pid": os.getpid(),
+            "started_at": STAGE["started_at"],
+            "duration_seconds": time.perf_counter() - STAGE["start"],
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in COUNTERS.items()],
+            "histograms": [{"name": name, "labels": dict(labels), **histogram}
+                           for (name, labels), histogram in HISTOGRAMS.items()],
+        }
+    with open(f"{run_dir}/{STAGE['stage']}-{os.getpid()}.json", 'w') as f:
+        json.dump(stage_metrics, f, indent=2)
+
+
+def estimate_quantile(histogram, q):
+    """Estimate a quantile from the bucket counts, interpolating linearly within the bucket"""
+    target = q * histogram["count"]
+    seen = 0
+    for i, bucket_count in enumerate(histogram["counts"]):
+        if bucket_count and seen + bucket_count >= target:
+            lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+            upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else histogram["max"]
+            return min(lower + (upper - lower) * (target - seen) / bucket_count, histogram["max"])
+        seen += bucket_count
+    return 0.0
+
+
+def aggregate_run(run_id):
+    """
+    Merge the metrics files of all stage processes of a run
+    Returns: {stage: {"duration_seconds", "processes", "counters", "histograms"}}
+    """
+    run_dir = get_run_dir(run_id)
+    stages = {}
+    for file in sorted(os.listdir(run_dir)):
+        if not file.endswith('.json') or file == "run_report.json":
+            continue
+        with open(f"{run_dir}/{file}", 'r') as f:
+            stage_metrics = json.load(f)
+        stage = stages.setdefault(stage_metrics["stage"], {"duration_seconds": 0.0, "processes": 0,
+                                                           "counters": {}, "histograms": {}})
+        stage["duration_seconds"] += stage_metrics["duration_seconds"]
+        stage["processes"] += 1
+        for counter in stage_metrics["counters"]:
+            key = get_key(counter["name"], counter["labels"])
+            stage["counters"][key] = stage["counters"].get(key, 0) + counter["value"]
+        for histogram in stage_metrics["histograms"]:
+            key = get_key(histogram["name"], histogram["labels"])
+            merged = stage["histograms"].setdefault(key, {"counts": [0] * (len(LATENCY_BUCKETS) + 1),
+                                                          "sum": 0.0, "count": 0, "max": 0.0})
+            merged["counts"] = [a + b for a, b in zip(merged["counts"], histogram["counts"])]
+            merged["sum"] += histogram["sum"]
+            merged["count"] += histogram["count"]
+            merged["max"] = max(merged["max"], histogram["max"])
+    return stages
+
+
+def summarize_stages(stages):
+    """Turn aggregated stage metrics into the JSON-friendly form of the run report"""
+    summary = {}
+    for stage_name, stage in stages.items():
+        summary[stage_name] = {
+            "duration_seconds": round(stage["duration_seconds"], 3),
+            "processes": stage["processes"],
+            "counters": {format_metric(name, labels): value for (name, labels), value in sorted(stage["counters"].items())},
+            "latency": {format_metric(name, labels): {
+                "count": histogram["count"],
+                "mean": round(histogram["sum"] / histogram["count"], 6) if histogram["count"] else 0.0,
+                "p50": round(estimate_quantile(histogram, 0.5), 6),
+                "p95": round(estimate_quantile(histogram, 0.95), 6),
+                "max": round(histogram["max"], 6),
+            } for (name, labels), histogram in sorted(stage["histograms"].items())},
+        }
+    return summary
+
+
+def find_previous_report(run_id, stage_names):
+    """Find the report of the latest earlier run that covered at least one of the same stages"""
+    runs_dir = f"{METRICS_DIR}/runs"
+    for previous_id in sorted(os.listdir(runs_dir), reverse=True):
+        report_file = f"{get_run_dir(previous_id)}/run_report.json"
+        if previous_id >= run_id or not os.path.exists(report_file):
+            continue
+        with open(report_file, 'r') as f:
+            report = json.load(f)
+        if set(report["stages"]) & set(stage_names):
+            return report
+    return None
+
+
+def compare_runs(summary, previous):
+    """
+    List what got worse since the previous run
+
+    Flags stages that took REGRESSION_RATIO times longer, operations and
+    endpoints whose mean latency grew as much, and more failures, errors or
+    retries than before.
+    """
+    regressions = []
+    for stage_name, stage in summary.items():
+        before = previous["stages"].get(stage_name)
+        if before is None:
+            continue
+        old, new = before["duration_seconds"], stage["duration_seconds"]
+        if new > old * REGRESSION_RATIO and new - old >= REGRESSION_MIN_SECONDS:
+            regressions.append(f"{stage_name}: duration {old:.1f}s -> {new:.1f}s (+{(new / old - 1) * 100:.0f}%)")
+        for metric, latency in stage["latency"].items():
+            old_latency = before["latency"].get(metric)
+            if old_latency and latency["count"] >= REGRESSION_MIN_COUNT and old_latency["mean"] > 0 \
+                    and latency["mean"] > old_latency["mean"] * REGRESSION_RATIO:
+                regressions.append(f"{stage_name}: {metric} mean {old_latency['mean'] * 1000:.1f}ms -> "
+                                   f"{latency['mean'] * 1000:.1f}ms (+{(latency['mean'] / old_latency['mean'] - 1) * 100:.0f}%)")
+        for metric, value in stage["counters"].items():
+            if any(word in metric for word in ("failures", "errors", "retries", "failed")) \
+                    and value > before["counters"].get(metric, 0):
+                regressions.append(f"{stage_name}: {metric} {before['counters'].get(metric, 0)} -> {value}")
+    return regressions
+
+
+def write_prometheus(stages, run_id, prom_file=PROM_FILE):
+    """
+    Write the metrics of a run in the Prometheus text exposition format, atomically
+
+    Metrics are prefixed with stock_pipeline_ and labelled with their stage;
+    the samples of a metric are grouped under its TYPE line.
+    """
+    families = {
+        "run_timestamp_seconds": ("gauge", [f'stock_pipeline_run_timestamp_seconds{{run_id="{run_id}"}} {time.time():.0f}']),
+        "stage_duration_seconds": ("gauge", []),
+    }
+    for stage_name, stage in sorted(stages.items()):
+        families["stage_duration_seconds"][1].append(
+            f'stock_pipeline_stage_duration_seconds{{stage="{stage_name}"}} {stage["duration_seconds"]:.3f}')
+        for (name, labels), value in sorted(stage["counters"].items()):
+            labels = (("stage", stage_name),) + labels
+            families.setdefault(name, ("counter", []))[1].append(f"stock_pipeline_{format_metric(name, labels)} {value}")
+        for (name, labels), histogram in sorted(stage["histograms"].items()):
+            labels = (("stage", stage_name),) + labels
+            samples = families.setdefault(name, ("histogram", []))[1]
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ["+Inf"], histogram["counts"]):
+                cumulative += bucket_count
+                samples.append(f"stock_pipeline_{format_metric(name + '_bucket', labels + (('le', bound),))} {cumulative}")
+            samples.append(f"stock_pipeline_{format_metric(name + '_sum', labels)} {histogram['sum']:.6f}")
+            samples.append(f"stock_pipeline_{format_metric(name + '_count', labels)} {histogram['count']}")
+
+    lines = []
+    for name, (metric_type, samples) in families.items():
+        lines.append(f"# TYPE stock_pipeline_{name} {metric_type}")
+        lines.extend(samples)
+
+    os.makedirs(os.path.dirname(prom_file), exist_ok=True)
+    tmp_file = f"{prom_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_file, prom_file)
+
+
+def write_run_report(run_id):
+    """
+    Write the JSON report and the Prometheus textfile of a run, and print what regressed
+
+    Returns: the report
+    """
+    stages = aggregate_run(run_id)
+    summary = summarize_stages(stages)
+    previous = find_previous_report(run_id, list(summary))
+    regressions = compare_runs(summary, previous) if previous else []
+    report = {
+        "run_id": run_id,
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "previous_run_id": previous["run_id"] if previous else None,
+        "regressions": regressions,
+        "stages": summary,
+    }
+    with open(f"{get_run_dir(run_id)}/run_report.json", 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    write_prometheus(stages, run_id)
+
+    print_report(report)
+    return report
+
+
+def print_report(report):
+    """Print the stage durations, the slowest endpoints and operations, and the regressions of a run"""
+    print(f"Run {report['run_id']} (compared with {report['previous_run_id'] or 'no previous run'}):")
+    for stage_name, stage in report["stages"].items():
+        print(f"  {stage_name:<20} {stage['duration_seconds']:>9.1f}s")
+        slowest = sorted(stage["latency"].items(), key=lambda item: -item[1]["mean"] * item[1]["count"])[:5]
+        for metric, latency in slowest:
+            print(f"    {metric:<60} n={latency['count']:<6} total={latency['mean'] * latency['count']:.1f}s "
+                  f"p50={latency['p50'] * 1000:.0f}ms p95={latency['p95'] * 1000:.0f}ms")
+    if report["regressions"]:
+        print("Regressions:")
+        for regression in report["regressions"]:
+            print(f"  {regression}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the metrics report of a run (default: the latest)")
+    parser.add_argument("--run_id", type=str, default=None,
+                        help="Run to show, a folder name in data/pipeline/metrics/runs")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Rebuild the report from the stage metrics files instead of showing the stored one")
+
+    args = parser.parse_args()
+
+    run_id = args.run_id if args.run_id else sorted(os.listdir(f"{METRICS_DIR}/runs"))[-1]
+    report_file = f"{get_run_dir(run_id)}/run_report.json"
+    if args.rebuild or not os.path.exists(report_file):
+        write_run_report(run_id)
+    else:
+        with open(report_file, 'r') as f:
+            print_report(json.load(f))
@@ -8,6 +8,30 @@
 #   2. Query price data (daily basis - only if not updated today)
 #   3. Calculate stock valuations and visualize best stocks
 #   4. Send email with results
+#
+# The stages are run by pipeline.py, which skips every stage whose inputs are
+# unchanged since its last successful run and runs the price and financial
+# queries in parallel. The STEP sections below document the commands each
+# stage runs; they are kept commented out for running a step by hand.
+#
+# Usage:
+#   ./run_new.sh                      # run whatever is out of date
+#   ./run_new.sh --from screen        # rerun screen, render and email
+#   ./run_new.sh --only email         # only resend the email
+#   ./run_new.sh --force              # rerun every stage
+#   ./run_new.sh --delta              # only report stocks that entered/left the screen
+#
+# Every run writes a metrics report (data/pipeline/metrics/runs/{run_id}/run_report.json)
+# and a Prometheus textfile (data/pipeline/metrics/stock_pipeline.prom), and prints what
+# got slower or failed more than in the previous run. Show it again with:
+#   python run_metrics.py
+#
+# To find out where a stage spends its time, run it by hand with --profile (see README):
+#   python calculation_and_visualization_new.py --step value --profile
+#
+# To measure the stages and query CLIs on seeded synthetic markets (300-10000 stocks)
+# against the saved baseline:
+#   python benchmark.py --scales 300,1000,5000,10000
 # ============================================================================
 
 # ============================================================================
@@ -16,6 +40,8 @@
 # --data_type    : Type of data to query
 #                  - 'financial': Financial indicators (EPS, BPS, ROE, etc.)
 #                  - 'price'    : Daily stock price data (OHLC)
+#                  - 'industry' : Industry classification of all listed stocks
+#                                 (refreshed per industry board every 30 days)
 #
 # --stock_type   : Stock list to query
 #                  - 'hs300'     : CSI 300 stocks
@@ -29,23 +55,36 @@
 #                  - Without this flag: Only query stocks that need updating
 #                  - With this flag: Query all stocks regardless of last update
 #
-# --season_end   : (Optional, for financial data) End date for financial data
-#                  - Format: 'YYYY-MM-DD'
-#                  - Default: '2025-12-31'
-#                  - Used to standardize report dates
-#
 # --adjust       : (Optional, for price data) Price adjustment method
 #                  - ''    : No adjustment (raw prices)
 #                  - 'qfq' : Forward adjustment (前复权)
 #                  - 'hfq' : Backward adjustment (后复权)
 #                  - Default: '' (no adjustment)
+#                  - Raw prices are always stored in price-data/all; adjusted
+#                    prices are derived from stored factors into price-data/{qfq,hfq}
+#
+# --shard        : (Optional) Only query shard 'i/n' of the stock list (0 <= i < n)
+#                  - Stocks are assigned by a stable hash of the code
+#                  - Results go to data/staging/shard_i_of_n; merge them with:
+#                    python merge_shards.py --stock_type all
+#
+# --priority     : (Optional, for price data) Fetch the portfolio, the last screen's
+#                  members and the stocks near its thresholds first, then publish
+#                  data/input/price-data/priority_complete.json before the rest
+#                  - Wait for it with: python fetch_priority.py --wait
+#                  - Then value the subset: calculation_and_visualization_new.py --step value --priority_only
+#
+# --industry_source : (Optional, for industry data) Read the classification from a
+#                  local CSV (columns: code, industry) instead of akshare
 #
 # ============================================================================
 # Command Line Parameters for calculation_and_visualization_new.py
 # ============================================================================
 # --step         : Which step to run
 #                  - 'value'    : Only calculate stock valuations
-#                  - 'visualize': Only visualize best stocks (requires existing valuations)
+#                  - 'screen'   : Only filter the best stocks (requires existing valuations)
+#                  - 'render'   : Only plot today's filtered stocks (requires the screen output)
+#                  - 'visualize': Screen and render (requires existing valuations)
 #                  - 'all'      : Run both steps (default)
 #
 # --threshold    : Quantile threshold for filtering stocks
@@ -54,6 +93,14 @@
 #                  - Lower value = stricter filtering (fewer stocks selected)
 #                  - Filters: PE, PB, PR < threshold percentile, ROE > (1-threshold) percentile
 #
+# --granularity  : (Optional) Valuation the screen runs on
+#                  - 'monthly': Latest monthly close (default)
+#                  - 'daily'  : Latest trading day; the value step also updates the daily
+#                               archive (python daily_valuation.py builds it on its own)
+#
+# --memory_cap_mb : (Optional) CSV text parsed at a time while scanning the valuations
+#                   of the whole market, in MB (default: 4); the scan prints its peak memory
+#
 # ============================================================================
 # Command Line Parameters for send_emails_new.py
 # ============================================================================
@@ -61,6 +108,10 @@
 #                  - Format: 'YYYYMMDD'
 #                  - Default: Today's date
 #                  - Specifies which img/{date} folder to attach
+#
+# --max_image_width : (Optional) Downscale inline images to this width (default: 1200)
+# --image_budget_kb : (Optional) Target size per inline image in KB (default: 300)
+# --max_message_mb  : (Optional) Split the report above this size in MB (default: 10)
 # ============================================================================
 
 
@@ -71,10 +122,10 @@
 # and only queries stocks that haven't been updated in 30+ days.
 # Uncomment the lines below to run financial data queries.
 
-python query_data_new.py --data_type financial --stock_type honglidibo --season_end 2026-12-31
-python query_data_new.py --data_type financial --stock_type hongli --season_end 2026-12-31
-python query_data_new.py --data_type financial --stock_type hs300 --season_end 2026-12-31
-python query_data_new.py --data_type financial --stock_type zz500 --season_end 2026-12-31
+# python query_data_new.py --data_type financial --stock_type honglidibo
+# python query_data_new.py --data_type financial --stock_type hongli
+# python query_data_new.py --data_type financial --stock_type hs300
+# python query_data_new.py --data_type financial --stock_type zz500
 
 # Force query all financial data (ignore last update time):
 # python query_data_new.py --data_type financial --stock_type hs300 --force
@@ -87,11 +138,11 @@ python query_data_new.py --data_type financial --stock_type zz500 --season_end 2
 # and only queries stocks that haven't been updated today.
 # Incremental updates append new data to existing files.
 
-python query_data_new.py --data_type price --stock_type honglidibo
-python query_data_new.py --data_type price --stock_type hongli
-python query_data_new.py --data_type price --stock_type hs300
-python query_data_new.py --data_type price --stock_type zz500
-python query_data_new.py --data_type price --stock_type portfolio
+# python query_data_new.py --data_type price --stock_type honglidibo
+# python query_data_new.py --data_type price --stock_type hongli
+# python query_data_new.py --data_type price --stock_type hs300
+# python query_data_new.py --data_type price --stock_type zz500
+# python query_data_new.py --data_type price --stock_type portfolio
 
 # Query all stocks:
 # python query_data_new.py --data_type price --stock_type all
@@ -106,6 +157,13 @@ python query_data_new.py --data_type price --stock_type portfolio
 # python query_data_new.py --data_type price --stock_type zz500 --adjust hfq
 # python query_data_new.py --data_type price --stock_type portfolio --adjust hfq
 
+# Query the industry classification (the screen then adds industry-relative ranks):
+# python query_data_new.py --data_type industry --stock_type all
+
+# Find holes left by failed queries and fetch only the missing trading days:
+# python gap_backfill.py --stock_type all --scan_only
+# python gap_backfill.py --stock_type all
+
 
 # ============================================================================
 # STEP 3: Calculate Stock Valuations and Visualize Best Stocks
@@ -116,11 +174,17 @@ python query_data_new.py --data_type price --stock_type portfolio
 #   3. Filters stocks based on threshold
 #   4. Generates distribution plots for selected stocks
 
-python calculation_and_visualization_new.py --step all --threshold 0.26
+# python calculation_and_visualization_new.py --step all --threshold 0.26
+#
+# Or fetch prices, value and screen in one streaming pass (financial data must be current):
+# python stream_pipeline.py --stock_type all --threshold 0.26
 
 # Run only valuation calculation:
 # python calculation_and_visualization_new.py --step value
 
+# Screen on the latest trading day instead of the latest monthly close:
+# python calculation_and_visualization_new.py --step all --threshold 0.26 --granularity daily
+
 # Run only visualization (requires existing valuation files):
 # python calculation_and_visualization_new.py --step visualize --threshold 0.26
 
@@ -130,6 +194,9 @@ python calculation_and_visualization_new.py --step all --threshold 0.26
 # Use looser threshold (more stocks selected):
 # python calculation_and_visualization_new.py --step all --threshold 0.35
 
+# Update the market-wide valuation quantiles per universe and month, with their chart:
+# python market_index.py
+
 
 # ============================================================================
 # STEP 4: Send Email with Results
@@ -138,10 +205,19 @@ python calculation_and_visualization_new.py --step all --threshold 0.26
 #   - Summary of selected stocks
 #   - Distribution plots as inline images
 
-python send_emails_new.py
+# python send_emails_new.py
 
 # Send email for a specific date:
 # python send_emails_new.py --date 20250307
 
 
+# ============================================================================
+# Run the stage graph: fetch_financial, fetch_price -> value -> screen -> render -> email
+#                                                       value -> index (market valuation index) -> email
+#                                     fetch_industry (industry classification) -> screen
+# ============================================================================
+
+python pipeline.py --threshold 0.26 "$@" || exit 1
+
+
 echo "Pipeline completed successfully!"
\ No newline at end of file
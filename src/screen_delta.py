@@ -0,0 +1,122 @@
+import os
+import re
+import argparse
+from datetime import datetime
+
+import pandas as pd
+
+VALUATION_DIR = "../data/processed/stock-valuation"
+
+# Threshold crossings reported on top of screen entries and exits:
+# (event name, metric, reference column, direction the metric crosses the reference)
+CROSSING_RULES = [
+    ("pr_below_own_q25", "pr_ttm", "pr_ttm_q25", "below"),
+    ("pr_above_own_q75", "pr_ttm", "pr_ttm_q75", "above"),
+]
+
+
+def get_snapshot_file(date):
+    """Get the path of the metric snapshot written by the screen step on the given date"""
+    return f"{VALUATION_DIR}/stocks_values_snapshot_{date}.csv"
+
+
+def get_delta_file(date):
+    """Get the path of the screen delta of the given date"""
+    return f"{VALUATION_DIR}/stocks_values_delta_{date}.csv"
+
+
+def find_previous_snapshot_date(date):
+    """
+    Find the date of the latest snapshot before the given date
+    Returns: the date as 'YYYYMMDD', or None if there is no earlier snapshot
+    """
+    dates = []
+    for file in os.listdir(VALUATION_DIR):
+        match = re.fullmatch(r"stocks_values_snapshot_(\d{8})\.csv", file)
+        if match and match.group(1) < date:
+            dates.append(match.group(1))
+    return max(dates) if dates else None
+
+
+def load_snapshot(date):
+    """Load the metric snapshot of the given date"""
+    snapshot = pd.read_csv(get_snapshot_file(date), dtype={'code': str})
+    snapshot['code'] = snapshot['code'].str.zfill(6)
+    return snapshot
+
+
+def compute_screen_delta(previous, current):
+    """
+    Compare two metric snapshots and return the changes between them
+
+    Both snapshots are aligned on code in one merge and every rule is
+    evaluated as a vectorized mask over all stocks.
+    Returns: DataFrame with one row per (code, event), where event is
+             'entered', 'exited' or the name of a crossing rule
+    """
+    columns = ['code', 'in_screen', 'pe_ttm', 'pb_ttm', 'pr_ttm', 'roe_ttm', 'close'] + \
+        sorted(set(rule[2] for rule in CROSSING_RULES))
+    if previous is None:
+        previous = pd.DataFrame(columns=columns)
+
+    merged = pd.merge(previous[columns], current[columns], on='code', how='outer',
+                      suffixes=('_prev', ''), validate="1:1")
+    in_prev = merged['in_screen_prev'].eq(True)
+    in_now = merged['in_screen'].eq(True)
+
+    events = [('entered', ~in_prev & in_now), ('exited', in_prev & ~in_now)]
+    for name, metric, reference, direction in CROSSING_RULES:
+        prev_value, prev_ref = merged[f"{metric}_prev"], merged[f"{reference}_prev"]
+        value, ref = merged[metric], merged[reference]
+        if direction == "below":
+            mask = (prev_value >= prev_ref) & (value < ref)
+        else:
+            mask = (prev_value <= prev_ref) & (value > ref)
+        events.append((name, mask))
+
+    delta = []
+    for name, mask in events:
+        rows = merged.loc[mask.to_numpy(dtype=bool)].copy()
+        rows.insert(1, 'event', name)
+        delta.append(rows)
+
+    delta = pd.concat(delta, ignore_index=True)
+    return delta[['code', 'event', 'pe_ttm', 'pb_ttm', 'pr_ttm', 'roe_ttm', 'close',
+                  'pe_ttm_prev', 'pb_ttm_prev', 'pr_ttm_prev', 'roe_ttm_prev', 'close_prev']]
+
+
+def detect_screen_changes(date=None):
+    """
+    Compare the snapshot of the given date (default: today) with the previous run and save the delta
+    """
+    date = date if date else datetime.now().strftime("%Y%m%d")
+    previous_date = find_previous_snapshot_date(date)
+
+    current = load_snapshot(date)
+    previous = load_snapshot(previous_date) if previous_date else None
+    delta = compute_screen_delta(previous, current)
+    delta.to_csv(get_delta_file(date), index=False)
+
+    print(f"Compared the screen of {date} with {previous_date if previous_date else 'no previous run'}:")
+    for event, codes in delta.groupby('event', sort=False)['code']:
+        print(f"  {event}: {len(codes)} stocks {codes.tolist()}")
+    return delta
+
+
+def load_changed_stocks(date=None):
+    """
+    Load the codes of the stocks that changed on the given date (default: today)
+    """
+    date = date if date else datetime.now().strftime("%Y%m%d")
+    delta = pd.read_csv(get_delta_file(date), dtype={'code': str})
+    return delta['code'].str.zfill(6).drop_duplicates().tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the stocks that entered or left the screen since the previous run")
+    parser.add_argument("--date", type=str, default=None,
+                        help="Date of the screen to compare, in the format 'YYYYMMDD' (default: today)")
+
+    args = parser.parse_args()
+
+    detect_screen_changes(args.date)
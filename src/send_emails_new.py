@@ -2,37 +2,153 @@ from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.header import Header
-from smtplib import SMTP_SSL
+from smtplib import SMTP, SMTP_SSL
 from datetime import datetime
+from io import BytesIO
+from functools import lru_cache
 
 import pandas as pd
+from PIL import Image
 
 import os
 from dotenv import load_dotenv
 import argparse
 
+from screen_delta import get_delta_file
+from market_index import load_market_index, get_market_summary, MARKET_INDEX_IMAGE_DIR
+from run_metrics import start_run, timed, track_request, count
+from stage_profiler import add_profile_arguments, start_profiling
 
-def load_stock_codes():
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
+
+def load_stock_codes(date=None):
     """
-    Load stock codes from the filtered stocks file (uses today's date)
+    Load stock codes from the filtered stocks file (default: today's date)
     """
-    today = datetime.now().strftime('%Y%m%d')
-    stocks = pd.read_csv(f'../data/processed/stock-valuation/stocks_values_filtered_{today}.csv')
+    date = date if date else datetime.now().strftime('%Y%m%d')
+    stocks = pd.read_csv(f'../data/processed/stock-valuation/stocks_values_filtered_{date}.csv', dtype={'code': str})
     number_of_stocks = len(stocks)
-    stock_codes = stocks.code.tolist()
+    stock_codes = stocks.code.str.zfill(6).tolist()
     return number_of_stocks, stock_codes
 
 
-def send_mail(receiver='', mail_title='', mail_content='', img_dir='../img/'):
-    smtp = SMTP_SSL(host_server)
+def load_screen_delta(date=None):
+    """
+    Load the screen changes of the date (default: today) as mail content and changed stock codes
+    """
+    date = date if date else datetime.now().strftime('%Y%m%d')
+    delta = pd.read_csv(get_delta_file(date), dtype={'code': str})
+    delta['code'] = delta['code'].str.zfill(6)
+
+    lines = [f'The screen changes by {date} are: ']
+    for event, codes in delta.groupby('event', sort=False)['code']:
+        lines.append(f'{event}: {len(codes)} stocks {codes.tolist()}')
+    if delta.empty:
+        lines.append('No stocks entered or left the screen.')
+    return '<br>'.join(lines), delta['code'].drop_duplicates().tolist()
+
+
+def load_market_section():
+    """
+    Load the market valuation summary as mail content, with its chart (see market_index.py)
+    Returns: (content, list of image files), empty if the market index has not been built
+    """
+    index = load_market_index()
+    if index is None:
+        return '', []
+    lines = ['Market valuation (median, 25th-75th percentile):'] + get_market_summary(index)
+    chart = f"{MARKET_INDEX_IMAGE_DIR}/market_index.png"
+    return '<br>'.join(lines), [chart] if os.path.exists(chart) else []
+
+
+def get_smtp_settings():
+    """
+    Read the SMTP settings from the environment (and the .env file)
+
+    SMTP_PORT and SMTP_USE_SSL are optional, e.g. SMTP_PORT=1025
+    SMTP_USE_SSL=false for a local SMTP stand-in.
+    Returns: dict of the open_smtp_session() arguments
+    """
+    load_dotenv()
+    return {
+        "host_server": os.getenv("SMTP_SERVER"),
+        "sender_mail": os.getenv("SENDER_EMAIL"),
+        "sender_passcode": os.getenv("EMAIL_AUTH_CODE"),
+        "port": int(os.getenv("SMTP_PORT")) if os.getenv("SMTP_PORT") else None,
+        "use_ssl": os.getenv("SMTP_USE_SSL", "true").lower() != "false",
+    }
+
+
+def open_smtp_session(host_server, sender_mail, sender_passcode, port=None, use_ssl=True):
+    """
+    Open one authenticated SMTP session to be reused for every message and recipient
+
+    Set use_ssl=False (and no passcode) to talk to a plain local SMTP stand-in.
+    """
+    if use_ssl:
+        smtp = SMTP_SSL(host_server, port) if port else SMTP_SSL(host_server)
+    else:
+        smtp = SMTP(host_server, port) if port else SMTP(host_server)
     smtp.ehlo(host_server)
-    smtp.login(sender_mail, sender_passcode)
+    if sender_passcode:
+        smtp.login(sender_mail, sender_passcode)
+    return smtp
+
+
+@lru_cache(maxsize=None)
+def optimize_image(path, max_width=1200, budget_kb=300, min_width=480):
+    """
+    Downscale and recompress an image to fit within a size budget
+
+    Charts are saved at 300 dpi; for an inline email image a width of about
+    1200 px is plenty. The image is palette-quantized PNG (flat chart colours
+    compress well that way) and shrunk further until it fits the budget.
+    Results are cached, so a chart shared by several reports is only
+    recompressed once per run.
+    Returns: (image bytes, subtype)
+    """
+    with Image.open(path) as img:
+        img = img.convert('RGB')
+        width = min(img.width, max_width)
+        while True:
+            height = round(img.height * width / img.width)
+            resized = img.resize((width, height), Image.LANCZOS) if width != img.width else img
+            buffer = BytesIO()
+            resized.quantize(colors=256).save(buffer, format='PNG', optimize=True)
+            data = buffer.getvalue()
+            if len(data) <= budget_kb * 1024 or width <= min_width:
+                return data, 'png'
+            width = max(min_width, int(width * 0.8))
+
 
+def iter_images(img_dir, max_width=1200, budget_kb=300):
+    """
+    Yield (filename, image bytes, subtype) one image at a time, in file name order
+
+    img_dir is either a folder or a list of image files.
+    """
+    if isinstance(img_dir, str):
+        image_files = [os.path.join(img_dir, filename) for filename in sorted(os.listdir(img_dir))]
+    else:
+        image_files = img_dir
+
+    for image_file in image_files:
+        if image_file.lower().endswith(IMAGE_EXTENSIONS):
+            with timed("image_optimize"):
+                data, subtype = optimize_image(image_file, max_width, budget_kb)
+            count("image_bytes_total", len(data))
+            yield os.path.basename(image_file), data, subtype
+
+
+def build_message(sender_mail, mail_title, mail_content, images):
+    """
+    Build an HTML message with the given (filename, bytes, subtype) images inline
+    """
     # Root message
     msg_root = MIMEMultipart('related')
     msg_root['Subject'] = Header(mail_title, 'utf-8')
     msg_root['From'] = sender_mail
-    msg_root['To'] = receiver
 
     # Alternative (HTML)
     msg_alt = MIMEMultipart('alternative')
@@ -46,16 +162,14 @@ def send_mail(receiver='', mail_title='', mail_content='', img_dir='../img/'):
     """
 
     # Attach images
-    for i, filename in enumerate(os.listdir(img_dir)):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-            cid = f"img{i}"
-            html += f'<p><img src="cid:{cid}" style="max-width:600px;"></p>'
+    for i, (filename, data, subtype) in enumerate(images):
+        cid = f"img{i}"
+        html += f'<p><img src="cid:{cid}" style="max-width:600px;"></p>'
 
-            with open(os.path.join(img_dir, filename), 'rb') as f:
-                img = MIMEImage(f.read())
-                img.add_header('Content-ID', f'<{cid}>')
-                img.add_header('Content-Disposition', 'inline', filename=filename)
-                msg_root.attach(img)
+        img = MIMEImage(data, _subtype=subtype)
+        img.add_header('Content-ID', f'<{cid}>')
+        img.add_header('Content-Disposition', 'inline', filename=filename)
+        msg_root.attach(img)
 
     html += """
       </body>
@@ -63,37 +177,124 @@ def send_mail(receiver='', mail_title='', mail_content='', img_dir='../img/'):
     """
 
     msg_alt.attach(MIMEText(html, 'html', 'utf-8'))
+    return msg_root
+
+
+def iter_messages(sender_mail, mail_title, mail_content, img_dir, max_message_mb=10, max_width=1200, budget_kb=300):
+    """
+    Yield messages as they are assembled, splitting the images across several
+    messages so that none exceeds max_message_mb
+
+    Images are optimized one at a time and a message is yielded (and can be
+    sent and released) as soon as it is full, so a large report never has to
+    sit in memory as a whole. Base64 inflates attachments by 4/3, which is
+    accounted for in the size limit.
+    """
+    limit = max_message_mb * 1024 * 1024
+    batch, batch_size, part = [], 0, 1
 
-    smtp.sendmail(sender_mail, receiver, msg_root.as_string())
-    smtp.quit()
+    for image in iter_images(img_dir, max_width, budget_kb):
+        encoded_size = len(image[1]) * 4 // 3
+        if batch and batch_size + encoded_size > limit:
+            yield build_message(sender_mail, f"{mail_title} (part {part})", mail_content, batch)
+            batch, batch_size, part = [], 0, part + 1
+        batch.append(image)
+        batch_size += encoded_size
+
+    title = f"{mail_title} (part {part})" if part > 1 else mail_title
+    yield build_message(sender_mail, title, mail_content, batch)
+
+
+def send_mail(receivers, mail_title='', mail_content='', img_dir='../img/', smtp=None, sender=None,
+              max_message_mb=10, max_width=1200, budget_kb=300):
+    """
+    Send the report to every receiver over a single SMTP session
+
+    Args:
+        receivers: a receiver address or a list of addresses
+        img_dir: a folder of images or a list of image files
+        smtp: an open session from open_smtp_session; opened from get_smtp_settings() if not given
+        sender: the sender address (default: SENDER_EMAIL from get_smtp_settings())
+    """
+    settings = get_smtp_settings() if smtp is None or not sender else None
+    sender = sender if sender else settings["sender_mail"]
+    if not sender:
+        raise ValueError("No sender address: pass sender or set SENDER_EMAIL.")
+    if isinstance(receivers, str):
+        receivers = [receiver.strip() for receiver in receivers.split(',') if receiver.strip()]
+
+    own_session = smtp is None
+    if own_session:
+        smtp = open_smtp_session(**settings)
+
+    try:
+        number_of_messages = 0
+        for msg_root in iter_messages(sender, mail_title, mail_content, img_dir,
+                                      max_message_mb, max_width, budget_kb):
+            for receiver in receivers:
+                del msg_root['To']
+                msg_root['To'] = receiver
+                message = msg_root.as_bytes()
+                with track_request("smtp_sendmail"):
+                    smtp.sendmail(sender, receiver, message)
+                count("bytes_sent_total", len(message))
+            number_of_messages += 1
+    finally:
+        if own_session:
+            smtp.quit()
+
+    return number_of_messages
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--date', type=str, default=None, 
+    parser.add_argument('--date', type=str, default=None,
                         help='Date for image folder (default: today)')
+    parser.add_argument('--max_image_width', type=int, default=1200,
+                        help='Downscale inline images to at most this width in pixels (default: 1200)')
+    parser.add_argument('--image_budget_kb', type=int, default=300,
+                        help='Target size per inline image in KB (default: 300)')
+    parser.add_argument('--max_message_mb', type=float, default=10,
+                        help='Split the report into several messages above this size in MB (default: 10)')
+    parser.add_argument('--delta', action='store_true',
+                        help='Only report the stocks that changed since the previous screen, with their charts')
+    add_profile_arguments(parser)
     args = parser.parse_args()
 
+    start_run("email")
+    if args.profile:
+        start_profiling("email", args.profile_memory, args.profile_top)
     load_dotenv()
-    
+
     today = datetime.now().strftime('%Y%m%d')
     date = args.date if args.date else today
 
-    # qq mail sending server
-    host_server = os.getenv("SMTP_SERVER")
-    sender_mail = os.getenv("SENDER_EMAIL")
-    sender_passcode = os.getenv("EMAIL_AUTH_CODE")
-
-    # receiver mail
+    # receiver mail(s), comma-separated
     receiver = os.getenv("RECEIVER_EMAIL")
     # mail title
     mail_title = f'Stock Analytics Results by {date}'
-    # load the results
-    number_of_stocks, stock_codes = load_stock_codes()
-    # mail contents
-    mail_content = f'The analysis results by {date} are: \n' + \
-    f'There are {number_of_stocks} stocks in total and \n' + \
-    f'The stock codes are: {stock_codes}.'
-
-    send_mail(receiver=receiver, mail_title=mail_title, mail_content=mail_content, img_dir=f'../img/{date}')
-    print('Email sent successfully.')
\ No newline at end of file
+    img_dir = f'../img/{date}'
+    if args.delta:
+        # mail contents: only the changes, with the charts of the changed stocks
+        mail_content, changed_codes = load_screen_delta(date)
+        img_dir = [os.path.join(img_dir, filename) for filename in sorted(os.listdir(img_dir))
+                   if any(f'_{code}_' in filename for code in changed_codes)]
+    else:
+        # load the results
+        number_of_stocks, stock_codes = load_stock_codes(date)
+        # mail contents
+        mail_content = f'The analysis results by {date} are: \n' + \
+        f'There are {number_of_stocks} stocks in total and \n' + \
+        f'The stock codes are: {stock_codes}.'
+        img_dir = [os.path.join(img_dir, filename) for filename in sorted(os.listdir(img_dir))]
+
+    # where the whole market stands, ahead of the stocks
+    market_content, market_images = load_market_section()
+    if market_content:
+        mail_content = f'{mail_content}<br><br>{market_content}'
+    img_dir = market_images + img_dir
+
+    number_of_messages = send_mail(receivers=receiver, mail_title=mail_title, mail_content=mail_content,
+                                   img_dir=img_dir, max_message_mb=args.max_message_mb,
+                                   max_width=args.max_image_width, budget_kb=args.image_budget_kb)
+    print(f'Email sent successfully ({number_of_messages} message(s)).')
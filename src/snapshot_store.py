@@ -0,0 +1,342 @@
+import os
+import re
+import io
+import json
+import zlib
+import sqlite3
+import hashlib
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from run_metrics import timed, count
+
+# Dated-folder datasets of the legacy scripts (querying_data.py, calculation_and_visualization.py):
+# one full copy of every stock's file per run date in {root}/{YYYYMMDD}/
+SNAPSHOT_DATASETS = {
+    "price": "../data/input/price-data",
+    "financial": "../data/input/financial-indicators",
+    "valuation": "../data/processed/stock-valuation",
+}
+
+# Content-addressed store of those folders: every file is kept as a list of chunks of
+# CHUNK_ROWS lines, and a chunk already stored for any date or stock is not stored again
+SNAPSHOT_STORE_FILE = "../data/snapshot-store/snapshots.db"
+CHUNK_ROWS = 64
+
+SCHEMA = [
+    # zlib-compressed lines, keyed by the digest of their text
+    "CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, digest BLOB NOT NULL UNIQUE, data BLOB NOT NULL)",
+    # one row per file of a dated folder: how to put it back together from its chunks
+    "CREATE TABLE IF NOT EXISTS files ("
+    "dataset TEXT NOT NULL, date TEXT NOT NULL, name TEXT NOT NULL, header TEXT NOT NULL, "
+    "constants TEXT NOT NULL, trailing_newline INTEGER NOT NULL, chunk_ids BLOB NOT NULL, "
+    "size INTEGER NOT NULL, digest BLOB NOT NULL, "
+    "PRIMARY KEY (dataset, date, name)) WITHOUT ROWID",
+    # one row per folded folder, with what it cost to store
+    "CREATE TABLE IF NOT EXISTS snapshots ("
+    "dataset TEXT NOT NULL, date TEXT NOT NULL, files INTEGER, size INTEGER, new_chunks INTEGER, "
+    "stored_size INTEGER, added_at TEXT, PRIMARY KEY (dataset, date))",
+]
+
+# Chunks known to the store when a migration started, set in every worker
+KNOWN_DIGESTS = set()
+
+
+def connect(store_file=SNAPSHOT_STORE_FILE, read_only=False):
+    """Open the snapshot store, creating its tables when writing"""
+    if read_only:
+        if not os.path.exists(store_file):
+            raise FileNotFoundError("No snapshot store found. Please run `python snapshot_store.py --migrate` first.")
+        return sqlite3.connect(f"file:{store_file}?mode=ro", uri=True)
+    os.makedirs(os.path.dirname(store_file), exist_ok=True)
+    conn = sqlite3.connect(store_file)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def get_digest(data):
+    """Digest of a chunk or file content"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def find_dated_folders(dataset):
+    """Get the dated folders (YYYYMMDD) of a legacy dataset, oldest first"""
+    root = SNAPSHOT_DATASETS[dataset]
+    if not os.path.exists(root):
+        return []
+    return sorted(folder for folder in os.listdir(root)
+                  if re.fullmatch(r"\d{8}", folder) and os.path.isdir(f"{root}/{folder}"))
+
+
+def split_file(path):
+    """
+    Split a CSV file into its header, constant columns and content-addressed chunks
+
+    Columns with the same text in every line (a stock's code, a run's
+    update_date) are kept aside, so the rows of two runs that only differ
+    there still share their chunks. The file is rebuilt byte for byte by
+    join_file(). Chunks already in KNOWN_DIGESTS are not compressed again.
+    Returns: dict with the file's layout, its chunks [(digest, compressed lines or None)] and its digest
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    text = data.decode('utf-8')
+    trailing_newline = text.endswith('\n')
+    lines = (text[:-1] if trailing_newline else text).split('\n')
+    header, lines = lines[0], lines[1:]
+
+    constants = {}
+    fields = [line.split(',') for line in lines]
+    columns = header.count(',') + 1
+    # quoted fields may hold commas: keep such files as they are
+    if len(lines) > 1 and '"' not in text and all(len(row) == columns for row in fields):
+        for column, values in enumerate(zip(*fields)):
+            if values.count(values[0]) == len(values):
+                constants[column] = values[0]
+        if constants:
+            lines = [','.join(value for column, value in enumerate(row) if column not in constants) for row in fields]
+
+    chunks = []
+    for start in range(0, len(lines), CHUNK_ROWS):
+        chunk = '\n'.join(lines[start:start + CHUNK_ROWS]).encode('utf-8')
+        digest = get_digest(chunk)
+        chunks.append((digest, None if digest in KNOWN_DIGESTS else zlib.compress(chunk, 1)))
+    return {"name": os.path.basename(path), "header": header, "constants": json.dumps(constants),
+            "trailing_newline": int(trailing_newline), "chunks": chunks, "size": len(data), "digest": get_digest(data)}
+
+
+def join_file(header, constants, trailing_newline, chunk_texts):
+    """Rebuild a file's text from its header, constant columns and chunk texts"""
+    lines = [line for chunk in chunk_texts for line in chunk.split('\n')]
+    constants = {int(column): value for column, value in json.loads(constants).items()}
+    if constants:
+        columns = header.count(',') + 1
+        rebuilt = []
+        for line in lines:
+            values = iter(line.split(','))
+            rebuilt.append(','.join(constants[column] if column in constants else next(values)
+                                    for column in range(columns)))
+        lines = rebuilt
+    return '\n'.join([header] + lines) + ('\n' if trailing_newline else '')
+
+
+def set_known_digests(digests):
+    """Worker initializer: the chunks the store already holds"""
+    KNOWN_DIGESTS.update(digests)
+
+
+def fold_folder(conn, dataset, date, executor, digest_ids):
+    """
+    Fold one dated folder into the store (one transaction)
+
+    The files are split into chunks by the worker processes; only the chunks
+    the store does not hold yet are written.
+    digest_ids: {digest: chunk id} of the store, updated with the new chunks
+    Returns: (files, new chunks, size of the folder, size of what was written)
+    """
+    folder = f"{SNAPSHOT_DATASETS[dataset]}/{date}"
+    paths = sorted(f"{folder}/{file}" for file in os.listdir(folder) if file.endswith('.csv'))
+
+    new_chunks = size = stored_size = 0
+    rows = []
+    for layout in executor.map(split_file, paths, chunksize=16):
+        chunk_ids = []
+        for digest, compressed in layout["chunks"]:
+            if digest not in digest_ids:
+                if compressed is None:
+                    # known when the migration started, but not any longer: the store changed meanwhile
+                    raise RuntimeError(f"Chunk of {layout['name']} missing from the snapshot store")
+                digest_ids[digest] = conn.execute("INSERT INTO chunks (digest, data) VALUES (?, ?)",
+                                                  (digest, compressed)).lastrowid
+                new_chunks += 1
+                stored_size += len(compressed)
+            chunk_ids.append(digest_ids[digest])
+        rows.append((dataset, date, layout["name"], layout["header"], layout["constants"], layout["trailing_newline"],
+                     np.array(chunk_ids, dtype=np.int64).tobytes(), layout["size"], layout["digest"]))
+        size += layout["size"]
+
+    conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)",
+                 (dataset, date, len(rows), size, new_chunks, stored_size, datetime.now().isoformat(timespec='seconds')))
+    conn.commit()
+    count("chunks_written_total", new_chunks, kind="snapshot_store")
+    return len(rows), new_chunks, size, stored_size
+
+
+def migrate_snapshots(datasets=tuple(SNAPSHOT_DATASETS), workers=None, delete=False, store_file=SNAPSHOT_STORE_FILE):
+    """
+    Fold the dated folders of the legacy datasets into the snapshot store, oldest first
+
+    Folders already in the store are skipped, so the migration can be rerun
+    after new legacy runs. The files are split in parallel worker processes.
+    With delete, a folder (also one folded before) is removed once every one
+    of its files has been read back from the store and matched byte for byte.
+    Returns: {dataset: [dates folded]}
+    """
+    conn = connect(store_file)
+    folded = {}
+    try:
+        digest_ids = dict(conn.execute("SELECT digest, id FROM chunks"))
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_known_digests,
+                                 initargs=(set(digest_ids),)) as executor:
+            for dataset in datasets:
+                stored = {date for (date,) in conn.execute("SELECT date FROM snapshots WHERE dataset = ?", (dataset,))}
+                dates = [date for date in find_dated_folders(dataset) if date not in stored]
+                folded[dataset] = dates
+                if delete:
+                    # folded by an earlier migration
+                    for date in sorted(stored & set(find_dated_folders(dataset))):
+                        delete_folder(dataset, date, store_file)
+                for date in tqdm(dates, desc=f"Folding {dataset} snapshots"):
+                    with timed("fold", kind="snapshot_store"):
+                        files, new_chunks, size, stored_size = fold_folder(conn, dataset, date, executor, digest_ids)
+                    print(f"{dataset} {date}: {files} files, {size / 1e6:.1f} MB, "
+                          f"{new_chunks} new chunks stored in {stored_size / 1e6:.2f} MB")
+                    if delete:
+                        delete_folder(dataset, date, store_file)
+    finally:
+        conn.close()
+    return folded
+
+
+def delete_folder(dataset, date, store_file=SNAPSHOT_STORE_FILE):
+    """
+    Remove the CSV files of a folded folder once all of them read back identical from the store,
+    and the folder itself if nothing else is left in it
+    """
+    folder = f"{SNAPSHOT_DATASETS[dataset]}/{date}"
+    texts = read_snapshot_texts(dataset, date, store_file=store_file)
+    files = [file for file in os.listdir(folder) if file.endswith('.csv')]
+    for file in files:
+        with open(f"{folder}/{file}", 'rb') as f:
+            if file not in texts or texts[file].encode('utf-8') != f.read():
+                raise RuntimeError(f"{folder}/{file} does not match the snapshot store; the folder was kept")
+    for file in files:
+        os.remove(f"{folder}/{file}")
+    if not os.listdir(folder):
+        os.rmdir(folder)
+
+
+def list_snapshots(dataset=None, store_file=SNAPSHOT_STORE_FILE):
+    """
+    List the snapshots of the store
+    Returns: DataFrame with dataset, date, files, size, new_chunks, stored_size and added_at
+    """
+    conn = connect(store_file, read_only=True)
+    try:
+        sql = "SELECT * FROM snapshots" + (" WHERE dataset = ?" if dataset else "") + " ORDER BY dataset, date"
+        return pd.read_sql_query(sql, conn, params=(dataset,) if dataset else ())
+    finally:
+        conn.close()
+
+
+def read_snapshot_texts(dataset, date, codes=None, store_file=SNAPSHOT_STORE_FILE):
+    """
+    Read the files of one snapshot date back from the store
+
+    The chunks of all requested files are fetched in a few batched queries
+    and decompressed once each.
+    codes: only the files of these stock codes (default: all)
+    Returns: {file name: file text}
+    """
+    conn = connect(store_file, read_only=True)
+    try:
+        files = conn.execute("SELECT name, header, constants, trailing_newline, chunk_ids, digest FROM files "
+                             "WHERE dataset = ? AND date = ? ORDER BY name", (dataset, date)).fetchall()
+        if not files:
+            raise FileNotFoundError(f"No {dataset} snapshot of {date} in the snapshot store.")
+        if codes is not None:
+            pattern = re.compile(rf"_(?:[a-z]{{2}})?({'|'.join(map(re.escape, codes))})_\d{{8}}\.csv")
+            files = [file for file in files if pattern.search(file[0])]
+
+        with timed("read", kind="snapshot_store"):
+            chunk_ids = {int(chunk_id) for file in files for chunk_id in np.frombuffer(file[4], dtype=np.int64)}
+            chunks = {}
+            ids = sorted(chunk_ids)
+            for start in range(0, len(ids), 900):
+                batch = ids[start:start + 900]
+                for chunk_id, data in conn.execute(f"SELECT id, data FROM chunks WHERE id IN ({','.join('?' * len(batch))})",
+                                                   batch):
+                    chunks[chunk_id] = zlib.decompress(data).decode('utf-8')
+
+            texts = {}
+            for name, header, constants, trailing_newline, ids_blob, digest in files:
+                text = join_file(header, constants, trailing_newline,
+                                 [chunks[int(chunk_id)] for chunk_id in np.frombuffer(ids_blob, dtype=np.int64)])
+                if get_digest(text.encode('utf-8')) != digest:
+                    raise RuntimeError(f"{name} of the {dataset} snapshot of {date} is corrupted in the snapshot store")
+                texts[name] = text
+    finally:
+        conn.close()
+    return texts
+
+
+def read_snapshot(dataset, date, codes=None, store_file=SNAPSHOT_STORE_FILE):
+    """
+    Read one snapshot date as DataFrames
+    Returns: {file name: DataFrame}
+    """
+    return {name: pd.read_csv(io.StringIO(text))
+            for name, text in read_snapshot_texts(dataset, date, codes, store_file).items()}
+
+
+def materialize_snapshot(dataset, date, output_dir=None, codes=None, store_file=SNAPSHOT_STORE_FILE):
+    """
+    Write one snapshot date back as a dated folder, byte for byte as the legacy scripts wrote it
+
+    output_dir defaults to the folder it came from ({root}/{date}), where
+    calculation_and_visualization.py and the notebooks expect it.
+    Returns: the folder
+    """
+    output_dir = output_dir if output_dir else f"{SNAPSHOT_DATASETS[dataset]}/{date}"
+    texts = read_snapshot_texts(dataset, date, codes, store_file)
+    os.makedirs(output_dir, exist_ok=True)
+    for name, text in texts.items():
+        with open(f"{output_dir}/{name}", 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+    print(f"Materialized {len(texts)} files of the {dataset} snapshot of {date} into {output_dir}")
+    return output_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deduplicating store of the legacy dated-folder datasets")
+    parser.add_argument("--dataset", type=str, default="all",
+                        choices=list(SNAPSHOT_DATASETS) + ['all'],
+                        help="Dataset: price, financial, valuation or all (default)")
+    parser.add_argument("--migrate", action="store_true",
+                        help="Fold the dated folders not in the store yet into it")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes of the migration (default: one per CPU)")
+    parser.add_argument("--delete", action="store_true",
+                        help="Remove each folder once folded and read back identical (with --migrate)")
+    parser.add_argument("--date", type=str, default=None,
+                        help="Materialize the snapshot of this date, YYYYMMDD")
+    parser.add_argument("--codes", type=str, default=None,
+                        help="Only materialize these stock codes, comma-separated (with --date)")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help="Folder to materialize into (default: the dataset's dated folder)")
+
+    args = parser.parse_args()
+
+    datasets = list(SNAPSHOT_DATASETS) if args.dataset == 'all' else [args.dataset]
+    if args.migrate:
+        migrate_snapshots(datasets, args.workers, args.delete)
+    elif args.date:
+        if args.dataset == 'all':
+            parser.error("--date needs a --dataset")
+        codes = [code.strip().zfill(6) for code in args.codes.split(',')] if args.codes else None
+        materialize_snapshot(args.dataset, args.date, args.output_dir, codes)
+    else:
+        snapshots = list_snapshots(None if args.dataset == 'all' else args.dataset)
+        print(snapshots.to_string(index=False))
+        if not snapshots.empty:
+            print(f"{snapshots['size'].sum() / 1e6:.1f} MB of dated folders stored in "
+                  f"{snapshots['stored_size'].sum() / 1e6:.1f} MB of chunks ({SNAPSHOT_STORE_FILE})")
@@ -0,0 +1,126 @@
+import os
+import io
+import time
+import atexit
+import pstats
+import signal
+import cProfile
+import tracemalloc
+from collections import Counter
+
+from run_metrics import get_run_id
+
+# One folder per run, shared with the metrics run id when started under pipeline.py
+PROFILE_DIR = "../data/pipeline/profiles"
+
+# Wall-clock interval of the stack sampler behind the flamegraph, in seconds
+SAMPLE_INTERVAL = 0.005
+# Frames kept per traceback in the memory snapshot: every extra frame slows tracing down a lot
+MEMORY_FRAMES = 1
+
+PROFILE = {}
+
+
+def add_profile_arguments(parser):
+    """Add the --profile options to an entry point's argument parser"""
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the run: cProfile stats, a sampled flamegraph and a top-N summary "
+                             "in data/pipeline/profiles/{run_id}")
+    parser.add_argument("--profile_memory", action="store_true",
+                        help="With --profile, also take a tracemalloc snapshot of the allocations (slower)")
+    parser.add_argument("--profile_top", type=int, default=25,
+                        help="Number of hot functions in the profile summary (default: 25)")
+
+
+def format_frame(frame):
+    """Name a frame as file:function for the folded stacks"""
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+def sample_stack(signum, frame):
+    """Count the folded stack of the main thread (SIGALRM handler)"""
+    names = []
+    while frame is not None:
+        names.append(format_frame(frame))
+        frame = frame.f_back
+    if names:
+        PROFILE["stacks"][";".join(reversed(names))] += 1
+
+
+def start_profiling(stage, memory=False, top_n=25):
+    """
+    Profile the rest of the process and write the results when it exits
+
+    Runs cProfile (exact call counts and times) and samples the main
+    thread's stack on a wall-clock timer (for the flamegraph, so time spent
+    waiting on the network shows up too); with memory, also traces the
+    allocations with tracemalloc. Must be called from the main thread.
+    """
+    run_dir = f"{PROFILE_DIR}/{get_run_id(stage)}"
+    PROFILE.update({"stage": stage, "run_dir": run_dir, "top_n": top_n, "memory": memory,
+                    "stacks": Counter(), "start": time.perf_counter()})
+    if memory:
+        tracemalloc.start(MEMORY_FRAMES)
+    signal.signal(signal.SIGALRM, sample_stack)
+    signal.setitimer(signal.ITIMER_REAL, SAMPLE_INTERVAL, SAMPLE_INTERVAL)
+    PROFILE["profiler"] = cProfile.Profile()
+    PROFILE["profiler"].enable()
+    atexit.register(stop_profiling)
+
+
+def stop_profiling():
+    """
+    Stop profiling and write the run's profile files
+
+    - {stage}-{pid}.pstats: cProfile stats (snakeviz, gprof2dot, pstats)
+    - {stage}-{pid}.folded: sampled stacks in collapsed format (flamegraph.pl, speedscope)
+    - {stage}-{pid}.tracemalloc: the allocation snapshot (tracemalloc.Snapshot.load), with --profile_memory
+    - {stage}-{pid}_summary.txt: the top-N functions by cumulative and own time, by samples,
+      and the top allocation sites
+    """
+    PROFILE["profiler"].disable()
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    elapsed = time.perf_counter() - PROFILE["start"]
+
+    os.makedirs(PROFILE["run_dir"], exist_ok=True)
+    prefix = f"{PROFILE['run_dir']}/{PROFILE['stage']}-{os.getpid()}"
+    top_n = PROFILE["top_n"]
+
+    PROFILE["profiler"].dump_stats(f"{prefix}.pstats")
+    with open(f"{prefix}.folded", 'w') as f:
+        for stack, samples in PROFILE["stacks"].most_common():
+            f.write(f"{stack} {samples}\n")
+
+    summary = io.StringIO()
+    summary.write(f"Profile of {PROFILE['stage']} (pid {os.getpid()}): {elapsed:.1f}s wall time, "
+                  f"{sum(PROFILE['stacks'].values())} stack samples every {SAMPLE_INTERVAL * 1000:.0f}ms\n")
+    for sort_key, title in [("cumulative", "cumulative time"), ("tottime", "own time")]:
+        summary.write(f"\n=== Top {top_n} functions by {title} ===\n")
+        pstats.Stats(PROFILE["profiler"], stream=summary).strip_dirs().sort_stats(sort_key).print_stats(top_n)
+
+    # a sample's innermost frame is where the time was spent
+    own_samples = Counter()
+    for stack, samples in PROFILE["stacks"].items():
+        own_samples[stack.rsplit(";", 1)[-1]] += samples
+    total = sum(own_samples.values()) or 1
+    summary.write(f"\n=== Top {top_n} functions by samples ===\n")
+    for name, samples in own_samples.most_common(top_n):
+        summary.write(f"{samples:>8} {samples / total * 100:>6.1f}%  {name}\n")
+
+    if PROFILE["memory"]:
+        # leave out the profiler's own bookkeeping
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot.dump(f"{prefix}.tracemalloc")
+        summary.write(f"\n=== Memory: {current / 2**20:.1f} MiB allocated at exit, {peak / 2**20:.1f} MiB peak ===\n")
+        summary.write(f"=== Top {top_n} allocation sites ===\n")
+        for stat in snapshot.statistics("lineno")[:top_n]:
+            summary.write(f"{stat.size / 2**20:>10.2f} MiB {stat.count:>9} blocks  {stat.traceback}\n")
+
+    with open(f"{prefix}_summary.txt", 'w') as f:
+        f.write(summary.getvalue())
+    print(f"Profile written to {prefix}_summary.txt (flamegraph: {prefix}.folded)")
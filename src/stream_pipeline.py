@@ -0,0 +1,171 @@
+import os
+import time
+import queue
+import argparse
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+from query_data_new import (get_stock_list, load_metadata, save_metadata, should_query_price, query_price_for_stock,
+                            STOCK_TYPE_MAPPING)
+from run_metrics import start_run
+from calculation_and_visualization_new import (calculate_stock_value, get_latest_stock_value, load_latest_stock_values,
+                                               screen_best_stocks, publish_valuations)
+
+# Marks the end of the stream for a consumer
+END_OF_STREAM = None
+
+
+def fetch_worker(fetch_queue, value_queue, metadata, metadata_lock, stats, today, max_attempts):
+    """
+    Fetch stocks from fetch_queue and hand each one to the valuation step as soon as it lands
+
+    Blocks on value_queue when valuation falls behind (backpressure). Failed
+    stocks are put back on fetch_queue until max_attempts is reached.
+    """
+    while True:
+        item = fetch_queue.get()
+        if item is END_OF_STREAM:
+            return
+        stock_code, last_date, attempt = item
+        try:
+            query_price_for_stock(stock_code, last_date, "../data/input/price-data/all", today)
+        except Exception as e:
+            if attempt < max_attempts:
+                fetch_queue.put((stock_code, last_date, attempt + 1))
+            else:
+                with metadata_lock:
+                    stats['failed'].append(stock_code)
+                    stats['pending'] -= 1
+            continue
+
+        with metadata_lock:
+            metadata["price"][stock_code] = datetime.now().strftime("%Y-%m-%d")
+            stats['first_fetched'] = stats['first_fetched'] or time.perf_counter()
+            stats['fetched'] += 1
+            stats['pending'] -= 1
+        value_queue.put(stock_code)
+
+
+def value_worker(value_queue, snapshot, snapshot_lock, stats, today):
+    """
+    Value each fetched stock and update its row of the in-memory snapshot
+    """
+    while True:
+        stock_code = value_queue.get()
+        if stock_code is END_OF_STREAM:
+            return
+        try:
+            stock_value = calculate_stock_value(stock_code, today)
+        except Exception as e:
+            print(f"Valuation failed for {stock_code}: {e}")
+            continue
+        if stock_value is None or stock_value.empty:
+            continue
+        latest = get_latest_stock_value(stock_value)
+        with snapshot_lock:
+            snapshot[latest['code']] = latest
+            stats['valued'].append(stock_code)
+
+
+def run_stream(stock_type="all", threshold=0.26, fetch_workers=2, value_workers=1, queue_size=64, force=False,
+               max_attempts=3):
+    """
+    Fetch, value and screen in one streaming pass
+
+    Fetch workers feed a bounded queue that valuation workers drain, so
+    network, parsing and valuation overlap and at most queue_size fetched
+    stocks wait for valuation. The snapshot of latest values is loaded once
+    and updated in memory per valued stock; the screen runs on it as soon as
+    the last stock is valued, without listing or rereading the valuation
+    folder.
+    """
+    start = time.perf_counter()
+    today = datetime.now().strftime("%Y%m%d")
+
+    stocks_df = get_stock_list(stock_type)
+    metadata = load_metadata()
+    stocks_to_update = []
+    for stock_code in stocks_df['code']:
+        should_query, last_date = should_query_price(metadata, stock_code, force)
+        if should_query:
+            stocks_to_update.append((stock_code, last_date))
+    print(f"Total stocks: {len(stocks_df)}, Need to update: {len(stocks_to_update)}")
+
+    snapshot = {}
+    if os.path.isdir("../data/processed/stock-valuation/all") and os.listdir("../data/processed/stock-valuation/all"):
+        snapshot = {row['code']: row for _, row in load_latest_stock_values().iterrows()}
+
+    fetch_queue = queue.Queue()
+    value_queue = queue.Queue(maxsize=queue_size)
+    metadata_lock = threading.Lock()
+    snapshot_lock = threading.Lock()
+    stats = {"fetched": 0, "valued": [], "failed": [], "pending": len(stocks_to_update), "first_fetched": None}
+
+    for stock_code, last_date in stocks_to_update:
+        fetch_queue.put((stock_code, last_date, 1))
+
+    fetchers = [threading.Thread(target=fetch_worker, args=(fetch_queue, value_queue, metadata, metadata_lock,
+                                                            stats, today, max_attempts))
+                for _ in range(fetch_workers)]
+    valuers = [threading.Thread(target=value_worker, args=(value_queue, snapshot, snapshot_lock, stats, today))
+               for _ in range(value_workers)]
+    for thread in fetchers + valuers:
+        thread.start()
+
+    # Retries are put back on the fetch queue, so wait until every stock is fetched or given up
+    while True:
+        with metadata_lock:
+            if stats['pending'] == 0:
+                break
+        time.sleep(0.05)
+    fetch_done = time.perf_counter()
+
+    for _ in fetchers:
+        fetch_queue.put(END_OF_STREAM)
+    for thread in fetchers:
+        thread.join()
+    for _ in valuers:
+        value_queue.put(END_OF_STREAM)
+    for thread in valuers:
+        thread.join()
+
+    save_metadata(metadata, "price")
+    # marker, SQL database and shared panel, as after the value step
+    publish_valuations(stats['valued'])
+
+    stock_values = pd.DataFrame(list(snapshot.values()))
+    screened = screen_best_stocks(threshold, stock_values) if len(stock_values) else []
+    end = time.perf_counter()
+
+    print(f"Fetched {stats['fetched']} stocks, valued {len(stats['valued'])}, failed {len(stats['failed'])}: {stats['failed']}")
+    first = stats['first_fetched'] or start
+    print(f"Fetch: {fetch_done - start:.1f}s, first fetched stock to screen: {end - first:.1f}s, "
+          f"screen ready {end - fetch_done:.1f}s after the last fetch.")
+    return screened
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch prices, value and screen in one streaming pass")
+    parser.add_argument("--stock_type", type=str, default="all",
+                        choices=list(STOCK_TYPE_MAPPING),
+                        help="Stock list to update (default: all)")
+    parser.add_argument("--threshold", type=float, default=0.26,
+                        help="The threshold value for filtering stocks")
+    parser.add_argument("--fetch_workers", type=int, default=2,
+                        help="Number of concurrent price requests (default: 2)")
+    parser.add_argument("--value_workers", type=int, default=1,
+                        help="Number of valuation workers (default: 1)")
+    parser.add_argument("--queue_size", type=int, default=64,
+                        help="Fetched stocks that may wait for valuation before fetching pauses (default: 64)")
+    parser.add_argument("--max_attempts", type=int, default=3,
+                        help="Attempts per stock before it is reported as failed (default: 3)")
+    parser.add_argument("--force", action="store_true",
+                        help="Fetch all stocks, ignoring last update time")
+
+    args = parser.parse_args()
+
+    start_run("stream")
+    run_stream(args.stock_type, args.threshold, args.fetch_workers, args.value_workers, args.queue_size,
+               args.force, args.max_attempts)
@@ -0,0 +1,244 @@
+import os
+import re
+import json
+import tempfile
+import argparse
+
+import numpy as np
+import pandas as pd
+
+STOCK_TYPE_MAPPING = {
+    "hongli": "../data/input/hongli_list_20251213.csv",
+    "honglidibo": "../data/input/honglidibo_list_20251213.csv",
+    "hs300": "../data/input/hs300_list_20251213.csv",
+    "zz500": "../data/input/zz500_list_20251216.csv",
+    "portfolio": ["600519", "000858", "600938", "000333", "600926", "300866", "600900", "601128"],
+    "all": "../data/input/stock_names_full.csv",
+}
+
+# Every known code with a dense integer id (its position in the sorted codes), its exchange,
+# its name and one membership bitset per universe; rebuilt when a stock list changes
+SYMBOL_TABLE_FILE = "../data/input/symbol_table.npz"
+
+# Exchange prefixes of format_symbol, stored per stock as an index into this list
+EXCHANGES = ['sh', 'sz', 'bj']
+
+# Symbol table loaded in this process; replaced as a whole when a stock list changes
+SYMBOLS = {}
+
+
+def format_symbol(code):
+    """
+    Format stock symbol with proper prefix based on code
+    """
+    if code.startswith('6'):
+        return f'sh{code}'
+    elif code.startswith('9') or code.startswith('4'):
+        return f'bj{code}'
+    else:
+        return f'sz{code}'
+
+
+def read_universe(stock_type):
+    """
+    Read the stock list of a universe from its source
+    Returns: DataFrame with the zero-padded code and the list's other columns
+    """
+    if stock_type == "zz500":
+        df = pd.read_csv(STOCK_TYPE_MAPPING[stock_type], sep='\t')
+    elif stock_type == "portfolio":
+        df = pd.DataFrame(STOCK_TYPE_MAPPING[stock_type], columns=['code'])
+    else:
+        df = pd.read_csv(STOCK_TYPE_MAPPING[stock_type])
+
+    df['code'] = df['code'].astype(str).str.zfill(6)
+    return df
+
+
+def get_sources_key():
+    """Describe the stock lists (size and modification time) and the portfolio the table is built from"""
+    sources = {}
+    for stock_type, source in STOCK_TYPE_MAPPING.items():
+        if isinstance(source, list):
+            sources[stock_type] = source
+        elif os.path.exists(source):
+            stat = os.stat(source)
+            sources[stock_type] = [stat.st_size, stat.st_mtime_ns]
+    return json.dumps(sources, sort_keys=True)
+
+
+def build_symbol_table():
+    """
+    Build the symbol table from the stock lists and cache it on disk
+
+    Stocks of the lists that are missing from the full list get an id too
+    (named "Unknown"), so every universe member can be looked up.
+    """
+    universes = {stock_type: read_universe(stock_type) for stock_type in STOCK_TYPE_MAPPING
+                 if isinstance(STOCK_TYPE_MAPPING[stock_type], list) or os.path.exists(STOCK_TYPE_MAPPING[stock_type])}
+    codes = np.unique(np.concatenate([df['code'].to_numpy(dtype='U6') for df in universes.values()]))
+
+    names = np.full(len(codes), "Unknown", dtype=object)
+    for df in universes.values():
+        if 'name' in df.columns:
+            names[np.searchsorted(codes, df['code'].to_numpy(dtype='U6'))] = df['name'].astype(str).to_numpy()
+
+    bits = np.zeros((len(universes), (len(codes) + 7) // 8), dtype=np.uint8)
+    for row, df in enumerate(universes.values()):
+        members = np.zeros(len(codes), dtype=bool)
+        members[np.searchsorted(codes, df['code'].to_numpy(dtype='U6'))] = True
+        bits[row] = np.packbits(members)
+
+    table = {
+        "codes": codes,
+        "numbers": codes.astype(np.int32),
+        "exchange": np.array([EXCHANGES.index(format_symbol(code)[:2]) for code in codes], dtype=np.uint8),
+        "names": names.astype(str),
+        "universes": np.array(list(universes)),
+        "bits": bits,
+        "sources": np.array(get_sources_key()),
+    }
+    os.makedirs(os.path.dirname(SYMBOL_TABLE_FILE), exist_ok=True)
+    # a temporary file of its own per writer: processes building the table at the same time each replace it whole
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(SYMBOL_TABLE_FILE), suffix=".tmp.npz")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **table)
+        os.replace(tmp_file, SYMBOL_TABLE_FILE)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    return table
+
+
+def load_symbol_table(rebuild=False):
+    """
+    Load the symbol table, building it when it is missing or a stock list changed since
+
+    The table is loaded once per process.
+    Returns: dict with codes (sorted, the id is the position), numbers (int32 codes),
+             exchange (index into EXCHANGES), names, and bits ({universe: packed membership bits})
+    """
+    sources = get_sources_key()
+    current = SYMBOLS.get("current")
+    if not rebuild and current is not None and current["sources"] == sources:
+        return current
+
+    table = None
+    if not rebuild and os.path.exists(SYMBOL_TABLE_FILE):
+        with np.load(SYMBOL_TABLE_FILE) as archive:
+            if str(archive['sources']) == sources:
+                table = {key: archive[key] for key in archive.files}
+    if table is None:
+        table = build_symbol_table()
+
+    SYMBOLS["current"] = {
+        "codes": table['codes'],
+        "numbers": table['numbers'],
+        "exchange": table['exchange'],
+        "names": table['names'],
+        "bits": dict(zip(table['universes'].tolist(), table['bits'])),
+        "sources": sources,
+    }
+    return SYMBOLS["current"]
+
+
+def get_ids(codes, table=None):
+    """
+    Get the ids of stock codes, given as zero-padded strings or as integers
+    Returns: int32 array of ids, -1 for codes that are not in the table
+    """
+    table = load_symbol_table() if table is None else table
+    codes = np.asarray(codes)
+    keys = table['numbers'] if codes.dtype.kind in 'iu' else table['codes']
+    codes = codes if codes.dtype.kind in 'iu' else codes.astype('U6')
+    positions = np.minimum(np.searchsorted(keys, codes), len(keys) - 1)
+    return np.where(keys[positions] == codes, positions, -1).astype(np.int32)
+
+
+def get_codes(ids, table=None):
+    """Get the zero-padded codes of ids"""
+    table = load_symbol_table() if table is None else table
+    return table['codes'][ids]
+
+
+def get_names(ids, table=None):
+    """Get the names of ids ("Unknown" for -1)"""
+    table = load_symbol_table() if table is None else table
+    ids = np.asarray(ids)
+    return np.where(ids >= 0, table['names'][ids], "Unknown")
+
+
+def get_name(stock_code):
+    """Get the name of one stock code, or "Unknown" """
+    return str(get_names(get_ids([str(stock_code).zfill(6)]))[0])
+
+
+def get_symbols(ids, table=None):
+    """Get the exchange-prefixed symbols of ids (see format_symbol)"""
+    table = load_symbol_table() if table is None else table
+    return np.char.add(np.array(EXCHANGES)[table['exchange'][ids]], table['codes'][ids])
+
+
+def get_universe_bits(expression, table=None):
+    """
+    Evaluate a universe expression into packed membership bits
+
+    The expression combines universes from left to right with '&'
+    (intersection), '|' (union) and '-' (difference), e.g. 'hs300&hongli'
+    or 'hs300|zz500-portfolio'; a single universe name is an expression too.
+    """
+    table = load_symbol_table() if table is None else table
+    tokens = re.split(r"\s*([&|-])\s*", expression.strip())
+    unknown = [name for name in tokens[::2] if name not in table['bits']]
+    if unknown:
+        raise ValueError(f"Unknown universe: {unknown}. Choose from {list(table['bits'])}.")
+
+    bits = table['bits'][tokens[0]]
+    for operator, name in zip(tokens[1::2], tokens[2::2]):
+        if operator == '&':
+            bits = bits & table['bits'][name]
+        elif operator == '|':
+            bits = bits | table['bits'][name]
+        else:
+            bits = bits & ~table['bits'][name]
+    return bits
+
+
+def is_member(ids, expression, table=None):
+    """Test which ids belong to a universe expression (ids of -1 never do)"""
+    table = load_symbol_table() if table is None else table
+    ids = np.asarray(ids)
+    members = np.unpackbits(get_universe_bits(expression, table), count=len(table['codes'])).astype(bool)
+    return (ids >= 0) & members[ids]
+
+
+def get_universe_ids(expression, table=None):
+    """Get the ids of the members of a universe expression"""
+    table = load_symbol_table() if table is None else table
+    return np.flatnonzero(np.unpackbits(get_universe_bits(expression, table), count=len(table['codes']))).astype(np.int32)
+
+
+def get_universe_codes(expression):
+    """Get the codes of the members of a universe expression, sorted"""
+    table = load_symbol_table()
+    return get_codes(get_universe_ids(expression, table), table).tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the symbol table and list the members of a universe")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Rebuild the table even if no stock list changed")
+    parser.add_argument("--universe", type=str, default=None,
+                        help="List the members of a universe expression, e.g. 'hs300&hongli' or 'hs300|zz500-portfolio'")
+
+    args = parser.parse_args()
+
+    table = load_symbol_table(rebuild=args.rebuild)
+    print(f"Symbol table: {len(table['codes'])} stocks, universes "
+          + ", ".join(f"{name} ({np.unpackbits(bits, count=len(table['codes'])).sum()})" for name, bits in table['bits'].items()))
+    if args.universe:
+        ids = get_universe_ids(args.universe, table)
+        print(f"{args.universe}: {len(ids)} stocks")
+        for code, symbol, name in zip(get_codes(ids, table), get_symbols(ids, table), get_names(ids, table)):
+            print(f"  {code}  {symbol}  {name}")
@@ -0,0 +1,197 @@
+import os
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from financial_store import compact_financials, save_financials
+from price_rollup import rollup_prices, save_rollup
+
+# Markets are generated into {BENCHMARK_DIR}/market_{stocks}/data in the project's layout;
+# scripts run with {BENCHMARK_DIR}/market_{stocks}/src as working directory read them through ../data
+BENCHMARK_DIR = "../data/benchmark"
+
+# Benchmark scales: number of stocks
+SCALES = [300, 1000, 5000, 10000]
+
+# Share of the listed stocks in each index list, and the list files as query_data_new.py expects them
+STOCK_LISTS = {
+    "hs300_list_20251213.csv": 300,
+    "zz500_list_20251216.csv": 500,
+    "hongli_list_20251213.csv": 100,
+    "honglidibo_list_20251213.csv": 50,
+}
+
+# Number of industries of the synthetic industry classification (uneven sizes, like a real market)
+INDUSTRIES = 30
+
+
+def get_market_dir(stocks, benchmark_dir=BENCHMARK_DIR):
+    """Get the folder of the synthetic market with the given number of stocks"""
+    return f"{benchmark_dir}/market_{stocks}"
+
+
+def make_codes(stocks, rng):
+    """
+    Make stock codes with the exchange mix of the A-share market
+    (about 45% Shanghai 6xxxxx, 40% Shenzhen 00xxxx/30xxxx, the rest Beijing 8xxxxx/4xxxxx)
+    """
+    exchange = rng.choice(4, size=stocks, p=[0.45, 0.25, 0.15, 0.15])
+    bases = np.array([600000, 1, 300001, 830000])
+    codes = []
+    offsets = np.zeros(4, dtype=int)
+    for board in exchange:
+        codes.append(str(bases[board] + offsets[board]).zfill(6))
+        offsets[board] += 1
+    return sorted(codes)
+
+
+def make_trading_days(years, end=None):
+    """Weekdays of the last `years` years, without the Spring Festival and National Day holiday weeks"""
+    end = pd.Timestamp(end if end else datetime.now().strftime("%Y-%m-%d"))
+    days = pd.bdate_range(end - pd.DateOffset(years=years), end)
+    holiday = ((days.month == 10) & (days.day <= 7)) | ((days.month == 2) & (days.day >= 10) & (days.day <= 16))
+    return days[~holiday]
+
+
+def make_prices(days, rng):
+    """
+    Simulate one stock's raw daily OHLC bars as a geometric random walk
+
+    Some stocks list later than the first day, and some have a suspension window without bars.
+    """
+    start = rng.integers(0, len(days) // 2) if rng.random() < 0.25 else 0
+    keep = np.zeros(len(days), dtype=bool)
+    keep[start:] = True
+    if rng.random() < 0.05:
+        suspension = rng.integers(start, len(days) - 30)
+        keep[suspension:suspension + rng.integers(5, 30)] = False
+
+    n = keep.sum()
+    volatility = rng.uniform(0.012, 0.035)
+    returns = rng.normal(rng.uniform(-0.0001, 0.0004), volatility, n)
+    close = rng.uniform(3, 80) * np.exp(np.cumsum(returns))
+    open_ = close * np.exp(rng.normal(0, volatility / 2, n))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, volatility / 2, n)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, volatility / 2, n)))
+    return pd.DataFrame({'report_date': days[keep].strftime('%Y-%m-%d'),
+                         'open': open_.round(2), 'high': high.round(2), 'low': low.round(2), 'close': close.round(2)})
+
+
+def make_financials(price_df, rng):
+    """
+    Simulate one stock's quarterly indicators consistent with its prices
+
+    Earnings follow a target PE with noise (about one stock in ten makes
+    losses for a while), book value grows with retained earnings; the TTM
+    columns are computed as query_data_new.py does.
+    """
+    quarters = pd.date_range(pd.Timestamp(price_df['report_date'].iloc[0]) - pd.DateOffset(years=1),
+                             price_df['report_date'].iloc[-1], freq='QE')
+    quarter_close = price_df.set_index(pd.to_datetime(price_df['report_date']))['close'] \
+        .reindex(quarters, method='nearest').to_numpy()
+
+    target_pe = rng.lognormal(np.log(18), 0.5)
+    eps = quarter_close / target_pe / 4 * rng.lognormal(0, 0.25, len(quarters))
+    if rng.random() < 0.1:
+        loss = rng.integers(0, len(quarters))
+        eps[loss:loss + rng.integers(2, 8)] *= -1
+    bps = quarter_close / rng.lognormal(np.log(2), 0.4) + np.cumsum(eps) * 0.5
+    bps = np.maximum(bps, 0.5)
+
+    financial_df = pd.DataFrame({'report_date': quarters, 'bps': bps.round(4), 'eps': eps.round(4)})
+    financial_df['roe'] = (financial_df['eps'] / financial_df['bps'] * 100).round(2)
+    financial_df['bps_ttm'] = financial_df['bps'].rolling(window=4).mean()
+    financial_df['eps_ttm'] = financial_df['eps'].rolling(window=4).sum()
+    financial_df['roe_ttm'] = financial_df['roe'].rolling(window=4).sum()
+    return compact_financials(financial_df.dropna())
+
+
+def stamp_query_metadata(market_dir, codes=None):
+    """
+    Mark every stock of a market as queried today, so the incremental queries have nothing to fetch
+
+    The price query refetches stocks last updated a day or more ago: a market
+    generated on an earlier day is stamped again before the queries run on it.
+    codes: the market's stocks (default: those of its stock_names_full.csv)
+    """
+    input_dir = f"{market_dir}/data/input"
+    if codes is None:
+        codes = pd.read_csv(f"{input_dir}/stock_names_full.csv", dtype={'code': str})['code'].tolist()
+    updated = datetime.now().strftime("%Y-%m-%d")
+    with open(f"{input_dir}/query_metadata.json", 'w') as f:
+        json.dump({"financial": {code: updated for code in codes}, "price": {code: updated for code in codes}}, f)
+
+
+def generate_market(stocks, years=15, seed=42, end_date=None, benchmark_dir=BENCHMARK_DIR, with_valuation=True):
+    """
+    Write a synthetic market of the given size in the project's current layout
+
+    Writes the stock lists, an industry classification, daily prices with
+    their monthly rollups, the reported quarters, an up-to-date query metadata file and, with
+    with_valuation, the valuation files (calculated by the valuation step
+    itself). The history ends on end_date (default: today); the same size,
+    seed and end date always give the same market.
+    Returns: the market folder
+    """
+    market_dir = get_market_dir(stocks, benchmark_dir)
+    input_dir = f"{market_dir}/data/input"
+    for folder in ["price-data/all", "price-data/monthly", "financial-indicators/all"]:
+        os.makedirs(f"{input_dir}/{folder}", exist_ok=True)
+    os.makedirs(f"{market_dir}/src", exist_ok=True)
+    os.makedirs(f"{market_dir}/img", exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    codes = make_codes(stocks, rng)
+    days = make_trading_days(years, end_date)
+
+    pd.DataFrame({'code': codes, 'name': [f"合成{i:05d}" for i in range(stocks)]}) \
+        .to_csv(f"{input_dir}/stock_names_full.csv", index=False)
+    for list_file, size in STOCK_LISTS.items():
+        members = pd.DataFrame({'code': sorted(rng.choice(codes, size=min(size, stocks), replace=False))})
+        members.to_csv(f"{input_dir}/{list_file}", index=False, sep='\t' if list_file.startswith("zz500") else ',')
+    industries = rng.choice(INDUSTRIES, size=stocks, p=rng.dirichlet(np.ones(INDUSTRIES)))
+    pd.DataFrame({'code': codes, 'industry': [f"合成行业{i:02d}" for i in industries]}) \
+        .to_csv(f"{input_dir}/industry_classification.csv", index=False)
+
+    for code in tqdm(codes, desc=f"Generating {stocks} stocks"):
+        stock_rng = np.random.default_rng([seed, int(code)])
+        price_df = make_prices(days, stock_rng)
+        price_df.to_csv(f"{input_dir}/price-data/all/price_data_{code}.csv", index=False)
+        save_rollup(rollup_prices(price_df, "monthly"), f"{input_dir}/price-data/monthly/price_monthly_{code}.csv")
+        save_financials(make_financials(price_df, stock_rng), f"{input_dir}/financial-indicators/all/financial_indicators_{code}.csv")
+
+    stamp_query_metadata(market_dir, codes)
+
+    if with_valuation:
+        cwd = os.getcwd()
+        os.chdir(f"{market_dir}/src")
+        try:
+            from calculation_and_visualization_new import calculate_stock_values
+            calculate_stock_values(codes)
+        finally:
+            os.chdir(cwd)
+    return market_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a seeded synthetic market in the project's data layout for benchmarks")
+    parser.add_argument("--stocks", type=int, default=1000,
+                        help=f"Number of stocks (benchmark scales: {SCALES})")
+    parser.add_argument("--years", type=int, default=15,
+                        help="Years of daily history (default: 15)")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="Random seed (default: 42)")
+    parser.add_argument("--end_date", type=str, default=None,
+                        help="Last day of the history, YYYY-MM-DD (default: today)")
+    parser.add_argument("--no_valuation", action="store_true",
+                        help="Don't calculate the valuation files")
+
+    args = parser.parse_args()
+
+    market_dir = generate_market(args.stocks, args.years, args.seed, args.end_date,
+                                 with_valuation=not args.no_valuation)
+    print(f"Synthetic market of {args.stocks} stocks x {args.years} years written to {market_dir}")
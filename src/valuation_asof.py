@@ -0,0 +1,288 @@
+import os
+import argparse
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from daily_valuation import (load_daily_store, list_daily_codes, join_daily_asof, store_to_frame, to_days,
+                             DAYS_PER_CODE, PRICE_DIR, VALUE_COLUMNS)
+from financial_store import load_financials, join_financials_asof
+from price_rollup import load_rollup
+from market_panel import attach_panel, detach_panel, read_valuation_panel, get_valuation_mode, PANEL_COLUMNS
+from valuation_stream import VALUATION_DIR
+
+# As-of queries only use the quarters announced by the as-of day: matching by period end would
+# show a quarter's results up to four months before they were published. Valuations computed
+# by period end are not used for them
+AS_OF_FINANCIAL_DATE = "announce_date"
+
+
+def parse_as_of(as_of):
+    """
+    Convert an as-of month 'YYYY-MM' to its last day
+    Returns: int32 days since 1970-01-01
+    """
+    try:
+        month = datetime.strptime(as_of, "%Y-%m")
+    except ValueError:
+        raise ValueError(f"Invalid as-of month '{as_of}', expected YYYY-MM")
+    return to_days([pd.Timestamp(month) + pd.offsets.MonthEnd(0)])[0]
+
+
+def get_date_keys(history):
+    """
+    Get the date index of a history: one sorted int64 (stock, day) key per row
+
+    The index is built once and kept in the history.
+    """
+    if "keys" not in history:
+        counts = np.diff(history["offsets"])
+        history["keys"] = np.repeat(np.arange(len(counts), dtype=np.int64), counts) * DAYS_PER_CODE + history["date"]
+    return history["keys"]
+
+
+def find_as_of_rows(history, day):
+    """
+    Find the last row of every stock on or before a day
+
+    history holds the rows of codes[i] at offsets[i]:offsets[i + 1], sorted
+    by date (a market panel or the daily archive); a single searchsorted
+    over the date index answers all stocks at once.
+    Returns: (stock positions, rows) of the stocks with a row on or before the day
+    """
+    stocks = np.arange(len(history["codes"]), dtype=np.int64)
+    rows = np.searchsorted(get_date_keys(history), stocks * DAYS_PER_CODE + day, side='right') - 1
+    found = rows >= history["offsets"][:-1]
+    return stocks[found], rows[found]
+
+
+def get_as_of_values(history, day, columns):
+    """
+    Get the row of every stock as of a day, together with the 25th and 75th
+    percentiles of the stock's own pr_ttm history up to that day
+    Returns: DataFrame like valuation_stream.scan_latest_values(), empty if no stock has a row by then
+    """
+    stocks, rows = find_as_of_rows(history, day)
+    if len(stocks) == 0:
+        return pd.DataFrame(columns=['code', 'report_date'] + list(columns) + ['pr_ttm_q25', 'pr_ttm_q75'])
+    values = pd.DataFrame({'code': history["codes"][stocks].astype(object),
+                           'report_date': np.datetime_as_string(history["date"][rows].astype('datetime64[D]'))})
+    for column in columns:
+        values[column] = history[column][rows]
+
+    counts = np.diff(history["offsets"])
+    in_range = history["date"] <= day
+    pr_ttm = pd.Series(history["pr_ttm"][in_range].astype(np.float64))
+    quantiles = pr_ttm.groupby(np.repeat(np.arange(len(counts)), counts)[in_range]).quantile([0.25, 0.75]).unstack()
+    values['pr_ttm_q25'] = quantiles.loc[stocks, 0.25].to_numpy()
+    values['pr_ttm_q75'] = quantiles.loc[stocks, 0.75].to_numpy()
+    return values
+
+
+def read_announced_history(stock_codes=None):
+    """
+    Value every stock's monthly bars against the quarters announced by each month end
+
+    The monthly rollups and reported quarters are read into flat arrays and
+    joined for all stocks at once (daily_valuation.join_daily_asof), like
+    the value step with --financial_date announce_date.
+    Returns: {codes, offsets, date, <VALUE_COLUMNS>}, the rows of codes[i] at offsets[i]:offsets[i + 1]
+    """
+    stock_codes = list_daily_codes() if stock_codes is None else sorted(stock_codes)
+    price_parts, financial_parts = [], []
+    for code_id, stock_code in enumerate(tqdm(stock_codes, desc="Reading monthly prices and financials",
+                                              disable=len(stock_codes) < 100)):
+        price_month = load_rollup(stock_code, "monthly").sort_values(['year', 'month'])
+        # the day before the first of the next month, as days since 1970-01-01
+        months = (price_month['year'].to_numpy() - 1970) * 12 + price_month['month'].to_numpy()
+        month_end = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int32) - 1
+        price_parts.append((np.full(len(price_month), code_id, dtype=np.int32), month_end,
+                            price_month['close'].to_numpy(dtype=np.float32)))
+
+        financial_df = load_financials(stock_code)
+        financial_parts.append((np.full(len(financial_df), code_id, dtype=np.int32),
+                                to_days(financial_df[AS_OF_FINANCIAL_DATE]), to_days(financial_df['report_date']),
+                                financial_df[['bps_ttm', 'eps_ttm', 'roe_ttm']].to_numpy(dtype=np.float32)))
+    if not price_parts:
+        raise FileNotFoundError("No price and financial data found. Please query data first.")
+
+    price = {name: np.concatenate([part[i] for part in price_parts]) for i, name in enumerate(['code_id', 'date', 'close'])}
+    fundamentals = np.concatenate([part[3] for part in financial_parts])
+    financial = {name: np.concatenate([part[i] for part in financial_parts])
+                 for i, name in enumerate(['code_id', 'as_of', 'quarter'])}
+    financial.update({column: fundamentals[:, i] for i, column in enumerate(['bps_ttm', 'eps_ttm', 'roe_ttm'])})
+    monthly = join_daily_asof(price, financial)
+
+    counts = np.bincount(monthly['code_id'], minlength=len(stock_codes))
+    history = {
+        'codes': np.array(stock_codes, dtype='U6')[counts > 0],
+        'offsets': np.r_[0, np.cumsum(counts[counts > 0])].astype(np.int64),
+        'date': monthly['date'],
+        'quarter': monthly['quarter'],
+    }
+    history.update({column: monthly[column] for column in VALUE_COLUMNS})
+    return history
+
+
+def load_daily_history():
+    """Load the daily valuation archive for as-of queries, which must match quarters by announcement date"""
+    store = load_daily_store()
+    if store is None:
+        raise FileNotFoundError("Daily valuation not found. Run 'python daily_valuation.py "
+                                f"--financial_date {AS_OF_FINANCIAL_DATE}' first.")
+    if str(store['financial_date']) != AS_OF_FINANCIAL_DATE:
+        raise ValueError(f"The daily valuation archive matches quarters by {store['financial_date']}, which uses "
+                         "quarters before they were announced. Rebuild it for as-of queries with "
+                         f"'python daily_valuation.py --financial_date {AS_OF_FINANCIAL_DATE}'.")
+    return store
+
+
+def load_as_of_values(as_of, granularity="monthly"):
+    """
+    Load the valuation of every stock as of the end of a month 'YYYY-MM'
+
+    Only the quarters announced by the month end are used. The monthly
+    histories come from the shared valuation panel (or the valuation files)
+    when the value step ran with --financial_date announce_date; valuations
+    by period end are not usable, so the histories are then valued from the
+    price and financial inputs instead (see read_announced_history()). The
+    daily ones come from the daily valuation archive built with
+    --financial_date announce_date (the last trading day of the month).
+    Returns: DataFrame like valuation_stream.scan_latest_values()
+    """
+    day = parse_as_of(as_of)
+    if granularity == "daily":
+        values = get_as_of_values(load_daily_history(), day, VALUE_COLUMNS)
+    elif get_valuation_mode() == AS_OF_FINANCIAL_DATE:
+        panel = attach_panel("valuation")
+        if panel is None:
+            values = get_as_of_values(read_valuation_panel(), day, PANEL_COLUMNS["valuation"])
+        else:
+            values = get_as_of_values(panel, day, PANEL_COLUMNS["valuation"])
+            detach_panel(panel)
+    else:
+        values = get_as_of_values(read_announced_history(), day, VALUE_COLUMNS)
+    if values.empty:
+        raise FileNotFoundError(f"No valuation data as of {as_of}.")
+    return values
+
+
+def load_as_of_history(stock_code, as_of, granularity="monthly"):
+    """
+    Load one stock's valuation history up to the end of a month 'YYYY-MM', with the quarters announced by each bar
+
+    Like load_as_of_values(), the stock's valuation file is only used when
+    it was computed with --financial_date announce_date.
+    Returns: DataFrame with report_date, year, month, the fundamentals and pe/pb/pr (empty if nothing by then)
+    """
+    day = parse_as_of(as_of)
+    if granularity != "daily" and get_valuation_mode() == AS_OF_FINANCIAL_DATE:
+        valuation_file = f"{VALUATION_DIR}/stock_valuation_{stock_code}.csv"
+        if not os.path.exists(valuation_file):
+            raise FileNotFoundError(f"Valuation data not found for stock {stock_code}")
+        stock_df = pd.read_csv(valuation_file, parse_dates=['report_date'])
+        return stock_df.iloc[:np.searchsorted(to_days(stock_df['report_date']), day, side='right')]
+
+    if granularity == "daily":
+        history = load_daily_history()
+        position = np.searchsorted(history['codes'], stock_code)
+        if position == len(history['codes']) or history['codes'][position] != stock_code:
+            raise FileNotFoundError(f"Daily valuation not found for stock {stock_code}")
+    else:
+        history = read_announced_history([stock_code])
+        if len(history['codes']) == 0:
+            raise FileNotFoundError(f"Valuation data not found for stock {stock_code}")
+        position = 0
+        history['update_date'] = np.array(datetime.now().strftime("%Y%m%d"))
+    start, end = history['offsets'][position], history['offsets'][position + 1]
+    end = start + np.searchsorted(history['date'][start:end], day, side='right')
+    return store_to_frame(history, np.arange(start, end), np.full(end - start, position))
+
+
+def recompute_as_of(stock_code, end):
+    """
+    Recompute one stock's monthly valuation as of a day from its inputs cut at that day
+
+    Independent of the as-of index: the daily prices and the quarters
+    announced by then are truncated first, the monthly closes taken from the
+    daily bars and joined with pandas (financial_store.join_financials_asof).
+    Returns: dict of the last row and the pr_ttm quartiles, or None without data by then
+    """
+    price_df = pd.read_csv(f"{PRICE_DIR}/price_data_{stock_code}.csv", usecols=['report_date', 'close'])
+    price_df['report_date'] = pd.to_datetime(price_df['report_date'])
+    price_df = price_df[price_df['report_date'] <= end].sort_values('report_date')
+    financial_df = load_financials(stock_code)
+    financial_df = financial_df[financial_df[AS_OF_FINANCIAL_DATE] <= end]
+    if price_df.empty:
+        return None
+
+    price_month = price_df.groupby(price_df['report_date'].dt.to_period('M'))['close'].last().reset_index()
+    price_month['report_date'] = price_month['report_date'].dt.to_timestamp() + pd.offsets.MonthEnd(0)
+    stock_df = join_financials_asof(price_month, financial_df, 'report_date', as_of=AS_OF_FINANCIAL_DATE)
+    stock_df['pe_ttm'] = stock_df['close'] / stock_df['eps_ttm']
+    stock_df['pb_ttm'] = stock_df['close'] / stock_df['bps_ttm']
+    stock_df['pr_ttm'] = stock_df['pe_ttm'] / stock_df['roe_ttm']
+
+    row = stock_df.iloc[-1][['report_date'] + VALUE_COLUMNS].to_dict()
+    row['report_date'] = row['report_date'].strftime('%Y-%m-%d')
+    row['pr_ttm_q25'] = stock_df['pr_ttm'].quantile(0.25)
+    row['pr_ttm_q75'] = stock_df['pr_ttm'].quantile(0.75)
+    return row
+
+
+def verify_as_of(as_of):
+    """
+    Check the as-of values of every stock against a recomputation from the
+    price and financial inputs truncated to the month end (see recompute_as_of())
+    Returns: the codes whose values differ
+    """
+    values = load_as_of_values(as_of).set_index('code')
+    end = pd.Timestamp(datetime.strptime(as_of, "%Y-%m")) + pd.offsets.MonthEnd(0)
+
+    expected = {}
+    for stock_code in tqdm(list_daily_codes(), desc=f"Recomputing as of {as_of}"):
+        row = recompute_as_of(stock_code, end)
+        if row is not None:
+            expected[stock_code] = row
+    expected = pd.DataFrame.from_dict(expected, orient='index')
+    if expected.empty:
+        expected = pd.DataFrame(columns=['report_date'] + VALUE_COLUMNS + ['pr_ttm_q25', 'pr_ttm_q75'])
+
+    mismatched = sorted(set(expected.index) ^ set(values.index))
+    common = expected.index.intersection(values.index)
+    mismatched += common[expected.loc[common, 'report_date'] != values.loc[common, 'report_date']].tolist()
+    for column in VALUE_COLUMNS + ['pr_ttm_q25', 'pr_ttm_q75']:
+        # the as-of index keeps float32 values
+        close = np.isclose(expected.loc[common, column].astype(np.float64), values.loc[common, column].astype(np.float64),
+                           rtol=1e-5, equal_nan=True)
+        mismatched += common[~close].tolist()
+    mismatched = sorted(set(mismatched))
+
+    print(f"Verified {len(expected)} stocks as of {as_of}: "
+          + ("all match" if not mismatched else f"{len(mismatched)} differ: {mismatched[:20]}"))
+    return mismatched
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Valuations of all stocks as of a past month")
+    parser.add_argument("--as_of", type=str, required=True,
+                        help="Month to look back to, YYYY-MM")
+    parser.add_argument("--granularity", type=str, default="monthly",
+                        choices=['monthly', 'daily'],
+                        help="Monthly valuation (default) or the daily series (run daily_valuation.py first)")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check the monthly values against a recomputation from the price and financial data "
+                             "cut at the month end")
+
+    args = parser.parse_args()
+
+    if args.verify:
+        mismatched = verify_as_of(args.as_of)
+        raise SystemExit(1 if mismatched else 0)
+
+    values = load_as_of_values(args.as_of, args.granularity)
+    print(f"{len(values)} stocks as of {args.as_of}")
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(values.head(20).to_string(index=False))
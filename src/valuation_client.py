@@ -0,0 +1,53 @@
+import os
+import json
+from io import StringIO
+from urllib.error import URLError, HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import pandas as pd
+
+# Where query CLIs look for a running valuation_server.py
+SERVER_URL = os.getenv("VALUATION_SERVER_URL", "http://127.0.0.1:8765")
+
+
+def query_server(path, timeout=0.5, **params):
+    """
+    Query the valuation server
+    Returns: the response body as text, or None if the server is not running
+    Raises: FileNotFoundError if the server does not know the requested stock
+    """
+    url = f"{SERVER_URL}{path}" + (f"?{urlencode(params)}" if params else "")
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            return response.read().decode('utf-8')
+    except HTTPError as e:
+        if e.code == 404:
+            raise FileNotFoundError(json.loads(e.read().decode('utf-8'))['error'])
+        return None
+    except (URLError, OSError):
+        return None
+
+
+def read_frame(body):
+    """Parse a frame returned by the server"""
+    df = pd.read_json(StringIO(body), orient='split', dtype={'code': str})
+    if 'report_date' in df.columns:
+        df['report_date'] = pd.to_datetime(df['report_date'])
+    return df
+
+
+def load_snapshot_from_server():
+    """
+    Latest valuation row of every stock from the server, or None if it is not running
+    """
+    body = query_server('/snapshot')
+    return read_frame(body) if body is not None else None
+
+
+def load_history_from_server(stock_code):
+    """
+    Valuation history of one stock from the server, or None if it is not running
+    """
+    body = query_server('/history', code=str(stock_code).zfill(6))
+    return read_frame(body) if body is not None else None
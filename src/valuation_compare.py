@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from symbol_table import get_ids, get_names
+from industry_rank import add_industry_ranks, get_rank_column, RANK_METRICS
+from run_metrics import timed
+
+COMPARE_METRICS = ['pe_ttm', 'pb_ttm', 'pr_ttm', 'roe_ttm']
+
+# Export formats by file extension; Parquet needs pyarrow (or fastparquet), which is not a dependency
+EXPORT_FORMATS = ['.csv', '.parquet', '.json']
+
+
+def get_market_quantiles(all_stocks_df, metric, values):
+    """
+    Quantile rank of values within the positive values of a metric across all stocks
+
+    The positive values are sorted once and every value is located with one
+    searchsorted, the share of stocks lower or equal (NaN for NaN values).
+    """
+    market = all_stocks_df[metric].to_numpy(dtype=np.float64)
+    market = np.sort(market[market > 0])
+    values = np.asarray(values, dtype=np.float64)
+    if len(market) == 0:
+        return np.full(len(values), np.nan)
+    quantiles = np.searchsorted(market, values, side='right') / len(market)
+    return np.where(np.isnan(values), np.nan, quantiles)
+
+
+def compare_stocks(stock_codes, all_stocks_df):
+    """
+    Look up the latest metrics, market quantiles and PR-based target prices of many stocks at once
+
+    all_stocks_df is the latest row of every stock with the quartiles of its
+    own pr_ttm history (valuation_stream.scan_latest_values() and the other
+    loaders of the query CLIs, monthly, daily or as of a month); the stocks
+    are taken from it in one join, so no history is read per stock. With an
+    industry classification, the industry-relative ranks are added as well.
+    Returns: (DataFrame with one row per found stock in the given order, codes not found)
+    """
+    stock_codes = [str(code).zfill(6) for code in stock_codes]
+    with timed("compare", kind="valuation"):
+        all_stocks_df = add_industry_ranks(all_stocks_df)
+        latest = all_stocks_df.assign(code=all_stocks_df['code'].astype(str).str.zfill(6)) \
+            .drop_duplicates('code', keep='last').set_index('code')
+        found = [code for code in dict.fromkeys(stock_codes) if code in latest.index]
+        missing = [code for code in stock_codes if code not in latest.index]
+        latest = latest.loc[found]
+
+        comparison = pd.DataFrame({'code': found, 'name': get_names(get_ids(found)) if found else []})
+        comparison['report_date'] = pd.to_datetime(latest['report_date']).dt.strftime('%Y-%m-%d').to_numpy()
+        comparison['close'] = latest['close'].to_numpy(dtype=np.float64)
+        for metric in COMPARE_METRICS:
+            comparison[metric] = latest[metric].to_numpy(dtype=np.float64)
+            comparison[f"{metric.split('_')[0]}_quantile"] = get_market_quantiles(all_stocks_df, metric, comparison[metric])
+
+        # target prices: the close at which pr_ttm would reach the quartiles of its own history
+        current_pr = comparison['pr_ttm'].where(comparison['pr_ttm'] > 0)
+        for name, column in [('price_25th', 'pr_ttm_q25'), ('price_75th', 'pr_ttm_q75')]:
+            comparison[name] = comparison['close'] * latest[column].to_numpy(dtype=np.float64) / current_pr
+
+        if 'industry' in latest.columns:
+            comparison['industry'] = latest['industry'].to_numpy()
+            for metric in RANK_METRICS:
+                comparison[get_rank_column(metric)] = latest[get_rank_column(metric)].to_numpy()
+    return comparison, missing
+
+
+def export_comparison(comparison, output_file):
+    """
+    Save a comparison for downstream tools, in the format of the file extension (.csv, .parquet or .json)
+
+    JSON is a list of one record per stock, with null for missing values.
+    """
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {extension or output_file}. Use one of {EXPORT_FORMATS}.")
+    if os.path.dirname(output_file):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    # the metrics are stored as float32: export them at that precision, not with the digits of the float64 conversion
+    comparison = comparison.copy()
+    floats = comparison.select_dtypes(include='float').columns
+    comparison[floats] = comparison[floats].apply(lambda column: column.map(lambda value: float(f"{value:.7g}")))
+
+    if extension == '.csv':
+        comparison.to_csv(output_file, index=False)
+    elif extension == '.parquet':
+        try:
+            comparison.to_parquet(output_file, index=False)
+        except ImportError:
+            raise ImportError("Parquet export needs pyarrow: pip install pyarrow (or export .csv/.json instead)")
+    else:
+        comparison.to_json(output_file, orient='records', force_ascii=False, indent=1)
+    return output_file
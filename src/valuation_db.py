@@ -0,0 +1,207 @@
+import os
+import bisect
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from valuation_stream import iter_valuation_chunks, VALUATION_DIR
+from symbol_table import get_ids, get_names
+from run_metrics import timed, count
+
+# SQLite copy of the monthly valuation files, kept in sync by the value step
+VALUATION_DB_FILE = "../data/processed/stock-valuation/valuation.db"
+
+# Columns of the valuation files copied into the database, with their read types
+DB_COLUMNS = {
+    'code': str,
+    'report_date': str,
+    'year': np.int64,
+    'month': np.int64,
+    'open': np.float64,
+    'high': np.float64,
+    'low': np.float64,
+    'close': np.float64,
+    'bps': np.float64,
+    'eps': np.float64,
+    'roe': np.float64,
+    'bps_ttm': np.float64,
+    'eps_ttm': np.float64,
+    'roe_ttm': np.float64,
+    'pe_ttm': np.float64,
+    'pb_ttm': np.float64,
+    'pr_ttm': np.float64,
+    'update_date': np.int64,
+}
+
+# Metric columns with their own index, for range conditions over the whole history
+INDEXED_METRICS = ['pe_ttm', 'pb_ttm', 'pr_ttm', 'roe_ttm']
+
+# Secondary indexes; a sync rewriting more than this share of the stocks drops them and
+# builds them again afterwards, which is faster than updating them row by row
+INDEXES = {
+    "valuation_report_date": "valuation (report_date, code)",
+    **{f"valuation_{metric}": f"valuation ({metric}, report_date)" for metric in INDEXED_METRICS},
+}
+BULK_SYNC_SHARE = 0.25
+
+# Page cache of a sync, in KiB
+SYNC_CACHE_KB = 65536
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS valuation ("
+    "code TEXT NOT NULL, report_date TEXT NOT NULL, year INTEGER, month INTEGER, "
+    "open REAL, high REAL, low REAL, close REAL, bps REAL, eps REAL, roe REAL, "
+    "bps_ttm REAL, eps_ttm REAL, roe_ttm REAL, pe_ttm REAL, pb_ttm REAL, pr_ttm REAL, update_date INTEGER, "
+    "PRIMARY KEY (code, report_date)) WITHOUT ROWID",
+    # one row per synced stock: its name and the size and modification time of the file it was synced from
+    "CREATE TABLE IF NOT EXISTS stocks ("
+    "code TEXT PRIMARY KEY, name TEXT, file_size INTEGER, file_mtime_ns INTEGER)",
+] + [
+    f"CREATE INDEX IF NOT EXISTS {name} ON {columns}" for name, columns in INDEXES.items()
+] + [
+    "CREATE VIEW IF NOT EXISTS latest_valuation AS "
+    "SELECT valuation.* FROM valuation JOIN "
+    "(SELECT code, MAX(report_date) AS report_date FROM valuation GROUP BY code) USING (code, report_date)",
+]
+
+
+class Median:
+    """
+    median() aggregate and window function for SQLite, e.g.
+    median(pr_ttm) OVER (PARTITION BY code ORDER BY report_date ROWS 59 PRECEDING)
+    """
+
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            bisect.insort(self.values, value)
+
+    def inverse(self, value):
+        if value is not None:
+            del self.values[bisect.bisect_left(self.values, value)]
+
+    def value(self):
+        n = len(self.values)
+        if n == 0:
+            return None
+        middle = n // 2
+        return self.values[middle] if n % 2 else (self.values[middle - 1] + self.values[middle]) / 2
+
+    def finalize(self):
+        return self.value()
+
+
+def connect(db_file=VALUATION_DB_FILE, read_only=False):
+    """
+    Open the valuation database, creating its tables and indexes when writing
+
+    The database runs in WAL mode, so queries keep reading the last synced
+    state while a sync is writing. median() is available as an aggregate and
+    as a window function.
+    """
+    if read_only:
+        if not os.path.exists(db_file):
+            raise FileNotFoundError("No valuation database found. Please run `python query_sql.py --sync` "
+                                    "or the value step first.")
+        conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    else:
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        conn = sqlite3.connect(db_file)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{SYNC_CACHE_KB}")
+        for statement in SCHEMA:
+            conn.execute(statement)
+    conn.create_window_function("median", 1, Median)
+    return conn
+
+
+def get_file_stats(stock_codes=None, valuation_dir=VALUATION_DIR):
+    """Get the size and modification time of the valuation files: {code: (size, mtime_ns)}"""
+    if stock_codes is None:
+        stock_codes = [file[16:22] for file in os.listdir(valuation_dir) if file.endswith('.csv')]
+    stats = {}
+    for code in stock_codes:
+        file = f"{valuation_dir}/stock_valuation_{code}.csv"
+        if os.path.exists(file):
+            stat = os.stat(file)
+            stats[code] = (stat.st_size, stat.st_mtime_ns)
+    return stats
+
+
+def sync_valuation_db(stock_codes=None, rebuild=False, db_file=VALUATION_DB_FILE, valuation_dir=VALUATION_DIR):
+    """
+    Copy the valuation files that changed since the last sync into the database
+
+    A stock's rows are replaced as a whole when its file's size or modification
+    time changed. Without stock_codes every file is checked, and the stocks
+    whose file is gone are removed. The sync is one transaction: queries see
+    either the previous or the new state. When most stocks changed (a full
+    value run) the secondary indexes are dropped and built again after the
+    copy, in the same transaction, so a failed sync leaves them in place.
+    Returns: the number of stocks (re)written
+    """
+    conn = connect(db_file)
+    try:
+        # explicit: sqlite3 only opens a transaction by itself before INSERT/UPDATE/DELETE, not before DROP INDEX
+        conn.execute("BEGIN")
+        if rebuild:
+            conn.execute("DELETE FROM valuation")
+            conn.execute("DELETE FROM stocks")
+        stats = get_file_stats(stock_codes, valuation_dir)
+        synced = {code: (size, mtime_ns) for code, size, mtime_ns in
+                  conn.execute("SELECT code, file_size, file_mtime_ns FROM stocks")}
+        changed = sorted(code for code, stat in stats.items() if synced.get(code) != stat)
+        removed = sorted(set(synced) - set(stats)) if stock_codes is None else []
+        bulk = len(changed) > BULK_SYNC_SHARE * len(synced)
+
+        columns = list(DB_COLUMNS)
+        insert = f"INSERT INTO valuation ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        with timed("db_write", kind="valuation"):
+            if bulk:
+                for name in INDEXES:
+                    conn.execute(f"DROP INDEX IF EXISTS {name}")
+            for code in removed:
+                conn.execute("DELETE FROM valuation WHERE code = ?", (code,))
+                conn.execute("DELETE FROM stocks WHERE code = ?", (code,))
+            for chunk in iter_valuation_chunks(changed, columns=DB_COLUMNS, valuation_dir=valuation_dir):
+                codes = chunk['code'].unique().tolist()
+                conn.executemany("DELETE FROM valuation WHERE code = ?", [(code,) for code in codes])
+                # SQLite stores NaN as NULL
+                conn.executemany(insert, chunk[columns].itertuples(index=False, name=None))
+                count("rows_written_total", len(chunk), kind="valuation_db")
+            if bulk:
+                for name, definition in INDEXES.items():
+                    conn.execute(f"CREATE INDEX {name} ON {definition}")
+            names = get_names(get_ids(changed)) if changed else []
+            conn.executemany("INSERT OR REPLACE INTO stocks (code, name, file_size, file_mtime_ns) VALUES (?, ?, ?, ?)",
+                             [(code, str(name), *stats[code]) for code, name in zip(changed, names)])
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    print(f"Valuation database synced: {len(changed)} stocks updated, {len(removed)} removed ({db_file})")
+    return len(changed)
+
+
+def query_sql(sql, params=(), db_file=VALUATION_DB_FILE):
+    """
+    Run a read-only SQL query against the valuation database
+
+    Tables: valuation (one row per stock and month, the columns of the
+    valuation files), stocks (code, name) and the view latest_valuation (the
+    latest row of every stock).
+    Returns: DataFrame with the result
+    """
+    conn = connect(db_file, read_only=True)
+    try:
+        with timed("db_query", kind="valuation"):
+            return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
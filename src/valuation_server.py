@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import argparse
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+from calculation_and_visualization_new import filter_best_stocks, PUBLISH_MARKER_FILE
+from symbol_table import get_ids, get_names, get_name
+
+VALUATION_DIR = "../data/processed/stock-valuation/all/"
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+METRICS = ['pe_ttm', 'pb_ttm', 'pr_ttm', 'roe_ttm']
+
+# The loaded market; replaced as a whole on reload so requests never see a half-loaded store
+STORE = {}
+
+
+def load_store():
+    """
+    Load every stock's valuation history into one compact columnar frame
+
+    All histories are concatenated into a single frame sorted by code, with
+    float32 metrics, a categorical code column and the row range of each
+    code, so a history is a slice and the snapshot is one take() of the
+    last rows, with the quartiles of every stock's pr_ttm history.
+    """
+    frames = []
+    for file in sorted(os.listdir(VALUATION_DIR)):
+        if file.endswith('.csv'):
+            frames.append(pd.read_csv(os.path.join(VALUATION_DIR, file), dtype={'code': str}))
+    if not frames:
+        raise FileNotFoundError("No valuation data found. Please run calculation first.")
+
+    history = pd.concat(frames, ignore_index=True)
+    history['code'] = history['code'].str.zfill(6)
+    history['report_date'] = pd.to_datetime(history['report_date'])
+    float_columns = history.select_dtypes(include='float64').columns
+    history[float_columns] = history[float_columns].astype(np.float32)
+    history['code'] = history['code'].astype('category')
+
+    codes = history['code'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(history)]
+    ranges = {code: (start, end) for code, start, end in zip(codes[starts], starts, ends)}
+
+    snapshot = history.iloc[ends - 1].reset_index(drop=True)
+    snapshot['code'] = snapshot['code'].astype(str)
+    snapshot['name'] = get_names(get_ids(snapshot['code']))
+    # quartiles of each stock's own pr_ttm history, as in valuation_stream.scan_latest_values()
+    quantiles = history['pr_ttm'].groupby(np.repeat(np.arange(len(starts)), ends - starts)).quantile([0.25, 0.75]).unstack()
+    snapshot['pr_ttm_q25'] = quantiles[0.25].to_numpy()
+    snapshot['pr_ttm_q75'] = quantiles[0.75].to_numpy()
+
+    return {
+        "history": history,
+        "ranges": ranges,
+        "snapshot": snapshot,
+        "snapshot_json": frame_to_json(snapshot),
+        "loaded_at": datetime.now().isoformat(timespec='seconds'),
+        "marker_mtime": os.path.getmtime(PUBLISH_MARKER_FILE) if os.path.exists(PUBLISH_MARKER_FILE) else None,
+    }
+
+
+def frame_to_json(df):
+    """Serialize a frame as {"columns", "index", "data"} JSON, with NaN as null and ISO dates"""
+    df = df.copy()
+    df[df.select_dtypes(include='float32').columns] = df.select_dtypes(include='float32').astype(np.float64).round(6)
+    return df.to_json(orient='split', date_format='iso', index=False).encode('utf-8')
+
+
+def get_history(store, code):
+    """Get the valuation history of one stock, or None if unknown"""
+    code = str(code).zfill(6)
+    if code not in store['ranges']:
+        return None
+    start, end = store['ranges'][code]
+    history = store['history'].iloc[start:end].copy()
+    history['code'] = history['code'].astype(str)
+    return history
+
+
+def to_float(value):
+    """Convert a numpy scalar to a JSON-safe float (None for NaN)"""
+    return None if pd.isna(value) else round(float(value), 6)
+
+
+def market_quantiles(snapshot, latest):
+    """Quantile rank of a stock's latest metrics among the positive values of all stocks"""
+    quantiles = {}
+    for metric in METRICS:
+        values = snapshot[metric].to_numpy()
+        values = np.sort(values[values > 0])
+        quantiles[metric] = float(np.searchsorted(values, latest[metric], side='right') / len(values)) if len(values) else None
+    return quantiles
+
+
+def stock_report(store, code):
+    """Latest metrics, market quantiles and PR-based target prices of one stock"""
+    history = get_history(store, code)
+    if history is None:
+        return None
+    latest = history.iloc[-1]
+    pr_25 = to_float(history['pr_ttm'].quantile(0.25))
+    pr_75 = to_float(history['pr_ttm'].quantile(0.75))
+    current_pr = to_float(latest['pr_ttm'])
+    close = to_float(latest['close'])
+    has_target = current_pr is not None and current_pr > 0 and pr_25 is not None
+    report = {
+        "code": str(code).zfill(6),
+        "name": get_name(code),
+        "report_date": latest['report_date'].strftime('%Y-%m-%d'),
+        "close": close,
+        "quantiles": market_quantiles(store['snapshot'], latest),
+        "price_25th": close * pr_25 / current_pr if has_target else None,
+        "price_75th": close * pr_75 / current_pr if has_target else None,
+    }
+    for metric in METRICS:
+        report[metric] = to_float(latest[metric])
+    return report
+
+
+def top_stocks(store, indicator, top_n):
+    """Top N stocks by an indicator, with the same filters as query_top_stocks.py"""
+    snapshot = store['snapshot']
+    valid = snapshot[(snapshot[indicator] > 0) & (snapshot['pe_ttm'] > 0) &
+                     (snapshot['pr_ttm'] > 0) & (snapshot['roe_ttm'] > 0)]
+    return valid.sort_values(indicator, ascending=(indicator != 'roe_ttm')).head(top_n)
+
+
+class ValuationRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET endpoints (all JSON):
+      /health                      loaded version and size
+      /snapshot                    latest row of every stock
+      /history?code=600519         valuation history of one stock
+      /report?code=600519          latest metrics, quantiles and target prices
+      /compare?codes=600519,000858 reports of several stocks
+      /top?indicator=pe_ttm&top_n=10
+      /screen?threshold=0.26
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        store = STORE['current']
+
+        try:
+            if url.path == '/health':
+                self.send_json({"loaded_at": store['loaded_at'], "stocks": len(store['snapshot']),
+                                "rows": len(store['history'])})
+            elif url.path == '/snapshot':
+                self.send_body(store['snapshot_json'])
+            elif url.path == '/history':
+                history = get_history(store, params.get('code', ''))
+                if history is None:
+                    self.send_json({"error": f"Valuation data not found for stock {params.get('code')}"}, 404)
+                else:
+                    self.send_body(frame_to_json(history))
+            elif url.path == '/report':
+                report = stock_report(store, params.get('code', ''))
+                if report is None:
+                    self.send_json({"error": f"Valuation data not found for stock {params.get('code')}"}, 404)
+                else:
+                    self.send_json(report)
+            elif url.path == '/compare':
+                codes = [code.strip() for code in params.get('codes', '').split(',') if code.strip()]
+                self.send_json([report for report in (stock_report(store, code) for code in codes) if report])
+            elif url.path == '/top':
+                indicator = params.get('indicator', 'pe_ttm')
+                if indicator not in METRICS:
+                    self.send_json({"error": f"Unknown indicator: {indicator}. Use one of {METRICS}."}, 400)
+                else:
+                    self.send_body(frame_to_json(top_stocks(store, indicator, int(params.get('top_n', 10)))))
+            elif url.path == '/screen':
+                self.send_body(frame_to_json(filter_best_stocks(store['snapshot'], float(params.get('threshold', 0.26)))))
+            else:
+                self.send_json({"error": f"Unknown endpoint: {url.path}"}, 404)
+        except ValueError as e:
+            self.send_json({"error": str(e)}, 400)
+
+    def send_json(self, payload, status=200):
+        self.send_body(json.dumps(payload).encode('utf-8'), status)
+
+    def send_body(self, body, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def watch_for_updates(interval):
+    """
+    Reload the store whenever the valuation step publishes new data
+
+    The new store is built next to the current one and swapped in when
+    complete, so requests keep being served during a reload.
+    """
+    while True:
+        time.sleep(interval)
+        if not os.path.exists(PUBLISH_MARKER_FILE):
+            continue
+        if os.path.getmtime(PUBLISH_MARKER_FILE) == STORE['current']['marker_mtime']:
+            continue
+        try:
+            STORE['current'] = load_store()
+            print(f"Reloaded {len(STORE['current']['snapshot'])} stocks at {STORE['current']['loaded_at']}.")
+        except Exception as e:
+            print(f"Reload failed, keeping the previous data: {e}")
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, reload_interval=5):
+    """
+    Load the market once and serve it until interrupted
+    """
+    start = time.perf_counter()
+    STORE['current'] = load_store()
+    print(f"Loaded {len(STORE['current']['snapshot'])} stocks ({len(STORE['current']['history'])} rows) "
+          f"in {time.perf_counter() - start:.1f}s.")
+
+    threading.Thread(target=watch_for_updates, args=(reload_interval,), daemon=True).start()
+
+    server = ThreadingHTTPServer((host, port), ValuationRequestHandler)
+    print(f"Serving valuations on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve stock valuations from memory over HTTP/JSON on localhost")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST,
+                        help=f"Address to listen on (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help=f"Port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("--reload_interval", type=float, default=5,
+                        help="Seconds between checks for newly published valuations (default: 5)")
+
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.reload_interval)
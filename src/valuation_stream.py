@@ -0,0 +1,116 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from run_metrics import timed, count
+
+VALUATION_DIR = "../data/processed/stock-valuation/all"
+
+# Columns read by the whole-market scans and their in-memory types: float32 metrics, the
+# code as an integer (zero-padded again in the results) and the dates as categories per chunk
+STREAM_COLUMNS = {
+    'code': np.int32,
+    'report_date': 'category',
+    'close': np.float32,
+    'bps_ttm': np.float32,
+    'eps_ttm': np.float32,
+    'roe_ttm': np.float32,
+    'pe_ttm': np.float32,
+    'pb_ttm': np.float32,
+    'pr_ttm': np.float32,
+    'update_date': np.int32,
+}
+
+# CSV text buffered before it is parsed into a chunk, in MB (a chunk always holds whole stocks)
+MEMORY_CAP_MB = 4
+# Peak resident memory of a full-market scan, interpreter and libraries included, in MB
+# (checked by the callers with run_metrics.get_peak_rss_mb())
+PEAK_RSS_BUDGET_MB = 512
+
+
+def parse_chunk(header, lines, columns):
+    """Parse the buffered CSV lines of several stocks into one typed DataFrame"""
+    names = header.decode().strip().split(',')
+    dtypes = {column: dtype for column, dtype in columns.items() if dtype != 'category'}
+    chunk = pd.read_csv(io.BytesIO(b"".join(lines)), header=None, names=names, usecols=list(columns), dtype=dtypes)
+    for column, dtype in columns.items():
+        if dtype == 'category':
+            chunk[column] = chunk[column].astype('category')
+    return chunk
+
+
+def iter_valuation_chunks(stock_codes=None, columns=STREAM_COLUMNS, memory_cap_mb=MEMORY_CAP_MB,
+                          valuation_dir=VALUATION_DIR):
+    """
+    Stream the valuation histories as typed column chunks
+
+    The files of whole stocks are buffered as raw lines until they take
+    memory_cap_mb, then parsed together in one read_csv call (instead of one
+    per stock) keeping only the given columns, so memory does not grow with
+    the size of the market. Files written with a different header start a
+    new chunk.
+    Yields: DataFrame chunks with the rows of several stocks, each stock's rows contiguous and sorted by date
+    """
+    if stock_codes is None:
+        files = sorted(file for file in os.listdir(valuation_dir) if file.endswith('.csv'))
+    else:
+        files = [f"stock_valuation_{code}.csv" for code in stock_codes
+                 if os.path.exists(f"{valuation_dir}/stock_valuation_{code}.csv")]
+
+    cap = memory_cap_mb * 2**20
+    header = None
+    lines = []
+    buffered = 0
+    for file in files:
+        with open(os.path.join(valuation_dir, file), 'rb') as f:
+            file_header = f.readline()
+            body = f.read()
+        if not body:
+            continue
+        if not body.endswith(b"\n"):
+            body += b"\n"
+        if lines and (file_header != header or buffered + len(body) > cap):
+            with timed("csv_read", kind="valuation"):
+                chunk = parse_chunk(header, lines, columns)
+            count("rows_read_total", len(chunk), kind="valuation")
+            yield chunk
+            lines = []
+            buffered = 0
+        header = file_header
+        lines.append(body)
+        buffered += len(body)
+    if lines:
+        with timed("csv_read", kind="valuation"):
+            chunk = parse_chunk(header, lines, columns)
+        count("rows_read_total", len(chunk), kind="valuation")
+        yield chunk
+
+
+def summarize_chunk(chunk):
+    """
+    Reduce a chunk to the latest row of every stock, together with the 25th
+    and 75th percentiles of the stock's own pr_ttm history
+    """
+    by_code = chunk.groupby('code', sort=False)
+    latest = chunk[by_code.cumcount(ascending=False).to_numpy() == 0].set_index('code')
+    quantiles = by_code['pr_ttm'].quantile([0.25, 0.75]).unstack()
+    latest['pr_ttm_q25'] = quantiles[0.25]
+    latest['pr_ttm_q75'] = quantiles[0.75]
+    return latest.reset_index()
+
+
+def scan_latest_values(stock_codes=None, memory_cap_mb=MEMORY_CAP_MB):
+    """
+    Scan the valuation histories of the whole market in chunks and keep the
+    latest row of every stock with its own pr_ttm quartiles
+
+    Returns: DataFrame with one row per stock and the code as a zero-padded string
+    """
+    latest = [summarize_chunk(chunk) for chunk in iter_valuation_chunks(stock_codes, memory_cap_mb=memory_cap_mb)]
+    if not latest:
+        raise FileNotFoundError("No valuation data found. Please run calculation first.")
+    stock_values = pd.concat(latest, ignore_index=True)
+    stock_values['code'] = stock_values['code'].astype(str).str.zfill(6)
+    return stock_values
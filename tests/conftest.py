@@ -0,0 +1,54 @@
+import os
+import sys
+import types
+import shutil
+
+import pytest
+
+import symbol_table
+from synthetic_market import generate_market
+
+# Size of the synthetic market the tests run against
+TEST_STOCKS = 40
+TEST_YEARS = 2
+# Last day of the market's history, fixed so that the dates the tests query stay inside it
+TEST_END_DATE = "2026-06-30"
+
+
+@pytest.fixture(scope="session")
+def market_template(tmp_path_factory):
+    """A small synthetic market with its valuations, generated once per test session"""
+    benchmark_dir = tmp_path_factory.mktemp("benchmark")
+    cwd = os.getcwd()
+    os.makedirs(benchmark_dir / "src")
+    os.chdir(benchmark_dir / "src")
+    try:
+        return os.path.abspath(generate_market(TEST_STOCKS, TEST_YEARS, seed=7, end_date=TEST_END_DATE,
+                                               benchmark_dir=str(benchmark_dir)))
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def market(market_template, tmp_path, monkeypatch):
+    """
+    A fresh copy of the synthetic market, with its src folder as working directory
+    so the scripts' ../data paths point at it
+    """
+    market_dir = shutil.copytree(market_template, tmp_path / "market")
+    monkeypatch.chdir(market_dir / "src")
+    symbol_table.SYMBOLS.clear()
+    yield market_dir
+    symbol_table.SYMBOLS.clear()
+
+
+@pytest.fixture
+def query_data_new(monkeypatch):
+    """query_data_new with akshare left out: the tests set the ak functions they call on query_data_new.ak"""
+    try:
+        import akshare
+    except ImportError:
+        monkeypatch.setitem(sys.modules, "akshare", types.ModuleType("akshare"))
+    import query_data_new
+    monkeypatch.setattr(query_data_new, "ak", types.SimpleNamespace())
+    return query_data_new
@@ -0,0 +1,30 @@
+import numpy as np
+
+from daily_valuation import build_daily_valuation, load_daily_store, list_daily_codes
+
+
+def test_subset_build_keeps_other_stocks(market):
+    codes = list_daily_codes()
+    build_daily_valuation(financial_date='report_date')
+    stored = load_daily_store()
+
+    assert build_daily_valuation(codes[:3], financial_date='report_date') == 0
+    store = load_daily_store()
+    assert store['codes'].tolist() == codes
+    np.testing.assert_array_equal(store['pe_ttm'], stored['pe_ttm'])
+
+
+def test_subset_build_with_other_financial_date_recomputes_all(market):
+    codes = list_daily_codes()
+    build_daily_valuation(financial_date='report_date')
+
+    assert build_daily_valuation(codes[:3], financial_date='announce_date') == len(codes)
+    store = load_daily_store()
+    assert str(store['financial_date']) == 'announce_date'
+    assert store['codes'].tolist() == codes
+
+
+def test_forced_subset_build_recomputes_all(market):
+    codes = list_daily_codes()
+    assert build_daily_valuation(codes[:3], force=True) == len(codes)
+    assert load_daily_store()['codes'].tolist() == codes
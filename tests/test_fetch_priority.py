@@ -0,0 +1,46 @@
+import pandas as pd
+
+import fetch_priority
+from symbol_table import STOCK_TYPE_MAPPING, get_universe_codes
+
+
+def test_marker_covers_priority_tier_of_every_universe(market, query_data_new, monkeypatch):
+    # two disjoint lists (the synthetic lists hold every stock of a small market)
+    codes = get_universe_codes("all")
+    hs300, zz500 = codes[:20], codes[20:]
+    pd.DataFrame({'code': hs300}).to_csv(STOCK_TYPE_MAPPING["hs300"], index=False)
+    pd.DataFrame({'code': zz500}).to_csv(STOCK_TYPE_MAPPING["zz500"], index=False, sep='\t')
+    portfolio = hs300[:2] + zz500[:2]
+    monkeypatch.setitem(STOCK_TYPE_MAPPING, "portfolio", portfolio)
+
+    # every stock but the first portfolio stock needs an update, and one stock cannot be fetched
+    metadata = query_data_new.load_metadata()
+    metadata["price"] = {portfolio[0]: metadata["price"][portfolio[0]]}
+    query_data_new.save_metadata(metadata)
+    failing = portfolio[3]
+
+    def fake_daily(symbol, start_date, end_date, adjust):
+        if symbol.endswith(failing):
+            raise ConnectionError("stand-in failure")
+        return pd.DataFrame({'date': ['2025-01-02'], 'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0})
+    query_data_new.ak.stock_zh_a_daily = fake_daily
+
+    query_data_new.query_data("price", "hs300", priority=True)
+    marker = fetch_priority.load_marker()
+    # the whole tier of the list, also the stock that was already up to date
+    assert marker["codes"] == sorted(portfolio[:2])
+    assert marker["universes"] == ["hs300"]
+
+    query_data_new.query_data("price", "zz500", priority=True)
+    marker = fetch_priority.load_marker()
+    assert marker["codes"] == sorted(portfolio)
+    assert marker["failed"] == [failing]
+    assert marker["universes"] == ["hs300", "zz500"]
+    assert sorted(fetch_priority.load_priority_codes()) == sorted(portfolio[:3])
+
+    # a later run of the day that fetches it clears the failure
+    query_data_new.ak.stock_zh_a_daily = lambda **kwargs: fake_daily(symbol="sh000000", start_date=None,
+                                                                      end_date=None, adjust="")
+    query_data_new.query_data("price", "zz500", priority=True)
+    assert fetch_priority.load_marker()["failed"] == []
+    assert sorted(fetch_priority.load_priority_codes()) == sorted(portfolio)
@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+CALENDAR = pd.bdate_range("2024-01-02", "2024-01-10").to_numpy(dtype='datetime64[D]')
+GAPS = {"600000": [("2024-01-04", "2024-01-05")]}
+
+
+@pytest.fixture
+def gap_backfill(query_data_new, tmp_path, monkeypatch):
+    """gap_backfill with the price files in tmp_path and a stored history missing 2024-01-04 and 2024-01-05"""
+    import gap_backfill
+    monkeypatch.setattr(gap_backfill, "PRICE_DIR", str(tmp_path))
+    monkeypatch.setattr(gap_backfill, "ak", query_data_new.ak)
+    stored = pd.DataFrame({'report_date': ['2024-01-02', '2024-01-03', '2024-01-08', '2024-01-09'],
+                           'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0})
+    stored.to_csv(tmp_path / "price_data_600000.csv", index=False)
+    return gap_backfill
+
+
+def fake_daily(dates, requests):
+    def stock_zh_a_daily(symbol, start_date, end_date, adjust):
+        requests.append((start_date, end_date))
+        return pd.DataFrame({'date': pd.to_datetime(dates), 'open': 2.0, 'high': 2.0, 'low': 2.0, 'close': 2.0})
+    return stock_zh_a_daily
+
+
+def test_empty_response_is_a_failure(gap_backfill):
+    requests = []
+    gap_backfill.ak.stock_zh_a_daily = fake_daily([], requests)
+    filled, suspended, failed = gap_backfill.backfill_price_gaps(GAPS, CALENDAR)
+    assert (filled, suspended, failed) == ({}, {}, ["600000"])
+    # the request reaches one stored day on each side of the gaps
+    assert requests == [("20240103", "20240108")]
+
+
+def test_days_skipped_between_returned_rows_are_suspensions(gap_backfill):
+    gap_backfill.ak.stock_zh_a_daily = fake_daily(['2024-01-03', '2024-01-04', '2024-01-08'], [])
+    filled, suspended, failed = gap_backfill.backfill_price_gaps(GAPS, CALENDAR)
+    assert (filled, suspended, failed) == ({"600000": 1}, {"600000": [("2024-01-05", "2024-01-05")]}, [])
+    price_df = pd.read_csv(f"{gap_backfill.PRICE_DIR}/price_data_600000.csv")
+    assert price_df['report_date'].tolist() == ['2024-01-02', '2024-01-03', '2024-01-04', '2024-01-08', '2024-01-09']
+    assert price_df['close'].tolist() == [1.0, 1.0, 2.0, 1.0, 1.0]
+
+
+def test_days_past_the_returned_rows_are_retried(gap_backfill):
+    gap_backfill.ak.stock_zh_a_daily = fake_daily(['2024-01-03', '2024-01-04'], [])
+    filled, suspended, failed = gap_backfill.backfill_price_gaps(GAPS, CALENDAR)
+    assert (filled, suspended, failed) == ({"600000": 1}, {}, ["600000"])
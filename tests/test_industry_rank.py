@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+from industry_rank import add_industry_ranks, grouped_percentiles, load_industries, get_rank_column, \
+    RANK_METRICS, MIN_INDUSTRY_STOCKS
+from valuation_stream import scan_latest_values
+
+
+def write_classification(query_data_new, tmp_path, industries, industry_file):
+    """Store a stand-in classification the way the industry query does from a local source file"""
+    source_file = tmp_path / "industry_source.csv"
+    pd.DataFrame({'code': [code.lstrip('0') for code in industries], 'industry': list(industries.values())}) \
+        .to_csv(source_file, index=False)
+    query_data_new.query_industry_classification(source_file=str(source_file), industry_file=str(industry_file))
+    return load_industries(str(industry_file))
+
+
+def test_ranks_with_tie_and_single_member_industry(query_data_new, tmp_path):
+    codes = [f"{number:06d}" for number in range(1, 8)]
+    industries = write_classification(query_data_new, tmp_path, dict(zip(codes, ["银行"] * 6 + ["航天"])),
+                                      tmp_path / "industry_classification.csv")
+    assert industries.index.tolist() == codes
+
+    stock_values = pd.DataFrame({
+        'code': codes,
+        'pe_ttm': [10.0, 20.0, 20.0, 30.0, -5.0, 40.0, 15.0],
+        'pb_ttm': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 1.5],
+        'pr_ttm': [0.5, 0.4, 0.3, 0.2, 0.1, np.nan, 0.6],
+        'roe_ttm': [12.0, 8.0, 8.0, 8.0, -3.0, 15.0, 9.0],
+    })
+    ranked = add_industry_ranks(stock_values, industries).set_index('code')
+
+    assert ranked['industry'].tolist() == ["银行"] * 6 + ["航天"]
+    # five stocks of the bank industry have a positive PE; ties share the highest rank
+    np.testing.assert_allclose(ranked[get_rank_column('pe_ttm')].iloc[:6], [0.2, 0.6, 0.6, 0.8, np.nan, 1.0])
+    np.testing.assert_allclose(ranked[get_rank_column('roe_ttm')].iloc[:6], [0.8, 0.6, 0.6, 0.6, np.nan, 1.0])
+    # a missing metric is left out of its industry, which then has too few stocks for that metric
+    assert ranked[get_rank_column('pr_ttm')].isna().all()
+    # a single-member industry gets no rank
+    assert ranked.loc[codes[-1], [get_rank_column(metric) for metric in RANK_METRICS]].isna().all()
+
+
+def test_grouped_percentiles_match_pandas_rank():
+    rng = np.random.default_rng(3)
+    groups = rng.integers(-1, 12, size=2000)
+    values = rng.integers(0, 40, size=2000).astype(np.float64)
+    values[rng.random(2000) < 0.05] = np.nan
+
+    frame = pd.DataFrame({'group': groups, 'value': values})
+    frame = frame[(frame['group'] >= 0) & frame['value'].notna()]
+    expected = frame.groupby('group')['value'].rank(method='max', pct=True)
+    expected[frame.groupby('group')['value'].transform('size') < MIN_INDUSTRY_STOCKS] = np.nan
+
+    percentiles = grouped_percentiles(groups, values)
+    np.testing.assert_allclose(percentiles[expected.index], expected.to_numpy())
+    assert np.isnan(np.delete(percentiles, expected.index)).all()
+
+
+def test_market_ranks(market, query_data_new, tmp_path):
+    stock_values = scan_latest_values()
+    codes = stock_values['code'].astype(str).str.zfill(6).tolist()
+    # two industries of half the market each, and one stock alone in its own
+    labels = ["电子" if i % 2 else "医药" for i in range(len(codes) - 1)] + ["军工"]
+    industries = write_classification(query_data_new, tmp_path, dict(zip(codes, labels)),
+                                      "../data/input/industry_classification.csv")
+
+    ranked = add_industry_ranks(stock_values)
+    ranked['code'] = ranked['code'].astype(str).str.zfill(6)
+    assert ranked['industry'].tolist() == industries.loc[codes].tolist()
+
+    positive = ranked[ranked['pe_ttm'] > 0]
+    for metric in RANK_METRICS:
+        expected = positive[positive['industry'] != "军工"].groupby('industry')[metric] \
+            .rank(method='max', pct=True)
+        np.testing.assert_allclose(ranked.loc[expected.index, get_rank_column(metric)], expected, rtol=1e-12)
+    assert ranked[ranked['industry'] == "军工"][[get_rank_column(metric) for metric in RANK_METRICS]].isna().all().all()
+    assert ranked.loc[ranked['pe_ttm'] <= 0, get_rank_column('pe_ttm')].isna().all()
@@ -0,0 +1,52 @@
+import json
+
+import pandas as pd
+import pandas.testing as pdt
+
+from market_index import update_market_index, compute_market_index
+from market_panel import read_valuation_panel, PANEL_SOURCES
+from valuation_stream import VALUATION_DIR
+
+
+def restate_first_month(code):
+    """Rewrite the metrics of the first valued month of a stock, as a restated quarter would"""
+    valuation_file = f"{VALUATION_DIR}/stock_valuation_{code}.csv"
+    stock_df = pd.read_csv(valuation_file, dtype={'code': str})
+    first = stock_df['pe_ttm'].gt(0).idxmax()
+    stock_df.loc[first, ['pe_ttm', 'pb_ttm', 'pr_ttm']] *= 100
+    stock_df.to_csv(valuation_file, index=False)
+    return stock_df.loc[first, 'report_date']
+
+
+def test_update_extends_unchanged_history(market, capsys):
+    update_market_index()
+    index = update_market_index()
+    assert "Market index updated" in capsys.readouterr().out
+    pdt.assert_frame_equal(index, update_market_index(rebuild=True), check_exact=False, rtol=1e-5)
+
+
+def test_restated_months_rebuild_the_index(market, capsys):
+    stale = update_market_index()
+    first_month = restate_first_month(read_valuation_panel()["codes"][0])
+
+    index = update_market_index()
+    assert "Market index built" in capsys.readouterr().out
+    month = index[(index['universe'] == 'all') & (index['report_date'] == first_month)]
+    stale_month = stale[(stale['universe'] == 'all') & (stale['report_date'] == first_month)]
+    assert month['pe_ttm_q75'].iloc[0] >= stale_month['pe_ttm_q75'].iloc[0]
+    expected = compute_market_index(read_valuation_panel())
+    pdt.assert_frame_equal(index, expected, check_exact=False, rtol=1e-5)
+
+
+def test_financial_date_change_rebuilds_the_index(market, capsys):
+    update_market_index()
+    with open(PANEL_SOURCES["valuation"], 'r') as f:
+        marker = json.load(f)
+    assert marker["financial_date"] == "report_date"
+    marker["financial_date"] = "announce_date"
+    with open(PANEL_SOURCES["valuation"], 'w') as f:
+        json.dump(marker, f)
+
+    capsys.readouterr()
+    update_market_index()
+    assert "Market index built" in capsys.readouterr().out
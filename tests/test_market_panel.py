@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import market_panel
+
+
+@pytest.fixture
+def published(market):
+    registry = market_panel.publish_panels()
+    yield registry
+    market_panel.unpublish_panels()
+
+
+def test_segment_names_fit_macos_limit(published):
+    names = [segment["name"] for descriptor in published["panels"].values()
+             for segment in descriptor["segments"].values()]
+    assert {"bps_ttm", "eps_ttm", "roe_ttm", "update_date", "offsets"} <= set(published["panels"]["valuation"]["segments"])
+    # POSIX names carry a leading slash, which counts towards the limit
+    assert all(len("/" + name.lstrip("/")) <= market_panel.MAX_SEGMENT_NAME for name in names)
+    assert len(set(names)) == len(names)
+
+    # republishing does not reuse the names of the version still linked
+    republished = market_panel.publish_panels(["valuation"])
+    new_names = [segment["name"] for segment in republished["panels"]["valuation"]["segments"].values()]
+    assert not set(new_names) & set(names)
+    assert all(len("/" + name.lstrip("/")) <= market_panel.MAX_SEGMENT_NAME for name in new_names)
+
+
+def test_long_versions_still_fit(market):
+    assert len("/" + market_panel.get_segment_name(10**12, "valuation", "update_date")) <= market_panel.MAX_SEGMENT_NAME
+
+
+def test_attached_panel_matches_files(published):
+    panel = market_panel.attach_panel("valuation")
+    code = panel["codes"][0]
+    frame = market_panel.get_stock_frame(panel, code).copy()
+    market_panel.detach_panel(panel)
+
+    valuation_df = pd.read_csv(f"../data/processed/stock-valuation/all/stock_valuation_{code}.csv")
+    assert np.allclose(frame['pr_ttm'], valuation_df['pr_ttm'].astype(np.float32), equal_nan=True)
@@ -0,0 +1,116 @@
+import email
+from io import BytesIO
+from email.header import decode_header, make_header
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import send_emails_new
+
+
+class FakeSMTP:
+    """SMTP stand-in recording the session calls and the messages sent"""
+    sessions = []
+
+    def __init__(self, host_server, port=None):
+        self.host_server = host_server
+        self.port = port
+        self.logins = []
+        self.sent = []
+        self.sizes = []
+        self.closed = False
+        FakeSMTP.sessions.append(self)
+
+    def ehlo(self, host_server):
+        pass
+
+    def login(self, sender_mail, sender_passcode):
+        self.logins.append((sender_mail, sender_passcode))
+
+    def sendmail(self, sender, receiver, message):
+        self.sent.append((sender, receiver, email.message_from_bytes(message)))
+        self.sizes.append(len(message))
+
+    def quit(self):
+        self.closed = True
+
+
+@pytest.fixture
+def images(tmp_path):
+    """Three line charts over 40 KB each once optimized at 600 px, which fit 40 KB when shrunk further"""
+    rng = np.random.default_rng(0)
+    for i in range(3):
+        chart = Image.new('RGB', (800, 600), 'white')
+        draw = ImageDraw.Draw(chart)
+        for _ in range(7):
+            points = list(zip(np.linspace(0, 800, 400), 300 + rng.normal(0, 8, 400).cumsum()))
+            draw.line(points, fill=tuple(int(c) for c in rng.integers(0, 255, 3)), width=2)
+        chart.save(tmp_path / f"chart_{i}.png")
+    (tmp_path / "notes.txt").write_text("not an image")
+    return str(tmp_path)
+
+
+@pytest.fixture
+def smtp_env(monkeypatch):
+    FakeSMTP.sessions = []
+    monkeypatch.setattr(send_emails_new, "load_dotenv", lambda: None)
+    monkeypatch.setattr(send_emails_new, "SMTP_SSL", FakeSMTP)
+    monkeypatch.setattr(send_emails_new, "SMTP", FakeSMTP)
+    monkeypatch.setenv("SMTP_SERVER", "localhost")
+    monkeypatch.setenv("SENDER_EMAIL", "reports@example.com")
+    monkeypatch.setenv("EMAIL_AUTH_CODE", "secret")
+    monkeypatch.setenv("SMTP_PORT", "1025")
+    monkeypatch.setenv("SMTP_USE_SSL", "false")
+
+
+def test_one_session_for_all_receivers(images, smtp_env):
+    smtp = send_emails_new.open_smtp_session(**send_emails_new.get_smtp_settings())
+    number_of_messages = send_emails_new.send_mail("a@example.com, b@example.com", "Report", "content",
+                                                   img_dir=images, smtp=smtp, sender="reports@example.com")
+
+    assert number_of_messages == 1
+    assert len(FakeSMTP.sessions) == 1
+    assert (smtp.host_server, smtp.port, smtp.logins) == ("localhost", 1025, [("reports@example.com", "secret")])
+    # the caller's session is left open for its next report
+    assert not smtp.closed
+    assert [receiver for _, receiver, _ in smtp.sent] == ["a@example.com", "b@example.com"]
+    inline = [part.get_filename() for part in smtp.sent[0][2].walk() if part.get_content_maintype() == 'image']
+    assert inline == ["chart_0.png", "chart_1.png", "chart_2.png"]
+
+
+def test_session_and_sender_from_environment(images, smtp_env):
+    number_of_messages = send_emails_new.send_mail("a@example.com", "Report", "content", img_dir=images)
+
+    assert number_of_messages == 1
+    (smtp,) = FakeSMTP.sessions
+    assert smtp.closed
+    assert smtp.sent[0][0] == "reports@example.com"
+    assert smtp.sent[0][2]["From"] == "reports@example.com"
+
+
+def test_images_fit_budget_and_split_messages(images, smtp_env):
+    smtp = FakeSMTP("localhost")
+    number_of_messages = send_emails_new.send_mail("a@example.com", "Report", "content", img_dir=images,
+                                                   smtp=smtp, sender="reports@example.com",
+                                                   max_message_mb=0.05, max_width=600, budget_kb=40)
+
+    messages = [message for _, _, message in smtp.sent]
+    assert number_of_messages == len(messages) == 3
+    assert [str(make_header(decode_header(message["Subject"]))) for message in messages] == [f"Report (part {part})" for part in (1, 2, 3)]
+    assert all(size <= 0.05 * 1024 * 1024 for size in smtp.sizes)
+    widths = []
+    for message in messages:
+        for part in message.walk():
+            if part.get_content_maintype() == 'image':
+                data = part.get_payload(decode=True)
+                assert len(data) <= 40 * 1024
+                widths.append(Image.open(BytesIO(data)).width)
+    # the charts only fit the budget below the maximum width
+    assert len(widths) == 3 and all(width < 600 for width in widths)
+
+
+def test_no_sender(images, smtp_env, monkeypatch):
+    monkeypatch.delenv("SENDER_EMAIL")
+    with pytest.raises(ValueError, match="sender"):
+        send_emails_new.send_mail("a@example.com", "Report", "content", img_dir=images, smtp=FakeSMTP("localhost"))
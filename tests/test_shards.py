@@ -0,0 +1,63 @@
+import json
+
+import pandas as pd
+import pytest
+
+import merge_shards
+
+
+def fake_daily(symbol, start_date, end_date, adjust):
+    """akshare stand-in: two bars per stock, with the code in the close so merged files can be traced back"""
+    return pd.DataFrame({'date': ['2025-01-02', '2025-01-03'], 'open': 1.0, 'high': 2.0, 'low': 0.5,
+                         'close': [float(symbol[-3:]), float(symbol[-3:]) + 1], 'volume': 100})
+
+
+@pytest.mark.parametrize("shard_count", [2, 3])
+def test_shards_merge_to_every_stock_once(market, query_data_new, shard_count):
+    query_data_new.ak.stock_zh_a_daily = fake_daily
+    metadata = query_data_new.load_metadata()
+    metadata["price"] = {}
+    query_data_new.save_metadata(metadata)
+    codes = query_data_new.get_stock_list("all")['code'].tolist()
+
+    shard_codes = []
+    for shard_index in range(shard_count):
+        query_data_new.query_data("price", "all", shard=f"{shard_index}/{shard_count}")
+        with open(f"{query_data_new.get_shard_dir(shard_index, shard_count)}/query_metadata.json") as f:
+            shard_codes.append(sorted(json.load(f)["price"]))
+
+    # the shards partition the universe, and none of them is empty
+    assert all(shard_codes)
+    assert sorted(code for codes_of_shard in shard_codes for code in codes_of_shard) == sorted(codes)
+
+    shards = merge_shards.find_shard_dirs()
+    assert [(index, count) for index, count, _ in shards] == [(index, shard_count) for index in range(shard_count)]
+    staged = merge_shards.list_staged_files(shards, "price")
+    assert sorted(staged) == sorted(codes)
+    assert all(len(paths) == 1 for paths in staged.values())
+
+    result = merge_shards.merge_shards(shards)
+    assert result["conflicts"] == []
+    assert result["merged"]["price"] == len(codes)
+    assert merge_shards.find_shard_dirs() == []
+
+    # every stock's main file ends with its own fetched bars, and every stock is up to date
+    for code in codes:
+        price_df = pd.read_csv(f"../data/input/price-data/all/price_data_{code}.csv")
+        assert price_df['close'].tail(2).tolist() == [float(code[-3:]), float(code[-3:]) + 1]
+    assert merge_shards.report_coverage("all", shards)["price"] == []
+
+
+def test_conflicting_shards_stay_in_staging(market, query_data_new):
+    query_data_new.ak.stock_zh_a_daily = fake_daily
+    query_data_new.query_data("price", "all", force=True, shard="0/2")
+    query_data_new.ak.stock_zh_a_daily = lambda **kwargs: fake_daily(**kwargs).assign(close=1.0)
+    # a rerun with another shard count stages some of the same stocks with other prices
+    query_data_new.query_data("price", "all", force=True, shard="0/3")
+
+    shards = merge_shards.find_shard_dirs()
+    both = set(merge_shards.list_staged_files(shards[:1], "price")) & \
+        set(merge_shards.list_staged_files(shards[1:], "price"))
+    result = merge_shards.merge_shards(shards)
+    assert both and sorted(code for _, code, _ in result["conflicts"]) == sorted(both)
+    assert len(merge_shards.find_shard_dirs()) == 2
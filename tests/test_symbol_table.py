@@ -0,0 +1,24 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import symbol_table
+
+
+def build_codes():
+    return symbol_table.build_symbol_table()["codes"].tolist()
+
+
+def test_concurrent_builds(market):
+    with ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = [executor.submit(build_codes) for _ in range(8)]
+        tables = [result.result() for result in results]
+
+    assert all(codes == tables[0] for codes in tables)
+    with np.load(symbol_table.SYMBOL_TABLE_FILE) as archive:
+        assert archive['codes'].tolist() == tables[0]
+    # no temporary file is left behind
+    folder = os.path.dirname(symbol_table.SYMBOL_TABLE_FILE)
+    assert not [file for file in os.listdir(folder) if file.endswith(".tmp.npz")]
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from financial_store import load_financials, save_financials, get_financial_file
+from daily_valuation import build_daily_valuation, list_daily_codes
+from calculation_and_visualization_new import calculate_stock_values
+import valuation_asof
+from valuation_asof import load_as_of_values, load_as_of_history, verify_as_of
+
+# A month inside the test market's history (see conftest.TEST_END_DATE)
+AS_OF = "2025-06"
+
+
+def month_end(as_of):
+    return pd.Timestamp(as_of) + pd.offsets.MonthEnd(0)
+
+
+def test_as_of_values_only_use_announced_quarters(market):
+    values = load_as_of_values(AS_OF).set_index('code')
+    end = month_end(AS_OF)
+    assert set(values.index) <= set(list_daily_codes())
+
+    for code, row in values.iterrows():
+        financial_df = load_financials(code)
+        announced = financial_df[financial_df['announce_date'] <= end].sort_values(['announce_date', 'report_date'])
+        expected = announced.iloc[-1] if len(announced) else None
+        if expected is None:
+            assert np.isnan(row['eps_ttm'])
+        else:
+            assert row['eps_ttm'] == pytest.approx(expected['eps_ttm'], rel=1e-5)
+
+
+def test_as_of_history_matches_as_of_values(market):
+    code = list_daily_codes()[0]
+    history = load_as_of_history(code, AS_OF)
+    assert history['report_date'].max() <= month_end(AS_OF)
+    latest = load_as_of_values(AS_OF).set_index('code').loc[code]
+    assert history['pe_ttm'].iloc[-1] == pytest.approx(latest['pe_ttm'], rel=1e-5, nan_ok=True)
+
+
+def test_daily_as_of_needs_announce_date_archive(market):
+    build_daily_valuation(financial_date='report_date')
+    with pytest.raises(ValueError, match="announce_date"):
+        load_as_of_values(AS_OF, "daily")
+
+    build_daily_valuation(financial_date='announce_date', force=True)
+    daily = load_as_of_values(AS_OF, "daily").set_index('code')
+    monthly = load_as_of_values(AS_OF).set_index('code')
+    common = daily.index.intersection(monthly.index)
+    # the last trading day of the month and the month end see the same quarters
+    assert np.allclose(daily.loc[common, 'eps_ttm'], monthly.loc[common, 'eps_ttm'], equal_nan=True)
+
+
+def test_verify_as_of(market):
+    assert verify_as_of(AS_OF) == []
+
+
+def test_verify_as_of_detects_changed_inputs(market, monkeypatch):
+    # the recomputation reads the inputs again: values built from stale financials no longer match
+    code = list_daily_codes()[0]
+    stale = valuation_asof.read_announced_history()
+    financial_df = load_financials(code)
+    financial_df['eps_ttm'] *= 2
+    save_financials(financial_df, get_financial_file(code))
+    monkeypatch.setattr(valuation_asof, "read_announced_history", lambda stock_codes=None: stale)
+    assert code in verify_as_of(AS_OF)
+
+
+def test_as_of_before_the_history(market):
+    with pytest.raises(FileNotFoundError, match="No valuation data as of 2000-01"):
+        load_as_of_values("2000-01")
+
+
+def test_announce_date_valuations_are_read_directly(market, monkeypatch):
+    fallback = load_as_of_values(AS_OF).set_index('code')
+    calculate_stock_values(list_daily_codes(), financial_date='announce_date')
+
+    def recompute(stock_codes=None):
+        raise AssertionError("valued again from the inputs")
+    monkeypatch.setattr(valuation_asof, "read_announced_history", recompute)
+
+    values = load_as_of_values(AS_OF).set_index('code')
+    assert values.index.tolist() == fallback.index.tolist()
+    for column in ['close', 'eps_ttm', 'pe_ttm', 'pr_ttm_q25', 'pr_ttm_q75']:
+        np.testing.assert_allclose(values[column].astype(np.float64), fallback[column].astype(np.float64),
+                                   rtol=1e-5)
+    code = values.index[0]
+    history = load_as_of_history(code, AS_OF)
+    assert history['report_date'].max() <= month_end(AS_OF)
+    assert history['pe_ttm'].iloc[-1] == pytest.approx(values.loc[code, 'pe_ttm'], rel=1e-5)
+    assert verify_as_of(AS_OF) == []
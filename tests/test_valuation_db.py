@@ -0,0 +1,56 @@
+import os
+import sqlite3
+import importlib
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+import valuation_db
+
+
+def get_indexes():
+    # not through connect(), which creates missing indexes
+    conn = sqlite3.connect(valuation_db.VALUATION_DB_FILE)
+    try:
+        return {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                                 "AND name NOT LIKE 'sqlite_%'")}
+    finally:
+        conn.close()
+
+
+def test_failed_bulk_sync_keeps_indexes_and_rows(market, monkeypatch):
+    rows = len(valuation_db.query_sql("SELECT code FROM valuation"))
+    assert get_indexes() == set(valuation_db.INDEXES)
+    # every file rewritten: a bulk sync, which drops the indexes first
+    for file in os.listdir(valuation_db.VALUATION_DIR):
+        os.utime(os.path.join(valuation_db.VALUATION_DIR, file))
+
+    def failing_chunks(*args, **kwargs):
+        yield from []
+        raise OSError("disk full")
+    monkeypatch.setattr(valuation_db, "iter_valuation_chunks", failing_chunks)
+    with pytest.raises(OSError):
+        valuation_db.sync_valuation_db()
+
+    assert get_indexes() == set(valuation_db.INDEXES)
+    assert len(valuation_db.query_sql("SELECT code FROM valuation")) == rows
+
+
+def test_stream_run_syncs_database(market, query_data_new):
+    stream_pipeline = importlib.import_module("stream_pipeline")
+    codes = query_data_new.get_stock_list("all")['code'].tolist()[:3]
+    metadata = query_data_new.load_metadata()
+    last_date = (datetime.now() - timedelta(days=3)).strftime("%Y-%m-%d")
+    for code in codes:
+        metadata["price"][code] = last_date
+    query_data_new.save_metadata(metadata)
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    query_data_new.ak.stock_zh_a_daily = lambda symbol, start_date, end_date, adjust: pd.DataFrame(
+        {'date': [today], 'open': 999.0, 'high': 999.0, 'low': 999.0, 'close': 999.0})
+    stream_pipeline.run_stream("all", fetch_workers=1)
+
+    latest = valuation_db.query_sql("SELECT code, close FROM latest_valuation").set_index('code')['close']
+    assert (latest[codes] == 999.0).all()
+    assert (latest.drop(codes) != 999.0).all()